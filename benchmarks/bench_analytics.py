@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""Compare a year-long spending report from rollups with a full scan.
+
+Usage: python benchmarks/bench_analytics.py [n_purchases]
+"""
+
+from datetime import date, timedelta
+from expenses.app import create_app
+from expenses.model import db, Household, User, Purchase
+from expenses.rollups import PERIODS, rebuild_rollups, spend_report, \
+                             rollup_sums
+from sqlalchemy.sql import and_
+import fakeredis
+import os
+import sys
+import tempfile
+import timeit
+
+
+USERS = 10
+
+
+def seed(n_purchases):
+    db.session.add(Household(id=1, name='Bench', invite_code='bench'))
+    db.session.add_all(User(id=u, household_id=1, name='User {0}'.format(u),
+                            username='user{0}'.format(u), password='')
+                       for u in range(1, USERS + 1))
+    start = date(2000, 1, 1)
+    db.session.execute(Purchase.__table__.insert(), [{
+        'household_id': 1,
+        'user_id': i % USERS + 1,
+        'name': 'Purchase {0}'.format(i),
+        'cost': 100 + i % 1000,
+        'date': start + timedelta(days=i * 730 // n_purchases),
+    } for i in range(n_purchases)])
+    db.session.commit()
+    rebuild_rollups()
+
+
+def scan_report(start, end):
+    """Build the same report by reading every purchase in the range."""
+    rows = db.session.query(Purchase.user_id, Purchase.household_id,
+                            Purchase.date, Purchase.cost) \
+        .filter(and_(Purchase.household_id == 1, Purchase.date >= start,
+                     Purchase.date <= end))
+    return rollup_sums(rows)
+
+
+def main(n_purchases=200000):
+    fd, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path,
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'REDIS_WARM_CONNECTIONS': 0,
+    })
+    app.redis = fakeredis.FakeStrictRedis()
+    try:
+        with app.app_context():
+            db.create_all()
+            seed(n_purchases)
+            print('{0:>8} {1:>8} {2:>12} {3:>12}'.format(
+                'period', 'rows', 'rollups ms', 'scan ms'))
+            # Mid-month to mid-month, so both ends are partial periods
+            start, end = date(2000, 6, 15), date(2001, 6, 14)
+            for period in PERIODS:
+                rows = len(spend_report(1, period, start, end))
+                rollups = min(timeit.repeat(
+                    lambda: spend_report(1, period, start, end),
+                    number=5, repeat=3)) / 5
+                scan = min(timeit.repeat(
+                    lambda: scan_report(start, end),
+                    number=1, repeat=3))
+                print('{0:>8} {1:>8} {2:>12.2f} {3:>12.2f}'.format(
+                    period, rows, rollups * 1000, scan * 1000))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
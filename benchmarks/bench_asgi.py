@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""Load test the read endpoints, served by threads or by asyncio.
+
+Both servers run as a single uvicorn worker against the same seeded
+SQLite database and a real redis server. The threaded one runs the
+Flask app in a pool of threads, the way a threaded WSGI server would.
+The other is the asyncio app from expenses.asgi. Many clients then keep
+requests in flight at once, and each run reports throughput, p50/p99
+latency, and the most redis connections the worker had open at a time.
+
+Needs Python 3, uvicorn and the 'asgi' extra.
+
+Usage: python benchmarks/bench_asgi.py --redis-url redis://localhost/15
+"""
+
+from bench_requests import percentile, seed
+from expenses.app import create_app
+from expenses.model import db
+from json import dumps
+from redis import StrictRedis
+from timeit import default_timer as timer
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+MODES = ('threads', 'asyncio')
+PATHS = ('/', '/expenses', '/expenses?page=3')
+
+
+def config(args, path):
+    return {
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path,
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'REDIS_URL': args.redis_url,
+        'REDIS_MAX_CONNECTIONS': args.max_connections,
+        'REDIS_WARM_CONNECTIONS': 0,
+        'CACHE_TTL': args.cache_ttl,
+        'ASGI_THREADS': args.threads,
+    }
+
+
+def serve(args):
+    """Run one worker, in the process the load test started."""
+    import uvicorn
+    if args.serve == 'asyncio':
+        from expenses.asgi import create_asgi_app
+        app = create_asgi_app(config(args, args.db))
+        lifespan = 'on'
+    else:
+        from expenses.bridge import ThreadedWSGI
+        app = ThreadedWSGI(create_app(config(args, args.db)), args.threads)
+        lifespan = 'off'
+    uvicorn.run(app, host='127.0.0.1', port=args.port, log_level='warning',
+                lifespan=lifespan, backlog=4096)
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError('The server did not start')
+
+
+async def fetch(reader, writer, path):
+    """Make a keep-alive GET request, and return the status."""
+    writer.write('GET {0} HTTP/1.1\r\nHost: localhost\r\n'
+                 'Cookie: session=bench\r\n\r\n'.format(path).encode())
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    length = 0
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        if name.lower() == 'content-length':
+            length = int(value)
+    await reader.readexactly(length)
+    return int(lines[0].split()[1])
+
+
+async def load(port, path, concurrency, requests):
+    """Keep concurrency requests in flight, and return their latencies."""
+    times = []
+    remaining = [requests]
+
+    async def client():
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        try:
+            while remaining[0] > 0:
+                remaining[0] -= 1
+                start = timer()
+                status = await fetch(reader, writer, path)
+                times.append(timer() - start)
+                if status >= 400:
+                    raise RuntimeError('Got a {0} response'.format(status))
+        finally:
+            writer.close()
+
+    start = timer()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return times, timer() - start
+
+
+class ConnectionSampler(threading.Thread):
+
+    """Sample how many clients the redis server has, in the background."""
+
+    def __init__(self, redis, interval=0.05):
+        super(ConnectionSampler, self).__init__()
+        self.daemon = True
+        self.redis = redis
+        self.interval = interval
+        self.peak = 0
+        self.running = True
+
+    def run(self):
+        while self.running:
+            clients = self.redis.info('clients')['connected_clients']
+            self.peak = max(self.peak, clients)
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.join()
+        return self.peak
+
+
+def run_mode(args, mode, redis):
+    port = free_port()
+    redis.set('session:bench', dumps({'user': 1, 'household': 1,
+                                      'csrf': 'token'}))
+    # The sampler and this client are open throughout
+    baseline = redis.info('clients')['connected_clients'] + 1
+    server = subprocess.Popen([
+        sys.executable, __file__, '--serve', mode, '--db', args.db_path,
+        '--port', str(port), '--redis-url', args.redis_url,
+        '--max-connections', str(args.max_connections),
+        '--threads', str(args.threads),
+        '--cache-ttl', str(args.cache_ttl)])
+    results = {}
+    try:
+        wait_for(port)
+        for path in PATHS:
+            # Warm up, then measure
+            asyncio.run(load(port, path, args.concurrency,
+                             args.concurrency))
+            sampler = ConnectionSampler(StrictRedis.from_url(args.redis_url))
+            sampler.start()
+            times, elapsed = asyncio.run(load(port, path, args.concurrency,
+                                              args.requests))
+            peak = sampler.stop()
+            times.sort()
+            results[path] = {
+                'throughput_rps': round(len(times) / elapsed, 1),
+                'p50_ms': round(percentile(times, 50) * 1000, 3),
+                'p99_ms': round(percentile(times, 99) * 1000, 3),
+                'redis_connections': peak - baseline,
+            }
+    finally:
+        server.terminate()
+        server.wait()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--redis-url', required=True,
+                        help='a redis database the test may write to')
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=5000,
+                        help='timed requests per path')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--purchases', type=int, default=1000,
+                        help='purchases per user')
+    parser.add_argument('--max-connections', type=int, default=50,
+                        help='redis connections per worker')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='threads serving Flask requests per worker')
+    parser.add_argument('--cache-ttl', type=int, default=60,
+                        help='response cache TTL, 0 to disable it')
+    parser.add_argument('--mode', choices=MODES, action='append',
+                        help='run just this mode, may be repeated')
+    parser.add_argument('--serve', choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument('--db', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        serve(args)
+        return
+
+    fd, args.db_path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    try:
+        app = create_app(config(args, args.db_path))
+        with app.app_context():
+            db.create_all()
+            seed(args.users, args.purchases, '')
+        redis = StrictRedis.from_url(args.redis_url)
+        print('{0:<8} {1:<18} {2:>8} {3:>9} {4:>9} {5:>6}'.format(
+            'mode', 'path', 'req/s', 'p50 ms', 'p99 ms', 'redis'))
+        for mode in args.mode or MODES:
+            for path, result in sorted(run_mode(args, mode, redis).items()):
+                print('{0:<8} {1:<18} {2:>8.1f} {3:>9.2f} {4:>9.2f} '
+                      '{5:>6}'.format(mode, path, result['throughput_rps'],
+                                      result['p50_ms'], result['p99_ms'],
+                                      result['redis_connections']))
+    finally:
+        os.remove(args.db_path)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""Check that per-household latency stays flat as households are added.
+
+Every household gets the same users and purchases, so a request should
+cost the same however many other households share the database. The
+response cache is turned off, so every request reaches the database.
+
+Usage: python benchmarks/bench_households.py [max_households] [purchases]
+"""
+
+from datetime import date, timedelta
+from expenses.app import create_app
+from expenses.model import db, Household, User, Purchase, UserTotal
+from json import dumps
+import fakeredis
+import os
+import random
+import sys
+import tempfile
+import timeit
+
+
+USERS = 4
+SAMPLE = 10
+
+paths = ('/', '/expenses', '/expenses?total=1', '/settlement')
+
+
+def seed(first, last, n_purchases):
+    """Add households first to last - 1, with users and purchases."""
+    start = date(2000, 1, 1)
+    db.session.execute(Household.__table__.insert(), [
+        {'id': h, 'name': 'Household {0}'.format(h),
+         'invite_code': 'invite{0}'.format(h)}
+        for h in range(first, last)])
+    db.session.execute(User.__table__.insert(), [
+        {'id': h * USERS + u, 'household_id': h,
+         'name': 'User {0}'.format(u), 'username': 'user{0}.{1}'.format(h, u),
+         'password': ''}
+        for h in range(first, last) for u in range(USERS)])
+    db.session.execute(Purchase.__table__.insert(), [
+        {'household_id': h, 'user_id': h * USERS + i % USERS,
+         'name': 'Purchase {0}'.format(i), 'cost': 100 + i % 1000,
+         'date': start + timedelta(days=i // 10)}
+        for h in range(first, last) for i in range(n_purchases)])
+    db.session.execute(UserTotal.__table__.insert(), [
+        {'user_id': h * USERS + u, 'owed': 0,
+         'total': sum(100 + i % 1000 for i in range(u, n_purchases, USERS))}
+        for h in range(first, last) for u in range(USERS)])
+    db.session.commit()
+
+
+def sign_in(app, client, household):
+    """Give the client a session as the first user of a household."""
+    app.redis.set('session:bench', dumps({
+        'user': household * USERS,
+        'household': household,
+        'csrf': 'token',
+    }))
+    client.set_cookie('localhost', 'session', 'bench')
+
+
+def measure(app, client, households, path):
+    """Return the median time in ms to fetch a path, across households."""
+    times = []
+    for household in households:
+        sign_in(app, client, household)
+        times.append(min(timeit.repeat(lambda: client.get(path),
+                                       number=3, repeat=3)) / 3)
+    times.sort()
+    return times[len(times) // 2] * 1000
+
+
+def main(max_households=1000, n_purchases=200):
+    fd, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path,
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'REDIS_WARM_CONNECTIONS': 0,
+        'CACHE_TTL': 0,
+    })
+    app.redis = fakeredis.FakeStrictRedis()
+    rng = random.Random(0)
+    try:
+        with app.app_context():
+            db.create_all()
+            client = app.test_client()
+            print(' '.join(['{0:>10}'.format('households'),
+                            '{0:>10}'.format('purchases')] +
+                           ['{0:>18}'.format(p) for p in paths]))
+            seeded = 1
+            households = 1
+            while households <= max_households:
+                seed(seeded, households + 1, n_purchases)
+                seeded = households + 1
+                sample = rng.sample(range(1, seeded),
+                                    min(SAMPLE, households))
+                times = [measure(app, client, sample, p) for p in paths]
+                print(' '.join(['{0:>10}'.format(households),
+                                '{0:>10}'.format(households * n_purchases)] +
+                               ['{0:>16.2f}ms'.format(t) for t in times]))
+                households *= 10
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
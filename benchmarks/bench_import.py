@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""Time bulk imports of generated CSV and JSON files.
+
+Usage: python benchmarks/bench_import.py [n_rows]
+"""
+
+from expenses.app import create_app
+from expenses.importer import import_expenses
+from expenses.model import db, Household, User, Purchase
+import fakeredis
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+
+def generate(n_rows, fmt):
+    rows = [{'name': 'Purchase {0}'.format(i), 'price': '{0}.99'.format(i),
+             'date': '{0:02d}/{1:02d}/2015'.format(i % 12 + 1, i % 28 + 1)}
+            for i in range(n_rows)]
+    if fmt == 'csv':
+        lines = ['name,price,date']
+        lines.extend('{name},{price},{date}'.format(**row) for row in rows)
+        return '\n'.join(lines).encode()
+    return json.dumps(rows).encode()
+
+
+def main(n_rows=100000):
+    fd, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path,
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'REDIS_WARM_CONNECTIONS': 0,
+    })
+    app.redis = fakeredis.FakeStrictRedis()
+    try:
+        with app.app_context():
+            db.create_all()
+            household = Household(id=1, name='Bench')
+            user = User(name='Bench', username='bench', password='',
+                        household=household)
+            db.session.add(user)
+            db.session.commit()
+            for fmt in ('csv', 'json'):
+                data = generate(n_rows, fmt)
+                start = time.time()
+                summary = import_expenses(io.BytesIO(data), fmt, user.id)
+                elapsed = time.time() - start
+                print('{0:<5} {1} rows in {2:.2f}s ({3:.0f} rows/s)'.format(
+                    fmt, summary['imported'], elapsed,
+                    summary['imported'] / elapsed))
+            print('{0} purchases stored'.format(Purchase.query.count()))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""Compare page latency of OFFSET and cursor pagination by depth.
+
+Usage: python benchmarks/bench_pagination.py [n_purchases]
+"""
+
+from datetime import date, timedelta
+from expenses.app import create_app
+from expenses.model import db, Household, User, Purchase
+from expenses.util import encode_cursor
+from expenses.views import PER_PAGE
+import fakeredis
+import os
+import sys
+import tempfile
+import timeit
+
+
+def seed(n_purchases):
+    # Signed out, the listing shows the default household
+    household = Household(id=1, name='Bench')
+    user = User(name='Bench', username='bench', password='',
+                household=household)
+    db.session.add(user)
+    db.session.commit()
+    start = date(2000, 1, 1)
+    db.session.execute(Purchase.__table__.insert(), [{
+        'name': 'Purchase {0}'.format(i),
+        'cost': 100 + i % 1000,
+        'date': start + timedelta(days=i // 10),
+        'user_id': user.id,
+        'household_id': household.id,
+    } for i in range(n_purchases)])
+    db.session.commit()
+
+
+def cursor_for(page):
+    """Return the cursor that starts at the given page number."""
+    last = (db.session.query(Purchase.date, Purchase.id)
+            .order_by(Purchase.date.desc(), Purchase.id.desc())
+            .offset(page * PER_PAGE - 1).first())
+    return encode_cursor(last.date, last.id)
+
+
+def main(n_purchases=100000):
+    fd, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path,
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'REDIS_WARM_CONNECTIONS': 0,
+        # Time the queries, not the cached pages every repeat after one
+        'CACHE_TTL': 0,
+    })
+    app.redis = fakeredis.FakeStrictRedis()
+    try:
+        with app.app_context():
+            db.create_all()
+            seed(n_purchases)
+            client = app.test_client()
+            pages = n_purchases // PER_PAGE
+            print('{0:>8} {1:>12} {2:>12}'.format('page', 'offset ms',
+                                                  'cursor ms'))
+            for page in (1, pages // 100, pages // 10, pages // 2, pages - 1):
+                if page < 1:
+                    continue
+                page_url = '/expenses?page={0}'.format(page)
+                cursor_url = '/expenses?cursor=' + cursor_for(page)
+                offset = min(timeit.repeat(lambda: client.get(page_url),
+                                           number=5, repeat=3)) / 5
+                cursor = min(timeit.repeat(lambda: client.get(cursor_url),
+                                           number=5, repeat=3)) / 5
+                print('{0:>8} {1:>12.2f} {2:>12.2f}'.format(
+                    page, offset * 1000, cursor * 1000))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""Measure the request hot paths, and write the results as JSON.
+
+Seeds a SQLite database with users and their purchases, then times each
+scenario request by request, through the test client. Redis is faked
+in-process unless --redis-url points at a real server, which has its
+keys written to. Each scenario reports throughput and p50/p99 latency.
+
+Usage: python benchmarks/bench_requests.py [options] > results.json
+       python benchmarks/bench_requests.py --compare old.json new.json
+"""
+
+from datetime import date, timedelta
+from expenses.app import create_app
+from expenses.model import db, Household, User, Purchase
+from expenses.totals import rebuild_totals
+from expenses.util import encode_cursor
+from expenses.views import PER_PAGE
+from json import dumps
+from timeit import default_timer as timer
+import argparse
+import fakeredis
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def seed(n_users, n_purchases, password):
+    """Add users, each with n_purchases purchases, and their totals."""
+    db.session.add(Household(id=1, name='Bench', invite_code='bench'))
+    db.session.execute(User.__table__.insert(), [
+        {'id': u, 'household_id': 1, 'name': 'User {0}'.format(u),
+         'username': 'user{0}'.format(u), 'password': password}
+        for u in range(1, n_users + 1)])
+    start = date(2000, 1, 1)
+    rows = []
+    for i in range(n_users * n_purchases):
+        rows.append({'household_id': 1, 'user_id': i % n_users + 1,
+                     'name': 'Purchase {0}'.format(i), 'cost': 100 + i % 1000,
+                     'date': start + timedelta(days=i // 10)})
+        if len(rows) == 10000:
+            db.session.execute(Purchase.__table__.insert(), rows)
+            rows = []
+    if rows:
+        db.session.execute(Purchase.__table__.insert(), rows)
+    rebuild_totals()
+    db.session.commit()
+
+
+def set_session(app, client, **data):
+    data['csrf'] = 'token'
+    app.redis.set('session:bench', dumps(data))
+    client.set_cookie('localhost', 'session', 'bench')
+
+
+def deep_position(fraction):
+    """Return the (date, id) of the purchase a fraction into the listing."""
+    count = Purchase.query.count()
+    return (db.session.query(Purchase.date, Purchase.id)
+            .order_by(Purchase.date.desc(), Purchase.id.desc())
+            .offset(max(0, int(count * fraction) - 1)).first())
+
+
+def scenarios(app, client):
+    """Yield (name, setup, run) for each scenario.
+
+    setup runs before each request, outside the timing.
+    """
+    def signed_in():
+        set_session(app, client, user=1, household=1)
+
+    def signed_out():
+        set_session(app, client)
+
+    pages = Purchase.query.count() // PER_PAGE
+    deep = deep_position(0.9)
+    deep_cursor = encode_cursor(deep.date, deep.id)
+
+    yield 'home', signed_in, lambda: client.get('/')
+    yield 'expenses_shallow', signed_in, \
+        lambda: client.get('/expenses?page=1')
+    yield 'expenses_deep_page', signed_in, \
+        lambda: client.get('/expenses?page={0}'.format(pages * 9 // 10))
+    yield 'expenses_deep_cursor', signed_in, \
+        lambda: client.get('/expenses?cursor=' + deep_cursor)
+    yield 'add_expense', signed_in, lambda: client.post('/expenses', data={
+        'token': 'token',
+        'name': 'Groceries',
+        'price': '12.34',
+        'date': '01/05/2015',
+    })
+    yield 'auth', signed_out, lambda: client.post('/auth', data={
+        'token': 'token',
+        'username': 'user1',
+        'password': 'hunter2',
+    })
+
+    interface = app.session_interface
+    headers = {'Cookie': 'session=bench'}
+
+    def open_session():
+        with app.test_request_context('/', headers=headers) as ctx:
+            # Sessions load lazily, on first use
+            interface.open_session(app, ctx.request).get('user')
+
+    def save_session():
+        with app.test_request_context('/', headers=headers) as ctx:
+            session = interface.open_session(app, ctx.request)
+            session['seen'] = True
+            interface.save_session(app, session, app.response_class())
+
+    yield 'session_open', signed_in, open_session
+    yield 'session_save', signed_in, save_session
+
+
+def percentile(ordered, p):
+    """Return the nearest-rank percentile of a sorted list."""
+    return ordered[max(0, int(math.ceil(p / 100.0 * len(ordered))) - 1)]
+
+
+def measure(setup, run, requests, warmup):
+    for _ in range(warmup):
+        setup()
+        response = run()
+        if getattr(response, 'status_code', 200) >= 400:
+            raise RuntimeError('Got a {0} response'.format(
+                response.status_code))
+    times = []
+    for _ in range(requests):
+        setup()
+        start = timer()
+        run()
+        times.append(timer() - start)
+    times.sort()
+    return {
+        'requests': requests,
+        'throughput_rps': round(requests / sum(times), 1),
+        'p50_ms': round(percentile(times, 50) * 1000, 3),
+        'p99_ms': round(percentile(times, 99) * 1000, 3),
+        'mean_ms': round(sum(times) / requests * 1000, 3),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    fd, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path,
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'REDIS_URL': args.redis_url or 'redis://localhost',
+        'REDIS_WARM_CONNECTIONS': 1 if args.redis_url else 0,
+        'BCRYPT_ROUNDS': args.bcrypt_rounds,
+        'CACHE_TTL': args.cache_ttl,
+    })
+    if not args.redis_url:
+        app.redis = fakeredis.FakeStrictRedis()
+    try:
+        with app.app_context():
+            db.create_all()
+            seed(args.users, args.purchases, app.hasher.hash('hunter2'))
+            client = app.test_client()
+            results = {}
+            for name, setup, fn in scenarios(app, client):
+                if args.only and name not in args.only:
+                    continue
+                results[name] = measure(setup, fn, args.requests,
+                                        args.warmup)
+    finally:
+        os.remove(path)
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'time': int(time.time()),
+            'python': platform.python_version(),
+            'redis': 'real' if args.redis_url else 'fake',
+            'users': args.users,
+            'purchases_per_user': args.purchases,
+            'bcrypt_rounds': args.bcrypt_rounds,
+            'cache_ttl': args.cache_ttl,
+        },
+        'results': results,
+    }
+
+
+def compare(old_path, new_path):
+    """Print how each scenario's latency changed between two runs."""
+    with open(old_path) as f:
+        old = json.load(f)['results']
+    with open(new_path) as f:
+        new = json.load(f)['results']
+    print('{0:<22} {1:>10} {2:>10} {3:>8} {4:>10} {5:>10} {6:>8}'.format(
+        'scenario', 'old p50', 'new p50', 'change', 'old p99', 'new p99',
+        'change'))
+    for name in sorted(set(old) & set(new)):
+        row = [name]
+        for key in ('p50_ms', 'p99_ms'):
+            row.extend([old[name][key], new[name][key],
+                        (new[name][key] / old[name][key] - 1) * 100])
+        print('{0:<22} {1:>10.3f} {2:>10.3f} {3:>+7.1f}% '
+              '{4:>10.3f} {5:>10.3f} {6:>+7.1f}%'.format(*row))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--purchases', type=int, default=1000,
+                        help='purchases per user')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='timed requests per scenario')
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--bcrypt-rounds', type=int, default=12)
+    parser.add_argument('--cache-ttl', type=int, default=0,
+                        help='response cache TTL, 0 (the default) to '
+                        'time uncached requests')
+    parser.add_argument('--redis-url',
+                        help='use this redis server instead of a fake one')
+    parser.add_argument('--only', action='append',
+                        help='run just this scenario, may be repeated')
+    parser.add_argument('--output', help='write JSON here, not stdout')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two result files instead')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    output = dumps(run(args), indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""Time purchase searches as the purchase table grows.
+
+Each of HOUSEHOLDS households has the same few purchases at Trader
+Joe's, among a growing number of other purchases, so a search of one
+household should take about as long however big the table is. LIKE
+scans every row, for comparison.
+
+Usage: python benchmarks/bench_search.py [sizes...]
+"""
+
+from datetime import date, timedelta
+from expenses.app import create_app
+from expenses.model import db, Household, User, Purchase
+from expenses.search import rebuild_index, search_purchases
+import fakeredis
+import os
+import sys
+import tempfile
+import timeit
+
+
+HOUSEHOLDS = 100
+MATCHES = 20
+WORDS = ['Groceries', 'Rent', 'Utilities', 'Coffee', 'Hardware', 'Books',
+         'Takeout', 'Pharmacy', 'Gas', 'Internet']
+
+
+def seed(n_purchases):
+    for h in range(1, HOUSEHOLDS + 1):
+        db.session.add(Household(id=h, name='Bench {0}'.format(h),
+                                 invite_code='bench{0}'.format(h)))
+        db.session.add(User(id=h, household_id=h, name='User',
+                            username='user{0}'.format(h), password=''))
+    start = date(2000, 1, 1)
+    # Households' purchases are interleaved, as they're added at once
+    rows = [{
+        'household_id': i % HOUSEHOLDS + 1,
+        'user_id': i % HOUSEHOLDS + 1,
+        'name': u'{0} {1}'.format(WORDS[i % len(WORDS)], i),
+        'cost': 100,
+        'date': start + timedelta(days=i % 3650),
+    } for i in range(n_purchases)]
+    per_household = n_purchases // HOUSEHOLDS
+    for h in range(HOUSEHOLDS):
+        for i in range(MATCHES):
+            row = rows[i * per_household // MATCHES * HOUSEHOLDS + h]
+            row['name'] = u"Trader Joe's"
+    db.session.execute(Purchase.__table__.insert(), rows)
+    db.session.commit()
+
+
+def time_search(n_purchases, backend):
+    fd, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path,
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'REDIS_WARM_CONNECTIONS': 0,
+        'SEARCH_BACKEND': backend,
+    })
+    app.redis = fakeredis.FakeStrictRedis()
+    try:
+        with app.app_context():
+            db.create_all()
+            seed(n_purchases)
+            rebuild_index()
+            search = min(timeit.repeat(
+                lambda: search_purchases(1, u'trader jo', limit=51),
+                number=10, repeat=3)) / 10
+            like = min(timeit.repeat(
+                lambda: Purchase.query.filter(
+                    Purchase.household_id == 1,
+                    Purchase.name.like(u'%trader jo%')).limit(51).all(),
+                number=3, repeat=3)) / 3
+            return search, like
+    finally:
+        os.remove(path)
+
+
+def main(*sizes):
+    print('{0:>8} {1:>8} {2:>10} {3:>10}'.format('rows', 'backend',
+                                                 'search ms', 'LIKE ms'))
+    for size in sizes or (10000, 100000, 500000):
+        for backend in ('sqlite', 'redis'):
+            search, like = time_search(size, backend)
+            print('{0:>8} {1:>8} {2:>10.2f} {3:>10.2f}'.format(
+                size, backend, search * 1000, like * 1000))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""Compare session serializers by speed and bytes stored in redis.
+
+Usage: python benchmarks/bench_session_codec.py
+"""
+
+from expenses.session import RedisSessionInterface, serializers
+from expenses.util import random_string
+import timeit
+
+
+SESSIONS = {
+    'anonymous': {'csrf': random_string(64)},
+    'signed in': {'csrf': random_string(64), 'user': 1234},
+    'flashed': {'csrf': random_string(64), 'user': 1234,
+                '_flashes': [['error', 'Expected a valid price']]},
+}
+
+
+def main(number=100000):
+    key = RedisSessionInterface().redis_key(random_string(64))
+    print('{0:<10} {1:<8} {2:>10} {3:>10} {4:>8}'.format(
+        'session', 'codec', 'encode us', 'decode us', 'bytes'))
+    for label, data in sorted(SESSIONS.items()):
+        for name, serializer_class in sorted(serializers.items()):
+            serializer = serializer_class()
+            encoded = serializer.dumps(data)
+            encode = min(timeit.repeat(lambda: serializer.dumps(data),
+                                       number=number, repeat=3))
+            decode = min(timeit.repeat(lambda: serializer.loads(encoded),
+                                       number=number, repeat=3))
+            print('{0:<10} {1:<8} {2:>10.2f} {3:>10.2f} {4:>8}'.format(
+                label, name, encode / number * 1e6, decode / number * 1e6,
+                len(key) + len(encoded)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""Time settling up random balances for groups of increasing size.
+
+Usage: python benchmarks/bench_settlement.py
+"""
+
+from expenses.settlement import equal_shares, settle
+import random
+import timeit
+
+
+def main():
+    rng = random.Random(0)
+    print('{0:>8} {1:>10} {2:>10} {3:>10}'.format('people', 'payments',
+                                                  'n - 1', 'ms'))
+    for n in (10, 100, 1000, 10000, 100000):
+        balances = equal_shares([(i, rng.randint(0, 100000))
+                                 for i in range(n)])
+        number = max(1, 10000 // n)
+        elapsed = min(timeit.repeat(lambda: settle(balances), number=number,
+                                    repeat=3)) / number
+        print('{0:>8} {1:>10} {2:>10} {3:>10.2f}'.format(
+            n, len(settle(balances)), n - 1, elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main()
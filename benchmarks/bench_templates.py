@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""Compare a new worker's startup and first request by template caching.
+
+Each run builds a fresh app, as a new worker would, and times creating
+it and then its first home page and error page. Jinja's in-memory cache
+starts empty every time, so only the bytecode cache carries over.
+
+Usage: python benchmarks/bench_templates.py [runs]
+"""
+
+from expenses.app import create_app
+from expenses.model import db, Household
+from expenses.templating import precompile_templates
+from timeit import default_timer as timer
+import fakeredis
+import shutil
+import sys
+import tempfile
+
+
+def first_requests(redis, **config):
+    """Return seconds to create an app, and for its first two requests."""
+    # create_app would precompile before we can swap in the fake redis
+    precompile = config.pop('TEMPLATE_PRECOMPILE', False)
+    config.update({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'REDIS_WARM_CONNECTIONS': 0,
+    })
+    start = timer()
+    app = create_app(config)
+    app.redis = redis
+    if precompile:
+        precompile_templates(app)
+    created = timer()
+    with app.app_context():
+        db.create_all()
+        db.session.add(Household(id=1, name='Home', invite_code='home'))
+        db.session.commit()
+        client = app.test_client()
+        requests = timer()
+        client.get('/')
+        client.get('/missing')
+        done = timer()
+    return created - start, done - requests
+
+
+def main(runs=20):
+    cache_dir = tempfile.mkdtemp()
+    setups = [
+        ('no cache', {}),
+        ('filesystem', {'TEMPLATE_CACHE': 'filesystem',
+                        'TEMPLATE_CACHE_DIR': cache_dir}),
+        ('redis', {'TEMPLATE_CACHE': 'redis'}),
+        ('redis, precompiled', {'TEMPLATE_CACHE': 'redis',
+                                'TEMPLATE_PRECOMPILE': True}),
+    ]
+    print('{0:<20} {1:>12} {2:>18}'.format('cache', 'startup ms',
+                                           'first requests ms'))
+    try:
+        for label, config in setups:
+            redis = fakeredis.FakeStrictRedis()
+            # One worker fills the cache for the rest
+            first_requests(redis, **config)
+            times = [first_requests(redis, **config) for _ in range(runs)]
+            print('{0:<20} {1:>12.2f} {2:>18.2f}'.format(
+                label, min(t[0] for t in times) * 1000,
+                min(t[1] for t in times) * 1000))
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -2,34 +2,99 @@
 """Flask application factory."""
 
 from flask import Flask
-from redis import StrictRedis
 from . import __name__ as package_name
 import os
 
 
-def create_app():
+def create_app(config=None):
     """Return an instance of the main Flask application."""
     app = Flask(package_name)
+    if config is not None:
+        app.config.update(config)
 
     app.config.setdefault('REDIS_URL', 'redis://localhost')
+    app.config.setdefault('REDIS_MAX_CONNECTIONS', 50)
+    # Seconds to wait for a free connection once all are in use
+    app.config.setdefault('REDIS_POOL_TIMEOUT', 5)
+    app.config.setdefault('REDIS_WARM_CONNECTIONS', 2)
+    app.config.setdefault('REDIS_SOCKET_TIMEOUT', 5)
+    app.config.setdefault('REDIS_CONNECT_TIMEOUT', 2)
+    # Check idle connections before use, if idle for this many seconds
+    app.config.setdefault('REDIS_HEALTH_CHECK', 30)
+    app.config.setdefault('SESSION_SERIALIZER', 'json')
+    # Shown to anyone signed out, and joined by signups without an invite
+    app.config.setdefault('DEFAULT_HOUSEHOLD', 1)
+    app.config.setdefault('SESSION_CACHE_SIZE', 0)
+    app.config.setdefault('SESSION_CACHE_TTL', 5)
+    # None, 'filesystem' or 'redis'
+    app.config.setdefault('TEMPLATE_CACHE', None)
+    app.config.setdefault('TEMPLATE_CACHE_DIR', None)
+    app.config.setdefault('TEMPLATE_CACHE_TTL', None)
+    app.config.setdefault('TEMPLATE_PRECOMPILE', False)
+    # 'sqlite' or 'redis', or None for FTS5 whenever SQLite has it
+    app.config.setdefault('SEARCH_BACKEND', None)
+    # Seconds a feed stream stays open before the browser reconnects, and
+    # between the comments that keep an idle one from timing out. Under
+    # WSGI each open stream holds a worker thread, so the Flask app only
+    # long polls: its streams end after the first message, or after
+    # FEED_POLL_TIMEOUT. Serve the app with expenses.asgi to hold them
+    # open for FEED_TIMEOUT without a thread each.
+    app.config.setdefault('FEED_TIMEOUT', 300)
+    app.config.setdefault('FEED_POLL_TIMEOUT', 20)
+    app.config.setdefault('FEED_KEEPALIVE', 15)
+    app.config.setdefault('BCRYPT_ROUNDS', 12)
+    app.config.setdefault('BCRYPT_WORKERS', 4)
+    app.config.setdefault('BCRYPT_MAX_PENDING', 16)
 
     from .model import db
     db.init_app(app)
 
+    if app.config.get('METRICS'):
+        from .metrics import init_metrics
+        init_metrics(app)
+
+    from .pool import RedisPool
+    app.redis_pool = RedisPool.from_config(app.config)
+    app.redis = app.redis_pool.client
+
     @app.before_first_request
-    def init_db():
-        app.redis = StrictRedis.from_url(app.config['REDIS_URL'])
+    def warm_redis_pool():
+        # Not up front, so creating an app doesn't connect to redis
+        app.redis_pool.warm()
+
+    from .feed import Feed
+    app.feed = Feed()
+
+    from .hashing import Hasher
+    app.hasher = Hasher(app.config['BCRYPT_ROUNDS'],
+                        app.config['BCRYPT_WORKERS'],
+                        app.config['BCRYPT_MAX_PENDING'])
 
     from .error import register_error_handler, html_handler
     register_error_handler(app, html_handler)
 
-    from .session import LazyRedisSessionInterface
-    app.session_interface = LazyRedisSessionInterface()
+    from .session import LazyRedisSessionInterface, SessionCache, serializers
+    serializer = serializers[app.config['SESSION_SERIALIZER']]()
+    cache = None
+    if app.config['SESSION_CACHE_SIZE']:
+        cache = SessionCache(app.config['SESSION_CACHE_SIZE'],
+                             app.config['SESSION_CACHE_TTL'])
+    app.session_interface = LazyRedisSessionInterface(serializer, cache)
+
+    from .templating import bytecode_cache
+    app.jinja_env.bytecode_cache = bytecode_cache(app)
 
     from .util import price_filter
     app.jinja_env.filters['price'] = price_filter
 
+    from .cli import register_commands
+    register_commands(app)
+
     from .views import views
     app.register_blueprint(views)
 
+    if app.config['TEMPLATE_PRECOMPILE']:
+        from .templating import precompile_templates
+        precompile_templates(app)
+
     return app
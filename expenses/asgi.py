@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+"""An asyncio server for the read endpoints.
+
+The home page, GET /expenses and its feed are served without blocking a
+worker: sessions and cached responses go through an asyncio redis
+client, and queries through an async database driver, so one worker can
+have many requests waiting on I/O at once, and hold open many feeds.
+Every other request is handed to the Flask app from create_app, in a
+pool of threads.
+
+Flask 1 keeps request contexts per thread rather than per task, so one
+is only pushed around code that doesn't await, to build queries and
+render responses with the same functions the Flask views use. The
+requests served here don't run the app's request hooks, so they aren't
+timed with METRICS, and their sessions are always read from redis,
+without the app's SESSION_CACHE.
+
+This needs Python 3.6 or later, and the 'asgi' extra. It runs under any
+ASGI server, for example::
+
+    uvicorn --factory expenses.asgi:create_asgi_app
+"""
+
+from collections import defaultdict
+from databases import Database
+from flask import jsonify, make_response, redirect, url_for
+from redis import RedisError
+from redis.asyncio import BlockingConnectionPool, Redis
+from sqlalchemy.sql import func, select
+from .app import create_app
+from .bridge import ThreadedWSGI, request_environ, send_response, \
+                    wait_disconnect
+from .cache import COUNT_TTL, count_key, response_cache
+from .feed import Feed, logged_since, position_key, queue_read_log
+from .model import Purchase, User
+from .views import FEED_RELOAD, FEED_RETRY, expenses_etag, feed_message, \
+                   feed_position, feed_reloads, feed_response, feed_url, \
+                   household_obj, household_query, invalid_position, \
+                   listing_position, new_purchases_query, page_obj, \
+                   page_query, purchases_cache_name, render_home, \
+                   user_totals, user_totals_query
+import asyncio
+
+
+class AsyncFeed(object):
+
+    """Wake a worker's open feeds when their household has news.
+
+    This is Feed for asyncio: one task listens to every household's
+    channel, and sets the events of the feeds waiting on that one.
+    """
+
+    def __init__(self):
+        self.waiters = defaultdict(set)
+        self.listener = None
+
+    async def listen(self, redis):
+        while True:
+            pubsub = redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.psubscribe(Feed.pattern)
+                # Anything published before then may have been missed
+                self.wake(list(self.waiters))
+                async for message in pubsub.listen():
+                    self.wake([message['channel'].decode().partition(':')[2]])
+            except RedisError:
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.reset()
+
+    def wake(self, households):
+        for household in households:
+            for event in self.waiters.get(household, ()):
+                event.set()
+
+    def subscribe(self, redis, household):
+        """Return an event that's set when a household has new purchases."""
+        if self.listener is None or self.listener.done():
+            self.listener = asyncio.ensure_future(self.listen(redis))
+        event = asyncio.Event()
+        self.waiters[str(household)].add(event)
+        return event
+
+    def unsubscribe(self, household, event):
+        waiters = self.waiters.get(str(household))
+        if waiters is not None:
+            waiters.discard(event)
+            if not waiters:
+                del self.waiters[str(household)]
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.cancel()
+
+
+class AsyncExpenses(object):
+
+    """Serve a Flask app's read endpoints with asyncio.
+
+    redis is an asyncio client, and database a connected Database, on
+    the same servers as the app's own clients. Other requests are served
+    by the app in up to threads threads.
+    """
+
+    def __init__(self, app, redis, database, threads=8):
+        self.app = app
+        self.redis = redis
+        self.database = database
+        self.fallback = ThreadedWSGI(app, threads)
+        self.feed = AsyncFeed()
+        self.routes = {
+            ('GET', '/'): self.home,
+            ('GET', '/expenses'): self.get_expenses,
+        }
+        # These send their own responses, a bit at a time
+        self.streams = {
+            ('GET', '/expenses/stream'): self.expense_stream,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        handler = stream = None
+        if scope['type'] == 'http':
+            route = (scope['method'], scope['path'])
+            handler = self.routes.get(route)
+            stream = self.streams.get(route)
+        if stream is not None:
+            return await stream(request_environ(scope), receive, send)
+        if handler is None:
+            return await self.fallback(scope, receive, send)
+        environ = request_environ(scope)
+        response = await handler(environ)
+        await send_response(send, response, environ)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def startup(self):
+        await self.database.connect()
+
+    async def shutdown(self):
+        self.feed.close()
+        await self.database.disconnect()
+        await self.redis.connection_pool.disconnect()
+
+    def request_context(self, environ, session):
+        """Return a request context using an already loaded session."""
+        ctx = self.app.request_context(environ)
+        ctx.session = session
+        return ctx
+
+    def statement(self, fn, *args):
+        """Return the SQL of a query built by one of the views' functions."""
+        with self.app.app_context():
+            return fn(*args).statement
+
+    async def open_session(self, request):
+        """Load a request's session as the app's session interface would."""
+        interface = self.app.session_interface
+        sid = request.cookies.get(self.app.session_cookie_name)
+        if sid:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.get(interface.redis_key(sid))
+            pipe.ttl(interface.redis_key(sid))
+            data, ttl = await pipe.execute()
+            if data:
+                return interface.stored_session(
+                    sid, interface.serializer.loads(data), ttl)
+        return interface.new_session()
+
+    async def save_session(self, session, response):
+        interface = self.app.session_interface
+        pipe = self.redis.pipeline()
+        interface.queue_save(self.app, session, pipe)
+        written = len(pipe)
+        if written:
+            await pipe.execute()
+        interface.finish_save(self.app, session, response, written)
+
+    async def current_household(self, session):
+        """Return the household a request is scoped to, like the views."""
+        if not session.authed:
+            return self.app.config['DEFAULT_HOUSEHOLD']
+        if 'household' not in session:
+            session['household'] = await self.database.fetch_val(
+                select([User.household_id])
+                .where(User.id == session['user']))
+        return session['household']
+
+    async def cached(self, household, name, compute):
+        """Return the response cache's value for name, or compute it."""
+        ttl = self.app.config.get('CACHE_TTL', 60)
+        if not ttl:
+            return await compute()
+        keys = response_cache.keys(household, name)
+        generation, value = response_cache.lookup(
+            *await self.redis.mget(*keys))
+        if value is not None:
+            return value
+        value = await compute()
+        pipe = self.redis.pipeline(transaction=False)
+        response_cache.queue_store(pipe, keys[1], generation, value, ttl)
+        await pipe.execute()
+        return value
+
+    async def purchase_count(self, household):
+        key = count_key(household)
+        count = await self.redis.get(key)
+        if count is None:
+            count = await self.database.fetch_val(
+                select([func.count()]).select_from(Purchase.__table__)
+                .where(Purchase.household_id == household))
+            await self.redis.set(key, count, ex=COUNT_TTL, nx=True)
+        return int(count)
+
+    async def user_totals(self, household):
+        return user_totals(household, await self.database.fetch_all(
+            self.statement(user_totals_query, household)))
+
+    async def log_position(self, household):
+        return int(await self.redis.hget(position_key(household),
+                                         'position') or 0)
+
+    async def household_obj(self, household):
+        return household_obj(household, await self.database.fetch_one(
+            self.statement(household_query, household)))
+
+    async def purchases_obj(self, environ, session, household, page=0,
+                            cursor=None):
+        rows = await self.database.fetch_all(
+            self.statement(page_query, household, page, cursor))
+        with self.request_context(environ, session):
+            return page_obj(rows)
+
+    async def login_redirect(self, environ, session):
+        with self.request_context(environ, session):
+            response = redirect(url_for('views.login_page'), code=303)
+        await self.save_session(session, response)
+        return response
+
+    async def home(self, environ):
+        request = self.app.request_class(environ)
+        session = await self.open_session(request)
+        household = await self.current_household(session)
+        if household is None:
+            return await self.login_redirect(environ, session)
+
+        position = await self.log_position(household)
+        users = await self.cached(household, 'user-totals',
+                                  lambda: self.user_totals(household))
+        purchases = await self.cached(
+            household, purchases_cache_name(request.host_url),
+            lambda: self.purchases_obj(environ, session, household))
+        invite_code = None
+        if session.authed:
+            invite_code = (await self.cached(
+                household, 'household',
+                lambda: self.household_obj(household)))['invite_code']
+        with self.request_context(environ, session):
+            response = make_response(render_home(users, purchases,
+                                                 invite_code, position))
+        await self.save_session(session, response)
+        return response
+
+    async def get_expenses(self, environ):
+        request = self.app.request_class(environ)
+        session = await self.open_session(request)
+        household = await self.current_household(session)
+        if household is None:
+            return await self.login_redirect(environ, session)
+
+        generation = int(await self.redis.get(
+            response_cache.redis_key(household, 'generation')) or 0)
+        with self.request_context(environ, session):
+            etag = expenses_etag(household, generation)
+            try:
+                page, cursor = listing_position()
+                error = None
+            except ValueError as e:
+                error = jsonify({'msg': str(e)})
+        if etag in request.if_none_match:
+            response = self.app.response_class('', 304)
+            response.set_etag(etag)
+        elif error is not None:
+            response = error
+            response.status_code = 404
+        else:
+            first = page == 0 and cursor is None
+            if first:
+                position = await self.log_position(household)
+            data = await self.cached(
+                household, purchases_cache_name(request.host_url, page,
+                                                cursor),
+                lambda: self.purchases_obj(environ, session, household,
+                                           page, cursor))
+            if data['expenses'] and request.args.get('total'):
+                data['total'] = await self.purchase_count(household)
+            with self.request_context(environ, session):
+                if data['expenses']:
+                    if first:
+                        data['links']['feed'] = feed_url(position)
+                    response = jsonify(data)
+                    response.set_etag(etag)
+                else:
+                    response = jsonify({'msg': invalid_position(cursor)})
+                    response.status_code = 404
+        await self.save_session(session, response)
+        return response
+
+    async def expense_stream(self, environ, receive, send):
+        request = self.app.request_class(environ)
+        session = await self.open_session(request)
+        household = await self.current_household(session)
+        if household is None:
+            response = await self.login_redirect(environ, session)
+            return await send_response(send, response, environ)
+
+        with self.request_context(environ, session):
+            try:
+                since = feed_position()
+                response = feed_response(iter(()))
+            except ValueError as e:
+                response = jsonify({'msg': str(e)})
+                response.status_code = 400
+        await self.save_session(session, response)
+        if response.status_code != 200:
+            return await send_response(send, response, environ)
+        await send_response(send, response, environ, more_body=True)
+        await self.stream_feed(household, since, receive, send)
+
+    async def stream_feed(self, household, since, receive, send):
+        """Send feed messages until the timeout, like the Flask view."""
+        async def write(text):
+            await send({'type': 'http.response.body',
+                        'body': text.encode(), 'more_body': True})
+
+        loop = asyncio.get_event_loop()
+        config = self.app.config
+        event = self.feed.subscribe(self.redis, household)
+        disconnected = asyncio.ensure_future(wait_disconnect(receive))
+        try:
+            await write('retry: {0}\n\n'.format(FEED_RETRY))
+            deadline = loop.time() + config['FEED_TIMEOUT']
+            woken = True
+            while True:
+                if woken:
+                    event.clear()
+                    pipe = self.redis.pipeline()
+                    queue_read_log(pipe, household, since)
+                    position, ids = logged_since(await pipe.execute(), since)
+                    if feed_reloads(position, ids):
+                        await write(FEED_RELOAD)
+                        break
+                    purchases = ids and await self.database.fetch_all(
+                        self.statement(new_purchases_query, household, ids))
+                    if purchases:
+                        users = await self.cached(
+                            household, 'user-totals',
+                            lambda: self.user_totals(household))
+                        await write(feed_message(purchases, users, position))
+                    since = position
+                else:
+                    await write(': keepalive\n\n')
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                wake = asyncio.ensure_future(event.wait())
+                done, _ = await asyncio.wait(
+                    [wake, disconnected],
+                    timeout=min(config['FEED_KEEPALIVE'], remaining),
+                    return_when=asyncio.FIRST_COMPLETED)
+                wake.cancel()
+                if disconnected in done:
+                    return
+                woken = wake in done
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnected.cancel()
+            self.feed.unsubscribe(household, event)
+
+
+def create_asgi_app(config=None):
+    """Return the ASGI application, around an app from create_app.
+
+    It takes the same config, and ASYNC_DATABASE_URL if the async driver
+    needs a different URL to SQLALCHEMY_DATABASE_URI, which is the
+    default, along with any ASYNC_DATABASE_OPTIONS for the driver.
+    ASGI_THREADS is how many threads serve the Flask app's requests.
+    """
+    app = create_app(config)
+    app.config.setdefault('ASGI_THREADS', 8)
+    app.config.setdefault('ASYNC_DATABASE_URL',
+                          app.config['SQLALCHEMY_DATABASE_URI'])
+    app.config.setdefault('ASYNC_DATABASE_OPTIONS', {})
+    pool = BlockingConnectionPool.from_url(
+        app.config['REDIS_URL'],
+        max_connections=app.config['REDIS_MAX_CONNECTIONS'],
+        timeout=app.config['REDIS_POOL_TIMEOUT'],
+        socket_timeout=app.config['REDIS_SOCKET_TIMEOUT'],
+        socket_connect_timeout=app.config['REDIS_CONNECT_TIMEOUT'],
+        health_check_interval=app.config['REDIS_HEALTH_CHECK'])
+    database = Database(app.config['ASYNC_DATABASE_URL'],
+                        **app.config['ASYNC_DATABASE_OPTIONS'])
+    return AsyncExpenses(app, Redis(connection_pool=pool), database,
+                         app.config['ASGI_THREADS'])
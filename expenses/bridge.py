@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""Serve a WSGI app over ASGI, from a pool of threads.
+
+This only needs the standard library and werkzeug, on Python 3.6 or
+later, so the Flask app can be run under an ASGI server without the
+'asgi' extra that expenses.asgi needs.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+import asyncio
+
+
+def request_environ(scope):
+    """Return a WSGI environ for an HTTP request, without its body."""
+    headers = [(k.decode('latin-1'), v.decode('latin-1'))
+               for k, v in scope['headers']]
+    host = dict(headers).get('host')
+    if host is None and scope.get('server'):
+        host = '{0}:{1}'.format(*scope['server'])
+    overrides = {}
+    if scope.get('client'):
+        overrides['REMOTE_ADDR'] = scope['client'][0]
+    environ = EnvironBuilder(
+        path=scope['path'],
+        base_url='{0}://{1}{2}'.format(scope.get('scheme', 'http'),
+                                       host or 'localhost',
+                                       scope.get('root_path', '')),
+        query_string=scope['query_string'].decode('latin-1'),
+        method=scope['method'],
+        headers=[(k, v) for k, v in headers if k.lower() != 'host'],
+        environ_overrides=overrides,
+    ).get_environ()
+    # The builder measures the body it's given, and it's given none
+    environ.pop('HTTP_CONTENT_LENGTH', None)
+    environ.pop('CONTENT_LENGTH', None)
+    length = dict(headers).get('content-length')
+    if length is not None:
+        environ['CONTENT_LENGTH'] = length
+    return environ
+
+
+async def send_response(send, response, environ, more_body=False):
+    """Send a werkzeug response over ASGI, as it would be over WSGI.
+
+    With more_body, the body can go on after the response's own.
+    """
+    headers = response.get_wsgi_headers(environ)
+    await send({
+        'type': 'http.response.start',
+        'status': response.status_code,
+        'headers': [(k.lower().encode('latin-1'), v.encode('latin-1'))
+                    for k, v in headers.items()],
+    })
+    await send({'type': 'http.response.body',
+                'body': b''.join(response.get_app_iter(environ)),
+                'more_body': more_body})
+
+
+async def wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+class RequestBody(object):
+
+    """An ASGI request's body, as the wsgi.input of a thread serving it.
+
+    Reads wait for the event loop to receive more of the body, so it's
+    never held in memory beyond what the app has asked for. Like any
+    wsgi.input, it's only read up to the request's Content-Length.
+    """
+
+    def __init__(self, receive, loop):
+        self.receive = receive
+        self.loop = loop
+        self.buffer = b''
+        self.more_body = True
+
+    def fill(self):
+        async def receive():
+            # receive need only return an awaitable, not a coroutine
+            return await self.receive()
+
+        message = asyncio.run_coroutine_threadsafe(receive(),
+                                                   self.loop).result()
+        if message['type'] == 'http.disconnect':
+            self.more_body = False
+        else:
+            self.buffer += message.get('body', b'')
+            self.more_body = message.get('more_body', False)
+
+    def take(self, end):
+        chunk, self.buffer = self.buffer[:end], self.buffer[end:]
+        return chunk
+
+    def read(self, size=-1):
+        while self.more_body and (size < 0 or len(self.buffer) < size):
+            self.fill()
+        return self.take(len(self.buffer) if size < 0 else size)
+
+    def readline(self, size=-1):
+        while self.more_body and b'\n' not in self.buffer and \
+                (size < 0 or len(self.buffer) < size):
+            self.fill()
+        end = self.buffer.find(b'\n') + 1 or len(self.buffer)
+        return self.take(end if size < 0 else min(end, size))
+
+
+class ThreadedWSGI(object):
+
+    """Serve a WSGI app over ASGI, from a pool of threads.
+
+    Each request holds a thread until its response is sent, so at most
+    threads requests are handled at once, as in a threaded WSGI server.
+    The request body is streamed to the app as it reads it, and the
+    response is streamed as the app produces it.
+    """
+
+    def __init__(self, app, threads=8):
+        self.app = app
+        self.executor = ThreadPoolExecutor(threads)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            raise ValueError('Only HTTP requests can go to a WSGI app')
+        loop = asyncio.get_event_loop()
+        environ = request_environ(scope)
+        environ['wsgi.input'] = RequestBody(receive, loop)
+        await loop.run_in_executor(self.executor, self.run, environ, loop,
+                                   send)
+
+    def run(self, environ, loop, send):
+        async def forward(message):
+            await send(message)
+
+        def send_soon(message):
+            asyncio.run_coroutine_threadsafe(forward(message), loop).result()
+
+        app_iter, status, headers = run_wsgi_app(self.app, environ)
+        try:
+            send_soon({
+                'type': 'http.response.start',
+                'status': int(status.split(None, 1)[0]),
+                'headers': [(k.lower().encode('latin-1'),
+                             v.encode('latin-1'))
+                            for k, v in headers.items()],
+            })
+            for chunk in app_iter:
+                if chunk:
+                    send_soon({'type': 'http.response.body', 'body': chunk,
+                               'more_body': True})
+            send_soon({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
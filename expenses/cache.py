@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""Redis-backed caches of derived data."""
+
+from flask import current_app
+from json import dumps, loads
+from .model import Purchase
+import time
+
+
+COUNT_TTL = 60 * 60
+
+
+def count_key(household):
+    return 'purchases:count:{0}'.format(household)
+
+
+def purchase_count(household):
+    """Return the approximate number of purchases in a household.
+
+    The count lives in redis and is bumped as purchases are added, so
+    reading it doesn't scan the table. It expires every so often, which
+    corrects any drift from writes that didn't go through the app.
+    """
+    redis = current_app.redis
+    key = count_key(household)
+    count = redis.get(key)
+    if count is None:
+        count = Purchase.query.filter_by(household_id=household).count()
+        redis.set(key, count, ex=COUNT_TTL, nx=True)
+    return int(count)
+
+
+def incr_purchase_count(household, n=1):
+    """Add n newly committed purchases to a household's cached count.
+
+    Only a count that's cached already is bumped. Incrementing a missing
+    key would create a count of just the new purchases, which readers
+    could see until it was deleted again.
+    """
+    key = count_key(household)
+
+    def incr(pipe):
+        if pipe.exists(key):
+            pipe.multi()
+            pipe.incrby(key, n)
+            pipe.ttl(key)
+
+    # Retried if the count changes in between. Before redis 6.0.9 the
+    # count expiring in between doesn't, and leaves one with no TTL
+    results = current_app.redis.transaction(incr, key)
+    if results and results[1] < 0:
+        current_app.redis.delete(key)
+
+
+class ResponseCache(object):
+
+    """Cache JSON-able values in redis until the next write.
+
+    Entries belong to a household, and are stored along with the write
+    generation of that household they were computed for. Writes bump the
+    generation, which makes every older entry stale without having to
+    find and delete them, and leaves other households' entries alone. A
+    lookup reads the generation and the entry in one round trip.
+    """
+
+    stats_key = 'cache:stats'
+
+    def __init__(self):
+        # Counted locally, and flushed to redis along with the next miss
+        self.hits = 0
+        self.misses = 0
+
+    def redis_key(self, household, name):
+        return 'cache:{0}:{1}'.format(household, name)
+
+    def keys(self, household, name):
+        """Return the redis keys of a household's generation and entry."""
+        return (self.redis_key(household, 'generation'),
+                self.redis_key(household, name))
+
+    def lookup(self, generation, data):
+        """Return the generation, and the value if the entry is fresh.
+
+        generation and data are what redis has under keys(), and the
+        value is None for a miss.
+        """
+        generation = int(generation or 0)
+        if data is not None:
+            entry = loads(data.decode())
+            if entry['generation'] == generation:
+                self.hits += 1
+                return generation, entry['value']
+        self.misses += 1
+        return generation, None
+
+    def queue_store(self, pipe, key, generation, value, ttl):
+        """Queue storing a value computed after a miss on a pipeline."""
+        entry = {'generation': generation, 'value': value}
+        pipe.set(key, dumps(entry, separators=(',', ':')), ex=ttl)
+        pipe.hincrby(self.stats_key, 'hits', self.hits)
+        pipe.hincrby(self.stats_key, 'misses', self.misses)
+        self.hits = self.misses = 0
+
+    def get_or_set(self, household, name, fn):
+        """Return the cached value for name, or cache the result of fn."""
+        ttl = current_app.config.get('CACHE_TTL', 60)
+        if not ttl:
+            return fn()
+        redis = current_app.redis
+        keys = self.keys(household, name)
+        generation, value = self.lookup(*redis.mget(*keys))
+        if value is not None:
+            return value
+
+        value = fn()
+        pipe = redis.pipeline(transaction=False)
+        self.queue_store(pipe, keys[1], generation, value, ttl)
+        pipe.execute()
+        return value
+
+    def generation(self, household):
+        """Return a household's generation, which every write changes."""
+        return int(current_app.redis.get(
+            self.redis_key(household, 'generation')) or 0)
+
+    def invalidate(self, household):
+        """Make every cached entry for a household stale."""
+        key = self.redis_key(household, 'generation')
+        pipe = current_app.redis.pipeline(transaction=False)
+        # The first write counts up from the time rather than 0, so no
+        # generation comes round again if redis loses them, as validators
+        # made from one rely on
+        pipe.set(key, int(time.time() * 1000), nx=True)
+        pipe.incr(key)
+        pipe.execute()
+
+    def stats(self):
+        """Return the hit and miss counts recorded in redis."""
+        stats = current_app.redis.hgetall(self.stats_key)
+        return dict((k, int(stats.get(k.encode(), 0)))
+                    for k in ('hits', 'misses'))
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""Command line maintenance tasks."""
+
+from flask import current_app
+from flask.cli import AppGroup, with_appcontext
+from .cache import response_cache
+from .importer import MalformedFile, formats, guess_format, import_expenses
+from .migrations import upgrade, schema_version, migrations
+from .model import db, User
+from .rollups import rollups_drift, rebuild_rollups
+from .search import rebuild_index
+from .templating import precompile_templates
+from .totals import totals_drift, rebuild_totals
+from .util import price_filter
+import click
+
+
+db_group = AppGroup('db', help='Manage the database schema.')
+totals_group = AppGroup('totals', help='Maintain per-user purchase totals.')
+rollups_group = AppGroup('rollups',
+                         help='Maintain monthly and weekly spending rollups.')
+templates_group = AppGroup('templates', help='Manage compiled templates.')
+search_group = AppGroup('search', help='Maintain the purchase search index.')
+
+
+@db_group.command('upgrade')
+def upgrade_command():
+    """Create the database, or apply pending migrations."""
+    applied = upgrade()
+    for name in applied:
+        click.echo('Applied {0}'.format(name))
+    click.echo('Schema is at version {0}'.format(len(migrations)))
+
+
+@db_group.command('version')
+def version_command():
+    """Show the current schema version."""
+    with db.engine.connect() as conn:
+        version = schema_version(conn)
+    if version is None:
+        click.echo('No schema')
+    else:
+        click.echo('Schema is at version {0} of {1}'.format(
+            version, len(migrations)))
+
+
+def invalidate(households):
+    """Make the cached responses of the households stale."""
+    for household in set(households):
+        response_cache.invalidate(household)
+
+
+def format_totals(totals):
+    if totals is None:
+        return 'missing'
+    return '{0} paid, {1} owed'.format(*map(price_filter, totals))
+
+
+def echo_drift(drift):
+    for user_id, (stored, actual) in sorted(drift.items()):
+        click.echo('User {0}: stored {1}; actual {2}'.format(
+            user_id, format_totals(stored), format_totals(actual)))
+
+
+@totals_group.command('verify')
+def verify_command():
+    """Compare stored totals against the purchase table."""
+    drift = totals_drift()
+    echo_drift(drift)
+    if drift:
+        raise click.ClickException('{0} totals have drifted'.format(
+            len(drift)))
+    click.echo('All totals are correct')
+
+
+@totals_group.command('rebuild')
+def rebuild_command():
+    """Recompute stored totals from the purchase table."""
+    drift = rebuild_totals()
+    invalidate(household for user_id, household
+               in db.session.query(User.id, User.household_id)
+               if user_id in drift)
+    echo_drift(drift)
+    click.echo('Rebuilt totals, fixing {0}'.format(len(drift)))
+
+
+def echo_rollup_drift(drift):
+    for (user_id, period, start), (stored, actual) in sorted(drift.items()):
+        click.echo('User {0}, {1} of {2}: stored {3}; actual {4}'.format(
+            user_id, period, start,
+            price_filter(stored[1]) if stored else 'missing',
+            price_filter(actual[1]) if actual else 'nothing'))
+
+
+@rollups_group.command('verify')
+def verify_rollups_command():
+    """Compare stored rollups against the purchase table."""
+    drift = rollups_drift()
+    echo_rollup_drift(drift)
+    if drift:
+        raise click.ClickException('{0} rollups have drifted'.format(
+            len(drift)))
+    click.echo('All rollups are correct')
+
+
+@rollups_group.command('rebuild')
+def rebuild_rollups_command():
+    """Backfill the rollups from the purchase table."""
+    drift = rebuild_rollups()
+    invalidate(rollup[0] for pair in drift.values()
+               for rollup in pair if rollup)
+    echo_rollup_drift(drift)
+    click.echo('Rebuilt rollups, fixing {0}'.format(len(drift)))
+
+
+@templates_group.command('compile')
+def compile_command():
+    """Compile every template into the bytecode cache."""
+    if current_app.jinja_env.bytecode_cache is None:
+        raise click.ClickException('Set TEMPLATE_CACHE to keep compiled '
+                                   'templates')
+    count = precompile_templates(current_app)
+    click.echo('Compiled {0} templates'.format(count))
+
+
+@search_group.command('rebuild')
+def rebuild_search_command():
+    """Index every purchase for search from scratch."""
+    count = rebuild_index()
+    click.echo('Indexed {0} purchases'.format(count))
+
+
+@click.command('import-expenses')
+@click.argument('path', type=click.File('rb'))
+@click.option('--user', 'username', required=True,
+              help='Username to record the expenses under.')
+@click.option('--format', 'fmt', type=click.Choice(formats),
+              help='File format, if not clear from the file name.')
+@with_appcontext
+def import_command(path, username, fmt):
+    """Import expenses from a CSV or JSON file.
+
+    Each row needs a name, a price in dollars, and a MM/DD/YYYY date.
+    """
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException('No such user: {0}'.format(username))
+    fmt = fmt or guess_format(path.name)
+    if fmt is None:
+        raise click.ClickException('Unknown format, use --format')
+    try:
+        summary = import_expenses(path, fmt, user.id)
+    except MalformedFile as e:
+        raise click.ClickException('Could not read the file: {0}'.format(e))
+    for error in summary['errors']:
+        click.echo('Row {0}: {1}'.format(error['row'],
+                                         ', '.join(error['errors'])))
+    if summary['failed'] > len(summary['errors']):
+        click.echo('...')
+    click.echo('Imported {0} expenses, skipped {1}'.format(
+        summary['imported'], summary['failed']))
+
+
+def register_commands(app):
+    """Register the maintenance commands on an app."""
+    app.cli.add_command(db_group)
+    app.cli.add_command(totals_group)
+    app.cli.add_command(rollups_group)
+    app.cli.add_command(templates_group)
+    app.cli.add_command(search_group)
+    app.cli.add_command(import_command)
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""A live feed of each household's new purchases.
+
+Ids aren't committed in the order they're handed out, so a stream can't
+just pick up from the newest id it's seen. Instead each commit appends
+its purchases' ids to a log in redis, at the household's next position,
+and streams resume from a position. The log keeps the last LOG_COMMITS
+commits; a stream from before them, or from before redis lost the log,
+has the browser reload the page instead.
+"""
+
+from collections import defaultdict
+from flask import current_app
+import threading
+import time
+
+
+LOG_COMMITS = 1000
+
+
+def feed_channel(household):
+    return 'feed:{0}'.format(household)
+
+
+def position_key(household):
+    return 'feed:{0}:position'.format(household)
+
+
+def log_key(household):
+    return 'feed:{0}:log'.format(household)
+
+
+def publish_purchases(household, ids):
+    """Log a household's newly committed purchases, and wake its streams.
+
+    ids are those of the purchases, and may include ones logged already.
+    """
+    key = position_key(household)
+    log = log_key(household)
+
+    def append(pipe):
+        position, start, trimmed = pipe.hmget(key, 'position', 'start',
+                                              'trimmed')
+        if position is None:
+            # Counted from the time, so positions from before redis lost
+            # the log are all before its start
+            position = start = int(time.time() * 1000)
+            trimmed = 0
+        else:
+            position, start, trimmed = \
+                int(position) + 1, int(start), int(trimmed)
+        pipe.multi()
+        if ids:
+            pipe.zadd(log, dict((i, position) for i in ids), nx=True)
+        if position - LOG_COMMITS >= start:
+            trimmed = position - LOG_COMMITS
+            pipe.zremrangebyscore(log, '-inf', trimmed)
+        pipe.hset(key, mapping={'position': position, 'start': start,
+                                'trimmed': trimmed})
+        pipe.publish(feed_channel(household), position)
+
+    current_app.redis.transaction(append, key)
+
+
+def log_position(household):
+    """Return a household's feed position, to stream from once it's shown.
+
+    Read it before the purchases shown, so any committed in between are
+    streamed too, even if some of them get shown twice.
+    """
+    return int(current_app.redis.hget(position_key(household),
+                                      'position') or 0)
+
+
+def queue_read_log(pipe, household, since):
+    """Queue reading the ids logged after position since, on a pipeline.
+
+    The pipeline needs to be a transaction, for logged_since to read a
+    position that goes with the ids.
+    """
+    pipe.hmget(position_key(household), 'position', 'start', 'trimmed')
+    pipe.zrangebyscore(log_key(household), '({0}'.format(since), '+inf')
+
+
+def logged_since(results, since):
+    """Return the feed's position, and the ids logged after since.
+
+    results are those of queue_read_log's commands. The position is None
+    if the log doesn't go back to since, and the browser should reload.
+    """
+    (position, start, trimmed), ids = results[-2:]
+    if position is None:
+        # Nothing's been logged, which a stream can only have seen as 0
+        return (0, []) if since == 0 else (None, [])
+    position, start, trimmed = int(position), int(start), int(trimmed)
+    # Position 0 is from before anything was logged
+    if since == 0 and trimmed == 0 or \
+            start <= since <= position and since >= trimmed:
+        return position, sorted(int(i) for i in ids)
+    return None, []
+
+
+class Feed(object):
+
+    """Wake a process's open streams when their household has news.
+
+    Committing purchases publishes to the household's channel. Rather
+    than each stream holding one of the pool's connections to subscribe
+    with, a single thread listens to every household's channel, and sets
+    the events of the streams waiting on that one.
+    """
+
+    pattern = feed_channel('*')
+
+    def __init__(self):
+        self.waiters = defaultdict(set)
+        self.lock = threading.Lock()
+        self.listener = None
+
+    def on_message(self, message):
+        household = message['channel'].decode().partition(':')[2]
+        with self.lock:
+            waiters = list(self.waiters.get(household, ()))
+        for event in waiters:
+            event.set()
+
+    def listen(self, redis):
+        """Make sure a thread is listening for new purchases."""
+        if self.listener is not None and self.listener.is_alive():
+            return
+        with self.lock:
+            if self.listener is None or not self.listener.is_alive():
+                pubsub = redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(**{self.pattern: self.on_message})
+                self.listener = pubsub.run_in_thread(sleep_time=1,
+                                                     daemon=True)
+
+    def subscribe(self, redis, household):
+        """Return an event that's set when a household has new purchases.
+
+        The caller clears it before looking for them, and should pass it
+        to unsubscribe once it's done waiting.
+        """
+        self.listen(redis)
+        event = threading.Event()
+        with self.lock:
+            self.waiters[str(household)].add(event)
+        return event
+
+    def unsubscribe(self, household, event):
+        with self.lock:
+            waiters = self.waiters.get(str(household))
+            if waiters is not None:
+                waiters.discard(event)
+                if not waiters:
+                    del self.waiters[str(household)]
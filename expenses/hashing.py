@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""Password hashing on a bounded pool of threads."""
+
+from bcrypt import gensalt, hashpw
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import safe_str_cmp
+from .metrics import timed
+import threading
+
+
+class HasherBusy(Exception):
+
+    """Too many hashes are already running or queued."""
+
+
+def hash_rounds(pw_hash):
+    """Return the cost factor of a bcrypt hash."""
+    return int(pw_hash.split('$')[2])
+
+
+class Hasher(object):
+
+    """Run bcrypt on a pool of threads, turning work away when it's full.
+
+    bcrypt releases the GIL while it works, so a few threads can keep
+    the cores busy. At most max_pending hashes may be running or queued
+    at once; beyond that, callers get HasherBusy straight away instead
+    of holding their request while they wait in line.
+    """
+
+    def __init__(self, rounds=12, workers=4, max_pending=16):
+        self.rounds = rounds
+        self.executor = ThreadPoolExecutor(workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+
+    def run(self, fn, *args):
+        """Run fn on the pool and return its result."""
+        if not self.slots.acquire(False):
+            raise HasherBusy()
+        try:
+            future = self.executor.submit(fn, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda future: self.slots.release())
+        with timed('bcrypt'):
+            return future.result()
+
+    def hash(self, password):
+        """Return a new hash of password at the configured cost."""
+        salt = gensalt(self.rounds)
+        return self.run(hashpw, password.encode(), salt).decode()
+
+    def check(self, password, pw_hash):
+        """Return whether password matches pw_hash."""
+        result = self.run(hashpw, password.encode(), pw_hash.encode())
+        return safe_str_cmp(result.decode(), pw_hash)
+
+    def needs_rehash(self, pw_hash):
+        """Return whether pw_hash was made at a different cost."""
+        return hash_rounds(pw_hash) != self.rounds
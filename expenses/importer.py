@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""Bulk import of expenses from CSV or JSON files."""
+
+from itertools import chain
+from json import JSONDecoder
+from .ledger import add_purchases, purchases_committed
+from .model import db, User
+from .util import PY2, decode_csv_cell, parse_expense
+import codecs
+import csv
+
+
+BATCH_SIZE = 1000
+MAX_ERRORS = 100
+
+formats = ('csv', 'json')
+
+
+class MalformedFile(ValueError):
+
+    """The file couldn't be parsed at all."""
+
+
+def guess_format(filename):
+    """Return the import format implied by a file name, or None."""
+    extension = filename.rsplit('.', 1)[-1].lower() if filename else ''
+    if extension == 'csv':
+        return 'csv'
+    elif extension in ('json', 'jsonl', 'ndjson'):
+        return 'json'
+    return None
+
+
+def iter_json(text, chunk_size=64 * 1024):
+    """Yield the values of a JSON array, or of newline-delimited JSON.
+
+    The file is decoded a chunk at a time, so it's never held in memory
+    all at once.
+    """
+    decoder = JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+    in_array = None
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n':
+            pos += 1
+        if pos < len(buf) and in_array is None:
+            in_array = buf[pos] == '['
+            pos += in_array
+            continue
+        if pos < len(buf) and in_array and buf[pos] in ',]':
+            if buf[pos] == ']':
+                return
+            pos += 1
+            continue
+
+        end = None
+        if pos < len(buf):
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                pass
+        if end is None or (end == len(buf) and not eof):
+            # Out of data, or the value might go on into the next chunk
+            if eof:
+                if pos < len(buf):
+                    raise MalformedFile('Invalid JSON')
+                elif in_array:
+                    raise MalformedFile('Unterminated JSON array')
+                return
+            more = text.read(chunk_size)
+            buf, pos, eof = buf[pos:] + more, 0, not more
+            continue
+        pos = end
+        yield value
+
+
+def iter_csv_bytes(stream):
+    """Yield the rows of a UTF-8 CSV file, with Python 2's csv module.
+
+    It only reads bytes, so the rows are decoded once they're split up.
+    """
+    lines = iter(stream)
+    first = next(lines, b'')
+    if first.startswith(codecs.BOM_UTF8):
+        first = first[len(codecs.BOM_UTF8):]
+    for row in csv.DictReader(chain([first], lines)):
+        yield dict((decode_csv_cell(k), decode_csv_cell(v))
+                   for k, v in row.items())
+
+
+def iter_rows(stream, fmt):
+    """Yield the rows of an uploaded file, as parsed values."""
+    if fmt == 'csv' and PY2:
+        return iter_csv_bytes(stream)
+    text = codecs.getreader('utf-8-sig')(stream)
+    if fmt == 'csv':
+        return csv.DictReader(text)
+    elif fmt == 'json':
+        return iter_json(text)
+    raise MalformedFile('Unknown format: {0}'.format(fmt))
+
+
+def import_expenses(stream, fmt, user_id, batch_size=BATCH_SIZE,
+                    max_errors=MAX_ERRORS):
+    """Import expenses for a user from a CSV or JSON file.
+
+    Rows need a name, price and date, with the same rules as adding one
+    expense by hand. Valid rows are inserted in batches, all in one
+    transaction; invalid ones are skipped and reported, up to max_errors
+    of them. Return a summary of the import.
+    """
+    household = db.session.query(User.household_id) \
+        .filter_by(id=user_id).scalar()
+    imported = 0
+    ids = []
+    failed = 0
+    errors = []
+    batch = []
+    try:
+        for row_number, row in enumerate(iter_rows(stream, fmt), 1):
+            if isinstance(row, dict):
+                values, row_errors = parse_expense(row.get('name'),
+                                                   row.get('price'),
+                                                   row.get('date'))
+            else:
+                row_errors = ['Expected an object']
+            if row_errors:
+                failed += 1
+                if len(errors) < max_errors:
+                    errors.append({'row': row_number, 'errors': row_errors})
+                continue
+
+            values['user_id'] = user_id
+            values['household_id'] = household
+            batch.append(values)
+            if len(batch) >= batch_size:
+                ids.extend(add_purchases(batch))
+                imported += len(batch)
+                batch = []
+        ids.extend(add_purchases(batch))
+        imported += len(batch)
+    except (MalformedFile, UnicodeError, csv.Error) as e:
+        db.session.rollback()
+        raise MalformedFile(str(e))
+    db.session.commit()
+    purchases_committed(household, imported, ids)
+    return {'imported': imported, 'failed': failed, 'errors': errors}
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""Recording purchases, and everything derived from them."""
+
+from collections import defaultdict
+from sqlalchemy import func
+from .cache import incr_purchase_count, response_cache
+from .feed import publish_purchases
+from .model import db, Purchase, PurchaseShare
+from .rollups import add_to_rollups
+from .search import index_purchases, search_backend
+from .totals import add_to_total
+
+
+def split_cost(cost, shares):
+    """Split a cost in proportion to weights, in whole cents.
+
+    shares is a list of (user id, weight) pairs. Return a list of (user
+    id, amount) pairs that add up to the cost exactly; the cents left
+    over from rounding down go to the largest remainders.
+    """
+    total_weight = sum(weight for _, weight in shares)
+    amounts = [cost * weight // total_weight for _, weight in shares]
+    remainders = sorted(range(len(shares)), key=lambda i: (
+        -(cost * shares[i][1] % total_weight), i))
+    for i in remainders[:cost - sum(amounts)]:
+        amounts[i] += 1
+    return [(user_id, amount)
+            for (user_id, _), amount in zip(shares, amounts)]
+
+
+def add_purchases(rows):
+    """Insert purchases as part of the current transaction.
+
+    rows is a list of dicts of purchase columns, including the buyer's
+    household_id. A row may also have a list of (user id, weight) pairs
+    under 'shares', to split it between just those people; otherwise it's
+    split equally between everyone in the household. Rows without shares
+    are inserted with a single executemany, and each user's totals and
+    spending rollups are updated once.
+
+    Return the ids of the new purchases. Those of rows inserted together
+    can't be told apart from any committed alongside them, so the ids
+    may include some of the households' other purchases too.
+    """
+    paid = defaultdict(int)
+    owed = defaultdict(int)
+    plain = []
+    ids = []
+    for row in rows:
+        paid[row['user_id']] += row['cost']
+        if not row.get('shares'):
+            plain.append(row)
+            continue
+
+        values = dict((k, v) for k, v in row.items() if k != 'shares')
+        result = db.session.execute(Purchase.__table__.insert(), values)
+        purchase_id = result.inserted_primary_key[0]
+        ids.append(purchase_id)
+        weights = dict(row['shares'])
+        amounts = split_cost(row['cost'], row['shares'])
+        db.session.execute(PurchaseShare.__table__.insert(), [{
+            'purchase_id': purchase_id,
+            'user_id': user_id,
+            'weight': weights[user_id],
+            'amount': amount,
+        } for user_id, amount in amounts])
+        for user_id, amount in amounts:
+            owed[user_id] += amount
+
+    if plain:
+        # Every id they're given is past the newest one there is so far
+        newest = db.session.query(func.max(Purchase.id)).scalar() or 0
+        db.session.execute(Purchase.__table__.insert(), plain)
+        households = set(row['household_id'] for row in plain)
+        ids.extend(purchase_id for purchase_id, in
+                   db.session.query(Purchase.id)
+                   .filter(Purchase.household_id.in_(households),
+                           Purchase.id > newest)
+                   .order_by(Purchase.id))
+    for user_id in set(paid) | set(owed):
+        add_to_total(user_id, paid.get(user_id, 0), owed.get(user_id, 0))
+    add_to_rollups(rows)
+    return ids
+
+
+def keyed_purchase_ids(user_id, keys):
+    """Return the ids of a user's purchases with any of the client keys."""
+    if not keys:
+        return {}
+    return dict(db.session.query(Purchase.client_key, Purchase.id)
+                .filter(Purchase.user_id == user_id,
+                        Purchase.client_key.in_(keys)))
+
+
+def add_keyed_purchases(user_id, rows):
+    """Insert a user's purchases, skipping any that were already added.
+
+    rows are as for add_purchases, each with a different client_key. A
+    row whose key the user already has a purchase under is left out, so
+    sending the same rows again doesn't add them twice. Return the rows
+    that were new, and a dict of every row's key to its purchase id.
+    """
+    ids = keyed_purchase_ids(user_id, [row['client_key'] for row in rows])
+    new = [row for row in rows if row['client_key'] not in ids]
+    add_purchases(new)
+    ids.update(keyed_purchase_ids(user_id,
+                                  [row['client_key'] for row in new]))
+    return new, ids
+
+
+def purchases_committed(household, count, ids):
+    """Update a household's redis caches once its purchases are committed.
+
+    count is how many purchases were added, and ids those add_purchases
+    returned for them.
+    """
+    if count:
+        incr_purchase_count(household, count)
+        response_cache.invalidate(household)
+        if search_backend() == 'redis':
+            index_purchases(household, ids)
+        # Last, so streams woken by it find everything else up to date
+        publish_purchases(household, ids)
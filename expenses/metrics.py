@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""Opt-in request timing, exposed to Prometheus and Server-Timing.
+
+With METRICS turned on, each request adds up the time spent in SQL,
+session redis commands, bcrypt and template rendering. Those go out in
+a Server-Timing header, and into per-endpoint totals and a latency
+histogram, served in the Prometheus text format from /metrics. Totals
+are kept per process, so each worker reports its own, as does
+/stats/redis for the worker's redis pool.
+"""
+
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from flask import current_app, g, has_request_context, jsonify, request, \
+                  Response, signals_available, before_render_template, \
+                  template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from timeit import default_timer as timer
+from .cache import response_cache
+import threading
+
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Each stage of a request, and what it counts
+STAGES = (
+    ('sql', 'statements'),
+    ('redis', 'commands'),
+    ('bcrypt', 'hashes'),
+    ('render', 'templates'),
+)
+
+
+def record(stage, seconds, count=1):
+    """Add time to a stage of the current request, if it's measured."""
+    if has_request_context():
+        timings = g.get('timings')
+        if timings is not None:
+            timings[stage][0] += seconds
+            timings[stage][1] += count
+
+
+@contextmanager
+def timed(stage, count=1):
+    """Record the time spent in the block towards a stage."""
+    start = timer()
+    try:
+        yield
+    finally:
+        record(stage, timer() - start, count)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # The last count is for values beyond every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Return (upper bound, count) pairs, ending with +Inf."""
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield bound, total
+
+
+class Metrics(object):
+
+    """Request metrics for one process."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.lock = threading.Lock()
+        self.latency = defaultdict(lambda: Histogram(buckets))
+        # (endpoint, stage) -> [seconds, count]
+        self.stages = defaultdict(lambda: [0.0, 0])
+
+    def observe(self, endpoint, seconds, timings):
+        with self.lock:
+            self.latency[endpoint].observe(seconds)
+            for stage, (stage_seconds, count) in timings.items():
+                totals = self.stages[endpoint, stage]
+                totals[0] += stage_seconds
+                totals[1] += count
+
+    def exposition(self, extra=()):
+        """Return the metrics in the Prometheus text format.
+
+        extra is a list of (name, type, help, labels, value) samples from
+        outside the request metrics.
+        """
+        lines = []
+        families = set()
+
+        def family(name, kind, help):
+            families.add(name)
+            lines.append('# HELP {0} {1}'.format(name, help))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+
+        def sample(name, labels, value):
+            label_text = ','.join('{0}="{1}"'.format(k, v)
+                                  for k, v in sorted(labels.items()))
+            lines.append('{0}{{{1}}} {2}'.format(name, label_text, value))
+
+        with self.lock:
+            name = 'expenses_request_duration_seconds'
+            family(name, 'histogram', 'Request latency by endpoint.')
+            for endpoint, histogram in sorted(self.latency.items()):
+                for bound, count in histogram.cumulative():
+                    sample(name + '_bucket',
+                           {'endpoint': endpoint, 'le': bound}, count)
+                sample(name + '_sum', {'endpoint': endpoint},
+                       repr(histogram.sum))
+                sample(name + '_count', {'endpoint': endpoint},
+                       sum(histogram.counts))
+
+            for stage, unit in STAGES:
+                totals = sorted((endpoint, value) for (endpoint, s), value
+                                in self.stages.items() if s == stage)
+                name = 'expenses_{0}_{1}_total'.format(stage, unit)
+                family(name, 'counter',
+                       'Number of {0} {1}.'.format(stage, unit))
+                for endpoint, (_, count) in totals:
+                    sample(name, {'endpoint': endpoint}, count)
+                name = 'expenses_{0}_duration_seconds_total'.format(stage)
+                family(name, 'counter', 'Time spent in {0}.'.format(stage))
+                for endpoint, (seconds, _) in totals:
+                    sample(name, {'endpoint': endpoint}, repr(seconds))
+
+        for name, kind, help, labels, value in extra:
+            if name not in families:
+                family(name, kind, help)
+            sample(name, labels, value)
+        return '\n'.join(lines) + '\n'
+
+
+def server_timing(timings, total):
+    """Return a Server-Timing header value, with durations in ms."""
+    parts = []
+    for stage, unit in STAGES:
+        if stage in timings:
+            seconds, count = timings[stage]
+            parts.append('{0};dur={1:.2f};desc="{2} {3}"'.format(
+                stage, seconds * 1000, count, unit))
+    parts.append('total;dur={0:.2f}'.format(total * 1000))
+    return ', '.join(parts)
+
+
+def start_request():
+    g.timings = defaultdict(lambda: [0.0, 0])
+    g.request_start = timer()
+
+
+def add_server_timing(response):
+    # The session is saved after this, so only the total below counts it
+    response.headers['Server-Timing'] = server_timing(
+        g.timings, timer() - g.request_start)
+    return response
+
+
+def finish_request(exc):
+    if 'request_start' in g:
+        current_app.metrics.observe(request.endpoint or 'none',
+                                    timer() - g.request_start, g.timings)
+
+
+def before_execute(conn, cursor, statement, parameters, context,
+                   executemany):
+    conn.info['query_start'] = timer()
+
+
+def after_execute(conn, cursor, statement, parameters, context,
+                  executemany):
+    start = conn.info.pop('query_start', None)
+    if start is not None:
+        record('sql', timer() - start)
+
+
+def before_render(app, template, context):
+    g.render_start = timer()
+
+
+def after_render(app, template, context):
+    if 'render_start' in g:
+        record('render', timer() - g.pop('render_start'))
+
+
+def metrics_view():
+    stats = response_cache.stats()
+    extra = [('expenses_response_cache_total', 'counter',
+              'Response cache lookups, across every process.',
+              {'result': result}, stats[key])
+             for result, key in (('hit', 'hits'), ('miss', 'misses'))]
+    extra.extend(('expenses_redis_pool_connections', 'gauge',
+                  'Redis pool connections.', {'state': state}, count)
+                 for state, count in
+                 sorted(current_app.redis_pool.stats().items()))
+    return Response(current_app.metrics.exposition(extra),
+                    mimetype='text/plain; version=0.0.4')
+
+
+def redis_stats_view():
+    return jsonify(current_app.redis_pool.stats())
+
+
+def init_metrics(app):
+    """Measure an app's requests, and serve the results at /metrics."""
+    app.metrics = Metrics()
+    if not event.contains(Engine, 'before_cursor_execute', before_execute):
+        event.listen(Engine, 'before_cursor_execute', before_execute)
+        event.listen(Engine, 'after_cursor_execute', after_execute)
+    if signals_available:
+        # Render time needs blinker
+        before_render_template.connect(before_render, app)
+        template_rendered.connect(after_render, app)
+    app.before_request(start_request)
+    app.after_request(add_server_timing)
+    app.teardown_request(finish_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
+    app.add_url_rule('/stats/redis', 'redis_stats', redis_stats_view)
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""Schema migrations for existing databases.
+
+Each migration takes a connection inside a transaction, and brings the
+schema from one version to the next. A fresh database is created at the
+latest version directly from the models.
+"""
+
+from sqlalchemy import Column, Index, Integer, MetaData, Table, func, \
+                       inspect, select
+from .model import db, Household, Purchase, PurchaseShare, SpendRollup, \
+                   User, UserTotal
+from .rollups import computed_rollups, insert_rollups
+from .search import create_fts, drop_fts, has_fts
+from .totals import computed_paid
+from .util import random_string
+
+
+version_table = Table('schema_version', MetaData(),
+                      Column('version', Integer, nullable=False))
+
+migrations = []
+
+
+def migration(fn):
+    """Register fn as the next migration."""
+    migrations.append(fn)
+    return fn
+
+
+def index_names(conn, table):
+    return [index['name'] for index in inspect(conn).get_indexes(table)]
+
+
+def column_names(conn, table):
+    return [column['name'] for column in inspect(conn).get_columns(table)]
+
+
+def create_index(conn, index):
+    """Create an index, unless one by that name already exists."""
+    if index.name not in index_names(conn, index.table.name):
+        index.create(conn)
+
+
+def table_index(conn, table, name, *columns, **kwargs):
+    """Return an index on the table as it is now, not as it's modelled."""
+    table = Table(table, MetaData(), autoload=True, autoload_with=conn)
+    return Index(name, *[table.c[column] for column in columns], **kwargs)
+
+
+@migration
+def add_user_totals(conn):
+    UserTotal.__table__.create(conn, checkfirst=True)
+    conn.execute(UserTotal.__table__.delete())
+    totals = computed_paid(conn)
+    if totals:
+        conn.execute(UserTotal.__table__.insert(), [
+            {'user_id': user_id, 'total': total}
+            for user_id, total in totals.items()])
+
+
+@migration
+def add_purchase_indexes(conn):
+    create_index(conn, table_index(conn, 'purchase', 'ix_purchase_date_id',
+                                   'date', 'id'))
+    create_index(conn, table_index(conn, 'purchase', 'ix_purchase_user_id',
+                                   'user_id'))
+
+
+@migration
+def add_purchase_shares(conn):
+    PurchaseShare.__table__.create(conn, checkfirst=True)
+    if 'owed' not in column_names(conn, 'user_total'):
+        conn.execute('ALTER TABLE user_total '
+                     'ADD COLUMN owed INTEGER NOT NULL DEFAULT 0')
+
+
+@migration
+def add_households(conn):
+    # Everyone so far lived together, in what becomes household 1
+    Household.__table__.create(conn, checkfirst=True)
+    if conn.execute(select([func.count()]).select_from(
+            Household.__table__)).scalar() == 0:
+        conn.execute(Household.__table__.insert(), id=1, name='Home',
+                     invite_code=random_string(12))
+    for table in ('user', 'purchase'):
+        if 'household_id' not in column_names(conn, table):
+            conn.execute('ALTER TABLE "{0}" ADD COLUMN household_id '
+                         'INTEGER NOT NULL DEFAULT 1'.format(table))
+    for index in User.__table__.indexes | Purchase.__table__.indexes:
+        # Later migrations add the indexes on columns they add
+        if 'household_id' in index.columns:
+            create_index(conn, index)
+    if 'ix_purchase_date_id' in index_names(conn, 'purchase'):
+        table_index(conn, 'purchase', 'ix_purchase_date_id',
+                    'date', 'id').drop(conn)
+
+
+@migration
+def add_spend_rollups(conn):
+    SpendRollup.__table__.create(conn, checkfirst=True)
+    conn.execute(SpendRollup.__table__.delete())
+    insert_rollups(conn, computed_rollups(conn))
+
+
+@migration
+def add_purchase_search(conn):
+    # The redis index fills itself in as it's searched
+    if has_fts(conn):
+        create_fts(conn)
+
+
+@migration
+def add_purchase_client_keys(conn):
+    if 'client_key' not in column_names(conn, 'purchase'):
+        conn.execute('ALTER TABLE purchase ADD COLUMN client_key VARCHAR(64)')
+    create_index(conn, table_index(conn, 'purchase',
+                                   'ix_purchase_user_id_client_key',
+                                   'user_id', 'client_key', unique=True))
+
+
+@migration
+def add_household_search(conn):
+    # Index each purchase's household along with its name
+    if has_fts(conn):
+        drop_fts(conn)
+        create_fts(conn)
+
+
+def schema_version(conn):
+    """Return the schema version, or None for a database with no tables."""
+    if version_table.exists(conn):
+        return conn.execute(version_table.select()).scalar()
+    if inspect(conn).get_table_names():
+        # Created before migrations were tracked
+        return 0
+    return None
+
+
+def upgrade(engine=None):
+    """Apply any pending migrations, and return the versions applied."""
+    engine = engine or db.engine
+    with engine.begin() as conn:
+        version = schema_version(conn)
+        if version is None:
+            db.metadata.create_all(conn)
+            version_table.create(conn)
+            conn.execute(version_table.insert(), version=len(migrations))
+            return []
+        if not version_table.exists(conn):
+            version_table.create(conn)
+            conn.execute(version_table.insert(), version=version)
+        applied = []
+        for fn in migrations[version:]:
+            fn(conn)
+            version += 1
+            conn.execute(version_table.update(), version=version)
+            applied.append(fn.__name__)
+        return applied
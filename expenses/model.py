@@ -7,9 +7,24 @@ from flask_sqlalchemy import SQLAlchemy
 db = SQLAlchemy()
 
 
+class Household(db.Model):
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(254))
+    # Given out to let someone sign up into this household
+    invite_code = db.Column(db.String(16), unique=True)
+    users = db.relationship('User', backref='household')
+
+
 class User(db.Model):
 
+    __table_args__ = (
+        db.Index('ix_user_household_id', 'household_id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
+    household_id = db.Column(db.Integer, db.ForeignKey('household.id'),
+                             nullable=False)
     name = db.Column(db.String(254))
     username = db.Column(db.String(254), unique=True)
     password = db.Column(db.String(60))
@@ -18,8 +33,69 @@ class User(db.Model):
 
 class Purchase(db.Model):
 
+    __table_args__ = (
+        # Listing order within a household, newest first
+        db.Index('ix_purchase_household_date_id',
+                 'household_id', 'date', 'id'),
+        # The newest purchase in a household
+        db.Index('ix_purchase_household_id', 'household_id', 'id'),
+        db.Index('ix_purchase_user_id', 'user_id'),
+        # Each client key is only ever recorded once per user
+        db.Index('ix_purchase_user_id_client_key', 'user_id', 'client_key',
+                 unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
+    # Copied from the buyer, so listings don't need to join users
+    household_id = db.Column(db.Integer, db.ForeignKey('household.id'),
+                             nullable=False)
     name = db.Column(db.String(254))
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     cost = db.Column(db.Integer)
     date = db.Column(db.Date)
+    # Made up by a client adding it, which may then retry safely
+    client_key = db.Column(db.String(64))
+
+
+class PurchaseShare(db.Model):
+
+    __table_args__ = (
+        db.Index('ix_purchase_share_user_id', 'user_id'),
+    )
+
+    purchase_id = db.Column(db.Integer, db.ForeignKey('purchase.id'),
+                            primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'),
+                        primary_key=True)
+    weight = db.Column(db.Integer, nullable=False, default=1)
+    # This participant's part of the cost, in cents
+    amount = db.Column(db.Integer, nullable=False)
+
+
+class UserTotal(db.Model):
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'),
+                        primary_key=True)
+    # What the user paid, and what they owe for purchases with shares
+    total = db.Column(db.Integer, nullable=False, default=0)
+    owed = db.Column(db.Integer, nullable=False, default=0,
+                     server_default='0')
+
+
+class SpendRollup(db.Model):
+
+    __table_args__ = (
+        db.Index('ix_spend_rollup_household_period_start',
+                 'household_id', 'period', 'start'),
+    )
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'),
+                        primary_key=True)
+    # 'month' or 'week', starting on start
+    period = db.Column(db.String(8), primary_key=True)
+    start = db.Column(db.Date, primary_key=True)
+    household_id = db.Column(db.Integer, db.ForeignKey('household.id'),
+                             nullable=False)
+    # What the user paid in the period, and for how many purchases
+    total = db.Column(db.Integer, nullable=False, default=0)
+    count = db.Column(db.Integer, nullable=False, default=0)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""The redis client, and its connection pool."""
+
+from redis import BlockingConnectionPool, RedisError, StrictRedis
+import os
+import threading
+import weakref
+
+
+# Pools to reopen in forked children
+pools = weakref.WeakSet()
+
+
+class CountingConnectionPool(BlockingConnectionPool):
+
+    """A BlockingConnectionPool that counts its connections as it goes.
+
+    Counting through the public methods keeps stats from depending on how
+    redis-py stores the connections.
+    """
+
+    def reset(self):
+        self.count_lock = threading.Lock()
+        self.created = 0
+        self.lent = set()
+        super(CountingConnectionPool, self).reset()
+
+    def make_connection(self):
+        connection = super(CountingConnectionPool, self).make_connection()
+        with self.count_lock:
+            self.created += 1
+        return connection
+
+    def get_connection(self, command_name, *keys, **options):
+        connection = super(CountingConnectionPool, self).get_connection(
+            command_name, *keys, **options)
+        with self.count_lock:
+            self.lent.add(connection)
+        return connection
+
+    def release(self, connection):
+        # A connection that failed to connect is released without having
+        # been lent, and one from before a fork isn't ours to count
+        with self.count_lock:
+            self.lent.discard(connection)
+        super(CountingConnectionPool, self).release(connection)
+
+
+class RedisPool(object):
+
+    """A bounded pool of redis connections, reopened in forked workers.
+
+    Once max_connections are in use, callers wait up to timeout seconds
+    for one to be released instead of opening more. A worker forked from
+    a process that already had connections drops them rather than share
+    the sockets, and opens warm connections of its own up front, so its
+    first requests don't pay for connecting.
+    """
+
+    def __init__(self, url, max_connections=50, timeout=5, warm=1,
+                 **kwargs):
+        self.warm_connections = warm
+        self.pool = CountingConnectionPool.from_url(
+            url, max_connections=max_connections, timeout=timeout, **kwargs)
+        self.client = StrictRedis(connection_pool=self.pool)
+        pools.add(self)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['REDIS_URL'],
+                   max_connections=config['REDIS_MAX_CONNECTIONS'],
+                   timeout=config['REDIS_POOL_TIMEOUT'],
+                   warm=config['REDIS_WARM_CONNECTIONS'],
+                   socket_timeout=config['REDIS_SOCKET_TIMEOUT'],
+                   socket_connect_timeout=config['REDIS_CONNECT_TIMEOUT'],
+                   health_check_interval=config['REDIS_HEALTH_CHECK'])
+
+    def warm(self):
+        """Open the warm connections, and return how many are open."""
+        count = min(self.warm_connections, self.pool.max_connections)
+        connections = []
+        try:
+            for _ in range(count):
+                connections.append(self.pool.get_connection('PING'))
+        except RedisError:
+            # Requests will connect on demand, and report the error then
+            pass
+        finally:
+            for connection in connections:
+                self.pool.release(connection)
+        return len(connections)
+
+    def after_fork(self):
+        """Drop the parent's connections, and open our own."""
+        self.pool.reset()
+        self.warm()
+
+    def stats(self):
+        """Return how many connections were created, are idle and in use."""
+        with self.pool.count_lock:
+            created = self.pool.created
+            in_use = len(self.pool.lent)
+        return {
+            'max': self.pool.max_connections,
+            'created': created,
+            'idle': created - in_use,
+            'in_use': in_use,
+        }
+
+
+def reopen_pools():
+    for pool in list(pools):
+        pool.after_fork()
+
+
+# Without this (before Python 3.7), redis-py still notices the fork, but
+# only resets the pool lazily on the next command
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reopen_pools)
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""Query builders for the read paths."""
+
+from sqlalchemy.sql import and_, or_
+from .model import db, User, Purchase
+
+
+def purchase_rows(household):
+    """Return a query for a household's listing rows, newest first.
+
+    Rows are lightweight tuples of only the columns a listing shows, with
+    the buyer's name joined in, rather than full ORM objects.
+    """
+    return (db.session.query(Purchase.id, Purchase.name, Purchase.cost,
+                             Purchase.date, User.name.label('user'))
+            .outerjoin(User, Purchase.user_id == User.id)
+            .filter(Purchase.household_id == household)
+            .order_by(Purchase.date.desc(), Purchase.id.desc()))
+
+
+def after_position(p_date, p_id):
+    """Return a filter for purchases ordered after (p_date, p_id).
+
+    The date bound on its own is redundant, but it's what lets the
+    database seek into the listing index rather than filter every row
+    from the top down to the position.
+    """
+    return and_(Purchase.date <= p_date,
+                or_(Purchase.date < p_date,
+                    and_(Purchase.date == p_date, Purchase.id < p_id)))
+
+
+def filter_purchases(query, user_id=None, start=None, end=None):
+    """Narrow a purchase query to a user, and an inclusive date range."""
+    if user_id is not None:
+        query = query.filter(Purchase.user_id == user_id)
+    if start is not None:
+        query = query.filter(Purchase.date >= start)
+    if end is not None:
+        query = query.filter(Purchase.date <= end)
+    return query
+
+
+def iter_batches(query, batch_size=1000):
+    """Yield every row of a purchase_rows query, a batch at a time.
+
+    Each batch seeks past the last row of the one before, so walking the
+    whole table takes constant memory and no OFFSET scans.
+    """
+    batch_query = query
+    while True:
+        rows = batch_query.limit(batch_size).all()
+        if rows:
+            yield rows
+        if len(rows) < batch_size:
+            return
+        batch_query = query.filter(after_position(rows[-1].date,
+                                                  rows[-1].id))
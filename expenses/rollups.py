@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""Maintained per-user spending by month and by week.
+
+Each user has a rollup row per period they bought something in, with
+what they paid and how many purchases it was. A report over whole
+periods reads just those rows. Only the partial periods at either end
+of a date range go back to the purchases, which are indexed by date.
+"""
+
+from collections import defaultdict
+from datetime import date, timedelta
+from sqlalchemy.sql import func, select
+from .model import db, Purchase, SpendRollup
+from .totals import insert_or_update
+
+
+PERIODS = ('month', 'week')
+# The period after any date up to here can still be a date
+LAST_REPORT_DATE = date(9999, 11, 30)
+
+
+def period_start(d, period):
+    """Return the first day of the month or week (from Monday) of d."""
+    if period == 'month':
+        return d.replace(day=1)
+    return d - timedelta(days=d.weekday())
+
+
+def next_period(start, period):
+    """Return the first day of the period after the one starting on start."""
+    if period == 'month':
+        return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return start + timedelta(days=7)
+
+
+def rollup_sums(purchases):
+    """Sum purchases into a dict of (user id, period, start) to totals.
+
+    purchases are (user id, household id, date, cost) tuples. The totals
+    are [household id, total, count] lists.
+    """
+    sums = {}
+    for user_id, household_id, p_date, cost in purchases:
+        for period in PERIODS:
+            key = (user_id, period, period_start(p_date, period))
+            totals = sums.setdefault(key, [household_id, 0, 0])
+            totals[1] += cost
+            totals[2] += 1
+    return sums
+
+
+def add_to_rollups(rows):
+    """Add purchase rows to the rollups, as part of the transaction."""
+    sums = rollup_sums((row['user_id'], row['household_id'], row['date'],
+                        row['cost']) for row in rows)
+    for (user_id, period, start), (household_id, total, count) \
+            in sums.items():
+        def update():
+            return (db.session.query(SpendRollup)
+                    .filter_by(user_id=user_id, period=period, start=start)
+                    .update({SpendRollup.total: SpendRollup.total + total,
+                             SpendRollup.count: SpendRollup.count + count},
+                            synchronize_session=False))
+
+        if not update():
+            insert_or_update(SpendRollup.__table__, {
+                'user_id': user_id, 'period': period, 'start': start,
+                'household_id': household_id, 'total': total,
+                'count': count}, update)
+
+
+def computed_rollups(bind=None):
+    """Return every rollup, as rollup_sums would, from the purchases."""
+    query = select([Purchase.user_id, Purchase.household_id, Purchase.date,
+                    Purchase.cost])
+    return rollup_sums((bind or db.session).execute(query))
+
+
+def rollups_drift():
+    """Return a dict of rollup key to (stored, actual) for wrong rollups."""
+    stored = dict(((r.user_id, r.period, r.start),
+                   [r.household_id, r.total, r.count])
+                  for r in SpendRollup.query)
+    actual = computed_rollups()
+    drift = {}
+    for key in set(stored) | set(actual):
+        if stored.get(key) != actual.get(key):
+            drift[key] = (stored.get(key), actual.get(key))
+    return drift
+
+
+def insert_rollups(bind, sums):
+    if sums:
+        bind.execute(SpendRollup.__table__.insert(), [{
+            'user_id': user_id,
+            'period': period,
+            'start': start,
+            'household_id': household_id,
+            'total': total,
+            'count': count,
+        } for (user_id, period, start), (household_id, total, count)
+            in sums.items()])
+
+
+def rebuild_rollups():
+    """Recompute every rollup from scratch, and return the drift fixed."""
+    drift = rollups_drift()
+    db.session.query(SpendRollup).delete()
+    insert_rollups(db.session, computed_rollups())
+    db.session.commit()
+    return drift
+
+
+def spend_report(household, period, start=None, end=None):
+    """Return what each user in a household spent per period.
+
+    The report covers purchases from start to end, inclusive; either may
+    be None to leave it open, and neither may be after LAST_REPORT_DATE.
+    Return a sorted list of (period start, user
+    id, total, count) tuples.
+    """
+    sums = defaultdict(lambda: [0, 0])
+    # Work with [lower, upper) ranges of days
+    lower = start
+    upper = end + timedelta(days=1) if end is not None else None
+    full_from, full_until = lower, upper
+    edges = []
+    if lower is not None and lower != period_start(lower, period):
+        full_from = next_period(period_start(lower, period), period)
+        edges.append((lower, full_from if upper is None else
+                      min(upper, full_from)))
+    if upper is not None and upper != period_start(upper, period):
+        full_until = period_start(upper, period)
+        # Unless the range starts and ends in the same period
+        if full_from is None or full_until >= full_from:
+            edges.append((full_until, upper))
+
+    # Partial periods at the ends, from the purchases
+    for edge_start, edge_end in edges:
+        rows = (db.session.query(Purchase.user_id, func.sum(Purchase.cost),
+                                 func.count(Purchase.id))
+                .filter(Purchase.household_id == household,
+                        Purchase.date >= edge_start,
+                        Purchase.date < edge_end)
+                .group_by(Purchase.user_id))
+        for user_id, total, count in rows:
+            totals = sums[period_start(edge_start, period), user_id]
+            totals[0] += int(total)
+            totals[1] += count
+
+    # Whole periods, from the rollups
+    query = (db.session.query(SpendRollup.start, SpendRollup.user_id,
+                              SpendRollup.total, SpendRollup.count)
+             .filter(SpendRollup.household_id == household,
+                     SpendRollup.period == period))
+    if full_from is not None:
+        query = query.filter(SpendRollup.start >= full_from)
+    if full_until is not None:
+        query = query.filter(SpendRollup.start < full_until)
+    if full_from is None or full_until is None or full_from < full_until:
+        for row in query:
+            totals = sums[row.start, row.user_id]
+            totals[0] += row.total
+            totals[1] += row.count
+
+    return sorted((p_start, user_id, total, count)
+                  for (p_start, user_id), (total, count) in sums.items())
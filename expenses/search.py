@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""Searching purchases by name.
+
+On SQLite, names are indexed with FTS5, in a table the database keeps up
+to date itself through triggers on the purchase table. Elsewhere, each
+household has an inverted index in redis: a sorted set of purchase ids
+for every prefix of every word, scored by date and id, so matches come
+out newest first and a date range is a range of scores. Purchases are
+only ever added, and each is indexed once it's committed; searches
+also catch up on any newer than the last one indexed, such as those
+added before the index was.
+
+Either way, every word searched for has to match the start of a word in
+the name, and words shorter than MIN_TERM are ignored.
+"""
+
+from flask import current_app
+from sqlalchemy import Column, Integer, MetaData, Table, Text, event
+from sqlalchemy.sql import literal_column
+from .model import db, Household, Purchase
+from .query import filter_purchases, purchase_rows
+from .util import random_string
+import re
+import unicodedata
+
+
+MIN_TERM = 2
+# Longer words are indexed and searched for by their first MAX_PREFIX
+MAX_PREFIX = 20
+
+BACKENDS = ('sqlite', 'redis')
+
+# Not part of db.metadata, since create_all can't make virtual tables
+fts_table = Table('purchase_fts', MetaData(),
+                  Column('rowid', Integer),
+                  Column('name', Text),
+                  Column('household_id', Text),
+                  Column('rank'))
+
+# Each purchase's household is indexed as a token of its own, which every
+# search matches too, so it only reads through that household's matches
+FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS purchase_fts USING fts5("
+    "name, household_id, content='purchase', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    # Rank by the name alone
+    "INSERT INTO purchase_fts(purchase_fts, rank) "
+    "VALUES ('rank', 'bm25(1.0, 0.0)')",
+    "CREATE TRIGGER IF NOT EXISTS purchase_fts_insert "
+    "AFTER INSERT ON purchase BEGIN "
+    "INSERT INTO purchase_fts(rowid, name, household_id) "
+    "VALUES (new.id, new.name, new.household_id); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS purchase_fts_delete "
+    "AFTER DELETE ON purchase BEGIN "
+    "INSERT INTO purchase_fts(purchase_fts, rowid, name, household_id) "
+    "VALUES ('delete', old.id, old.name, old.household_id); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS purchase_fts_update "
+    "AFTER UPDATE OF name, household_id ON purchase BEGIN "
+    "INSERT INTO purchase_fts(purchase_fts, rowid, name, household_id) "
+    "VALUES ('delete', old.id, old.name, old.household_id); "
+    "INSERT INTO purchase_fts(rowid, name, household_id) "
+    "VALUES (new.id, new.name, new.household_id); "
+    "END",
+]
+
+
+def search_terms(text):
+    """Return the words of text to search for, lowercased and unaccented.
+
+    This splits words the way the FTS5 tokenizer does, so both backends
+    match the same purchases.
+    """
+    # On Python 2, an argument's default can be a byte string
+    text = unicodedata.normalize('NFKD', type(u'')(text))
+    text = u''.join(c for c in text if not unicodedata.combining(c))
+    return [word[:MAX_PREFIX]
+            for word in re.findall(r'[^\W_]+', text.lower(), re.UNICODE)
+            if len(word) >= MIN_TERM]
+
+
+def has_fts(conn):
+    """Return whether a connection's database can index with FTS5."""
+    return (conn.dialect.name == 'sqlite' and conn.execute(
+        "SELECT sqlite_compileoption_used('ENABLE_FTS5')").scalar() == 1)
+
+
+def create_fts(conn):
+    """Create the FTS5 index and its triggers, and fill it."""
+    for statement in FTS_DDL:
+        conn.execute(statement)
+    conn.execute("INSERT INTO purchase_fts(purchase_fts) VALUES ('rebuild')")
+
+
+def drop_fts(conn):
+    """Drop the FTS5 index and its triggers."""
+    for trigger in ('insert', 'delete', 'update'):
+        conn.execute('DROP TRIGGER IF EXISTS purchase_fts_' + trigger)
+    conn.execute('DROP TABLE IF EXISTS purchase_fts')
+
+
+@event.listens_for(Purchase.__table__, 'after_create')
+def purchase_created(target, conn, **kw):
+    if has_fts(conn):
+        create_fts(conn)
+
+
+@event.listens_for(Purchase.__table__, 'after_drop')
+def purchase_dropped(target, conn, **kw):
+    # The triggers go along with the purchase table
+    if conn.dialect.name == 'sqlite':
+        conn.execute('DROP TABLE IF EXISTS purchase_fts')
+
+
+def search_backend():
+    """Return the SEARCH_BACKEND, or the best one for the database."""
+    backend = current_app.extensions.get('search_backend')
+    if backend is None:
+        backend = current_app.config['SEARCH_BACKEND']
+        if backend is None:
+            with db.engine.connect() as conn:
+                backend = 'sqlite' if has_fts(conn) else 'redis'
+        elif backend not in BACKENDS:
+            raise ValueError('Unknown SEARCH_BACKEND: {0}'.format(backend))
+        current_app.extensions['search_backend'] = backend
+    return backend
+
+
+def term_key(household, term):
+    return 'search:{0}:term:{1}'.format(household, term)
+
+
+def user_key(household, user_id):
+    return 'search:{0}:user:{1}'.format(household, user_id)
+
+
+def indexed_key(household):
+    return 'search:{0}:indexed'.format(household)
+
+
+def score(p_date, p_id):
+    """Return a sorted set score ordering purchases by date, then id."""
+    # Exact in a double with ids under 2 ** 32, for dates up to 5742-10-21;
+    # later ones can be an id or so off, which only reorders a single day
+    return p_date.toordinal() * 2 ** 32 + p_id
+
+
+def index_rows(pipe, household, rows):
+    """Queue adding purchase rows to a household's index on a pipeline."""
+    for p in rows:
+        member = {p.id: score(p.date, p.id)}
+        prefixes = set(term[:n] for term in search_terms(p.name or u'')
+                       for n in range(MIN_TERM, len(term) + 1))
+        for prefix in prefixes:
+            pipe.zadd(term_key(household, prefix), member)
+        pipe.zadd(user_key(household, p.user_id), member)
+
+
+def index_purchases(household, ids=None, batch_size=1000):
+    """Add a household's newly added purchases to its redis index.
+
+    With ids, just those purchases are indexed, as they're committed.
+    Otherwise the index catches up on any newer than the last one it
+    indexed. Ids aren't committed in the order they're given out, so
+    that walk can pass over one that's still being added; whoever adds
+    it indexes it by id once it's committed. Return how many purchases
+    were indexed.
+    """
+    redis = current_app.redis
+    columns = (Purchase.id, Purchase.user_id, Purchase.name, Purchase.date)
+    indexed = 0
+    if ids is not None:
+        ids = sorted(ids)
+        for i in range(0, len(ids), batch_size):
+            rows = (db.session.query(*columns)
+                    .filter(Purchase.household_id == household,
+                            Purchase.id.in_(ids[i:i + batch_size])).all())
+            pipe = redis.pipeline(transaction=False)
+            index_rows(pipe, household, rows)
+            pipe.execute()
+            indexed += len(rows)
+        return indexed
+
+    last = int(redis.get(indexed_key(household)) or 0)
+    while True:
+        rows = (db.session.query(*columns)
+                .filter(Purchase.household_id == household,
+                        Purchase.id > last)
+                .order_by(Purchase.id).limit(batch_size).all())
+        if not rows:
+            return indexed
+        pipe = redis.pipeline(transaction=False)
+        index_rows(pipe, household, rows)
+        last = rows[-1].id
+        pipe.set(indexed_key(household), last)
+        pipe.execute()
+        indexed += len(rows)
+
+
+def fts_search(household, terms, user_id, start, end, offset, limit):
+    """Return matching purchase rows, best matches first, with FTS5."""
+    match = u'household_id : "{0}" AND name : ({1})'.format(
+        household, u' '.join(u'"{0}"*'.format(term) for term in terms))
+    query = filter_purchases(purchase_rows(household), user_id, start, end)
+    return (query.join(fts_table, fts_table.c.rowid == Purchase.id)
+            .filter(literal_column('purchase_fts').op('MATCH')(match))
+            .order_by(None)
+            .order_by(fts_table.c.rank, Purchase.date.desc(),
+                      Purchase.id.desc())
+            .slice(offset, offset + limit).all())
+
+
+def redis_search(household, terms, user_id, start, end, offset, limit):
+    """Return matching purchase rows, newest first, from redis."""
+    index_purchases(household)
+    redis = current_app.redis
+    keys = [term_key(household, term) for term in sorted(set(terms))]
+    if user_id is not None:
+        keys.append(user_key(household, user_id))
+    high = '+inf' if end is None else score(end, 2 ** 32 - 1)
+    low = '-inf' if start is None else score(start, 0)
+    if len(keys) == 1:
+        ids = redis.zrevrangebyscore(keys[0], high, low, offset, limit)
+    else:
+        result = 'search:{0}:result:{1}'.format(household, random_string(12))
+        pipe = redis.pipeline()
+        pipe.zinterstore(result, keys, aggregate='MAX')
+        pipe.zrevrangebyscore(result, high, low, offset, limit)
+        pipe.delete(result)
+        ids = pipe.execute()[1]
+    ids = [int(i) for i in ids]
+    if not ids:
+        return []
+    # Looked up by id, not walked in listing order, and then put back in
+    # the order redis returned them
+    rows = dict((p.id, p) for p in
+                purchase_rows(household).filter(Purchase.id.in_(ids))
+                .order_by(None))
+    return [rows[i] for i in ids if i in rows]
+
+
+def search_purchases(household, text, user_id=None, start=None, end=None,
+                     offset=0, limit=50):
+    """Return up to limit of a household's purchases matching text.
+
+    Results can be narrowed to a buyer, and an inclusive date range.
+    They're rows like purchase_rows returns, ranked by how well the name
+    matches with FTS5, and newest first in redis.
+    """
+    terms = search_terms(text)
+    if not terms:
+        return []
+    if search_backend() == 'sqlite':
+        search = fts_search
+    else:
+        search = redis_search
+    return search(household, terms, user_id, start, end, offset, limit)
+
+
+def rebuild_index():
+    """Index every purchase from scratch, and return how many there are."""
+    if search_backend() == 'sqlite':
+        db.session.execute(
+            "INSERT INTO purchase_fts(purchase_fts) VALUES ('rebuild')")
+        db.session.commit()
+        return Purchase.query.count()
+    redis = current_app.redis
+    keys = list(redis.scan_iter('search:*', count=1000))
+    for i in range(0, len(keys), 1000):
+        redis.delete(*keys[i:i + 1000])
+    return sum(index_purchases(household)
+               for household, in db.session.query(Household.id))
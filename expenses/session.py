@@ -1,11 +1,19 @@
 # -*- coding: utf-8 -*-
 """Server-side sessions."""
 
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from copy import deepcopy
 from datetime import datetime, timedelta
 from flask.sessions import SessionInterface, SessionMixin
 from json import dumps, loads
 from werkzeug.datastructures import CallbackDict
+from .metrics import timed
 from .util import LazyObject, random_string
+import re
+import struct
+import threading
+import time
 
 
 class RedisSession(CallbackDict, SessionMixin):
@@ -21,6 +29,7 @@ class RedisSession(CallbackDict, SessionMixin):
         self.old_sid = None
         self.new = new
         self.modified = False
+        self.ttl = None
 
     def init_data(self):
         """Create a random session key and CSRF token."""
@@ -39,22 +48,193 @@ class RedisSession(CallbackDict, SessionMixin):
         return 'user' in self
 
 
+token_re = re.compile(r'^[A-Za-z0-9_-]*$')
+
+
+class JSONSerializer(object):
+
+    """Serialize sessions as compact JSON."""
+
+    def dumps(self, data):
+        return dumps(data, separators=(',', ':')).encode()
+
+    def loads(self, data):
+        return loads(data.decode())
+
+
+class BinarySerializer(JSONSerializer):
+
+    """Serialize sessions with the CSRF token packed as raw bytes.
+
+    The random token is most of a typical session, and takes 48 bytes
+    rather than 64 once it's out of base64. A marker byte and the token
+    length come first, and the rest of the session follows as JSON.
+    Anything without the marker, like a session written by the JSON
+    serializer, is decoded as plain JSON.
+    """
+
+    marker = b'\x01'
+
+    def dumps(self, data):
+        token = self.pack_token(data.get('csrf'))
+        if token is not None:
+            data = dict((k, v) for k, v in data.items() if k != 'csrf')
+        else:
+            token = b''
+        rest = super(BinarySerializer, self).dumps(data) if data else b''
+        return self.marker + struct.pack('B', len(token)) + token + rest
+
+    def loads(self, data):
+        if data[:1] != self.marker:
+            return super(BinarySerializer, self).loads(data)
+        size, = struct.unpack('B', data[1:2])
+        token, rest = data[2:2 + size], data[2 + size:]
+        if rest:
+            session = super(BinarySerializer, self).loads(rest)
+        else:
+            session = {}
+        if size:
+            session['csrf'] = urlsafe_b64encode(token).decode()
+        return session
+
+    def pack_token(self, token):
+        """Return the raw bytes of a base64 token, if it can be packed."""
+        # Unpadded base64 in whole 4 character groups decodes losslessly
+        if (not isinstance(token, type(u'')) or len(token) % 4 != 0 or
+                len(token) > 340 or not token_re.match(token)):
+            return None
+        return urlsafe_b64decode(token.encode())
+
+
+serializers = {
+    'json': JSONSerializer,
+    'binary': BinarySerializer,
+}
+
+
+def copy_data(data):
+    """Copy session data deeply enough that changes don't leak back."""
+    return dict((k, deepcopy(v) if isinstance(v, (list, dict)) else v)
+                for k, v in data.items())
+
+
+class SessionCache(object):
+
+    """A per-process LRU cache of decoded sessions.
+
+    Entries are only trusted for a few seconds. Changes are written
+    through to the cache, and announced on a redis channel so that other
+    processes drop their copy right away.
+    """
+
+    channel = 'session:invalidate'
+
+    def __init__(self, maxsize=1024, ttl=5):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Tells our own announcements apart from other processes'
+        self.token = random_string(8)
+        self.listener = None
+
+    def get(self, sid):
+        """Return the data and redis TTL of a cached session, or None."""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.pop(sid, None)
+            if entry is None or entry[0] <= now:
+                return None
+            self.entries[sid] = entry
+        expires, data, ttl, loaded = entry
+        if ttl >= 0:
+            ttl -= int(now - loaded)
+        return copy_data(data), ttl
+
+    def set(self, sid, data, ttl):
+        now = time.time()
+        entry = (now + self.ttl, copy_data(data), ttl, now)
+        with self.lock:
+            self.entries.pop(sid, None)
+            self.entries[sid] = entry
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def discard(self, sid):
+        with self.lock:
+            self.entries.pop(sid, None)
+
+    def announce(self, pipe, sid):
+        """Queue a message telling other processes to drop a session."""
+        pipe.publish(self.channel, '{0}:{1}'.format(self.token, sid))
+
+    def on_message(self, message):
+        token, _, sid = message['data'].decode().partition(':')
+        if token != self.token:
+            self.discard(sid)
+
+    def listen(self, redis):
+        """Make sure a thread is dropping sessions changed elsewhere."""
+        if self.listener is not None and self.listener.is_alive():
+            return
+        with self.lock:
+            if self.listener is None or not self.listener.is_alive():
+                # Anything cached while we weren't listening is suspect
+                self.entries.clear()
+                pubsub = redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(**{self.channel: self.on_message})
+                self.listener = pubsub.run_in_thread(sleep_time=1,
+                                                     daemon=True)
+
+
 class RedisSessionInterface(SessionInterface):
 
     session_class = RedisSession
+    serializer = JSONSerializer()
+
+    def __init__(self, serializer=None, cache=None):
+        if serializer is not None:
+            self.serializer = serializer
+        self.cache = cache
 
     def open_session(self, app, request):
         """Attempt to load the session from a cookie, or create one."""
         sid = request.cookies.get(app.session_cookie_name)
         if sid:
-            data = app.redis.get(self.redis_key(sid))
-            if data:
-                initial = loads(data.decode())
-                return self.session_class(initial=initial, sid=sid)
+            initial, ttl = self.load(app, sid)
+            if initial is not None:
+                return self.stored_session(sid, initial, ttl)
+        return self.new_session()
+
+    def new_session(self):
         session = self.session_class(new=True)
         session.init_data()
         return session
 
+    def stored_session(self, sid, initial, ttl):
+        session = self.session_class(initial=initial, sid=sid)
+        session.ttl = ttl
+        return session
+
+    def load(self, app, sid):
+        """Return the data and TTL of a stored session, or (None, None)."""
+        if self.cache is not None:
+            self.cache.listen(app.redis)
+            cached = self.cache.get(sid)
+            if cached is not None:
+                return cached
+        pipe = app.redis.pipeline(transaction=False)
+        pipe.get(self.redis_key(sid))
+        pipe.ttl(self.redis_key(sid))
+        with timed('redis', 2):
+            data, ttl = pipe.execute()
+        if not data:
+            return None, None
+        initial = self.serializer.loads(data)
+        if self.cache is not None:
+            self.cache.set(sid, initial, ttl)
+        return initial, ttl
+
     def redis_key(self, sid):
         return 'session:{0}'.format(sid)
 
@@ -66,25 +246,73 @@ class RedisSessionInterface(SessionInterface):
     def get_expiration_time(self, app, session):
         return datetime.utcnow() + self.get_session_lifetime(app, session)
 
+    def recently_refreshed(self, app, session, expire_seconds):
+        """Return whether the expiry was refreshed too recently to redo.
+
+        This is controlled by SESSION_REFRESH_THROTTLE, the number of
+        seconds to wait between refreshes. By default it's 0, which
+        refreshes the expiry on every request.
+        """
+        throttle = app.config.get('SESSION_REFRESH_THROTTLE', 0)
+        if isinstance(throttle, timedelta):
+            throttle = throttle.total_seconds()
+        if not throttle or session.ttl is None or session.ttl < 0:
+            return False
+        return expire_seconds - session.ttl < throttle
+
+    def expire_seconds(self, app, session):
+        redis_exp = self.get_session_lifetime(app, session)
+        return redis_exp.days * 60 * 60 * 24 + redis_exp.seconds
+
     def save_session(self, app, session, response):
         """Write the session to redis, and set the cookie."""
-        domain = self.get_cookie_domain(app)
+        pipe = app.redis.pipeline()
+        self.queue_save(app, session, pipe)
+        written = len(pipe)
+        if written:
+            with timed('redis', written):
+                pipe.execute()
+        self.finish_save(app, session, response, written)
+
+    def queue_save(self, app, session, pipe):
+        """Queue the redis commands that save a session on a pipeline.
+
+        Both the blocking and the asyncio clients queue commands without
+        any I/O, so saving is split around executing the pipeline.
+        """
+        cache = self.cache
         if not session:
-            app.redis.delete(self.redis_key(session.sid))
-            if session.modified:
-                response.delete_cookie(app.session_cookie_name, domain=domain)
+            pipe.delete(self.redis_key(session.sid))
+            if cache is not None:
+                cache.discard(session.sid)
+                cache.announce(pipe, session.sid)
             return
 
         redis_key = self.redis_key(session.sid)
-        redis_exp = self.get_session_lifetime(app, session)
-        expire_seconds = redis_exp.days * 60 * 60 * 24 + redis_exp.seconds
+        expire_seconds = self.expire_seconds(app, session)
         if session.old_sid:
-            app.redis.delete(self.redis_key(session.old_sid))
+            pipe.delete(self.redis_key(session.old_sid))
+            if cache is not None:
+                cache.discard(session.old_sid)
+                cache.announce(pipe, session.old_sid)
         if session.modified:
-            data = dumps(dict(session), separators=(',', ':'))
-            app.redis.setex(redis_key, expire_seconds, data)
-        else:
-            app.redis.expire(redis_key, expire_seconds)
+            data = self.serializer.dumps(dict(session))
+            pipe.setex(redis_key, expire_seconds, data)
+            if cache is not None:
+                cache.announce(pipe, session.sid)
+        elif not self.recently_refreshed(app, session, expire_seconds):
+            pipe.expire(redis_key, expire_seconds)
+
+    def finish_save(self, app, session, response, written):
+        """Set the cookie once a session's pipeline has been executed."""
+        domain = self.get_cookie_domain(app)
+        if not session:
+            if session.modified:
+                response.delete_cookie(app.session_cookie_name, domain=domain)
+            return
+        if written and self.cache is not None:
+            self.cache.set(session.sid, dict(session),
+                           self.expire_seconds(app, session))
 
         cookie_exp = self.get_expiration_time(app, session)
         secure = self.get_cookie_secure(app)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""Settling up balances in as few payments as we reasonably can."""
+
+from collections import defaultdict
+import heapq
+
+
+def equal_shares(totals):
+    """Return everyone's balance for an equal split of what they paid.
+
+    totals is a list of (name, amount paid) pairs, in cents. Everyone owes
+    the same share of the sum, and the odd cents go to the first people
+    in the list. A positive balance is owed money; a negative one owes.
+    """
+    return net_balances([(name, paid, 0) for name, paid in totals])
+
+
+def net_balances(totals):
+    """Return everyone's balance, given what they paid and owe.
+
+    totals is a list of (name, paid, owed) triples, where owed covers the
+    purchases split with explicit shares. Whatever was paid beyond that
+    is split equally, as in equal_shares.
+    """
+    if not totals:
+        return []
+    pool = sum(paid - owed for _, paid, owed in totals)
+    share, extra = divmod(pool, len(totals))
+    return [(name, paid - owed - share - (1 if i < extra else 0))
+            for i, (name, paid, owed) in enumerate(totals)]
+
+
+def settle(balances):
+    """Return (payer, payee, amount) payments that zero out the balances.
+
+    Finding the fewest payments is NP-hard, so this is greedy: first any
+    debtor and creditor whose balances exactly cancel are paired up, and
+    then the largest debtor repeatedly pays the largest creditor as much
+    as they can. Each payment settles at least one person, so it takes
+    at most n - 1 payments, in O(n log n) time.
+    """
+    payments = []
+    creditors = []
+    debtors = defaultdict(list)
+    for name, amount in balances:
+        if amount < 0:
+            debtors[-amount].append(name)
+    for name, amount in balances:
+        if amount > 0:
+            if debtors.get(amount):
+                payments.append((debtors[amount].pop(), name, amount))
+            else:
+                creditors.append((-amount, name))
+    debtors = [(-amount, name) for amount, names in debtors.items()
+               for name in names]
+
+    # Both heaps hold negated amounts, so the largest comes out first
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+    while creditors and debtors:
+        credit, creditor = heapq.heappop(creditors)
+        debt, debtor = heapq.heappop(debtors)
+        amount = min(-credit, -debt)
+        payments.append((debtor, creditor, amount))
+        if -credit > amount:
+            heapq.heappush(creditors, (credit + amount, creditor))
+        if -debt > amount:
+            heapq.heappush(debtors, (debt + amount, debtor))
+    return payments
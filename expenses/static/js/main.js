@@ -1,5 +1,8 @@
 var failMsg = 'Error communicating with the server.';
 
+// The last validator and data seen for each GET url
+var validated = {};
+
 function request(method, url, data, success, error) {
     var xhr = new XMLHttpRequest();
     xhr.open(method, url);
@@ -9,9 +12,17 @@ function request(method, url, data, success, error) {
         xhr.setRequestHeader('Content-Type', 'application/json');
         body = JSON.stringify(data);
     }
+    if (method == 'GET' && validated[url]) {
+        xhr.setRequestHeader('If-None-Match', validated[url].etag);
+    }
 
     xhr.onload = function() {
         var data;
+        if (xhr.status == 304 && validated[url]) {
+            // Unchanged since we last fetched it
+            success(validated[url].data);
+            return;
+        }
         if (xhr.responseText) {
             // Parse the response, if it exists
             try {
@@ -26,6 +37,10 @@ function request(method, url, data, success, error) {
         }
 
         if (xhr.status >= 200 && xhr.status < 400) {
+            var etag = xhr.getResponseHeader('ETag');
+            if (method == 'GET' && etag) {
+                validated[url] = {etag: etag, data: data};
+            }
             success(data);
             return;
         } else {
@@ -52,6 +67,23 @@ function createDiv(cls, text) {
     return div;
 }
 
+function createRow(expense) {
+    var row = createDiv('row');
+    row.setAttribute('data-id', expense.id);
+    row.setAttribute('data-date', expense.iso_date);
+    row.appendChild(createDiv('cell user', expense.user));
+    row.appendChild(createDiv('cell name', expense.name));
+    row.appendChild(createDiv('cell price', expense.price));
+    return row;
+}
+
+function createGroup(expense, container, before) {
+    container.insertBefore(createDiv('date', expense.date), before);
+    var table = createDiv('box table');
+    container.insertBefore(table, before);
+    return table;
+}
+
 var addExpense = (function() {
     var currentTable = null;
     var lastExpenseDate = null;
@@ -59,19 +91,71 @@ var addExpense = (function() {
     return function(expense, container) {
         if (expense.date != lastExpenseDate) {
             lastExpenseDate = expense.date;
-            container.appendChild(createDiv('date', expense.date));
-            currentTable = createDiv('box table');
-            container.appendChild(currentTable);
+            currentTable = createGroup(expense, container, null);
         };
 
-        var row = createDiv('row');
-        row.appendChild(createDiv('cell user', expense.user));
-        row.appendChild(createDiv('cell name', expense.name));
-        row.appendChild(createDiv('cell price', expense.price));
-        currentTable.appendChild(row);
+        currentTable.appendChild(createRow(expense));
     };
 })();
 
+function prependExpense(expense, container) {
+    // Add a new expense above the first one shown from its date or
+    // earlier, so a backdated one lands among the others from its date.
+    // Return false if it's older than every one shown.
+    if (container.querySelector('.row[data-id="' + expense.id + '"]')) {
+        // The feed can send one the page already shows
+        return true;
+    };
+    var rows = container.querySelectorAll('.table > .row');
+    for (var i = 0; i < rows.length; i++) {
+        if (rows[i].getAttribute('data-date') > expense.iso_date) {
+            continue;
+        };
+        var table = rows[i].parentNode;
+        var label = table.previousSibling;
+        if (label.textContent != expense.date) {
+            // Dates with the same label are together, so it goes at the
+            // end of the group before, or in a new group between them
+            table = i > 0 ? rows[i - 1].parentNode : null;
+            if (!table || table.previousSibling.textContent != expense.date) {
+                createGroup(expense, container, label)
+                    .appendChild(createRow(expense));
+                return true;
+            };
+            table.appendChild(createRow(expense));
+            return true;
+        };
+        table.insertBefore(createRow(expense), rows[i]);
+        return true;
+    };
+    return false;
+}
+
+function updateBalances(balances, payments, container) {
+    var old = container.querySelectorAll('.user-card, .payments');
+    for (var i = 0; i < old.length; i++) {
+        container.removeChild(old[i]);
+    };
+
+    var first = container.firstChild;
+    for (var i = 0; i < balances.length; i++) {
+        var card = createDiv('user-card');
+        card.appendChild(createDiv('user-name', balances[i].name));
+        card.appendChild(createDiv('user-balance ' +
+            (balances[i].positive ? 'positive' : 'negative'),
+            balances[i].balance));
+        container.insertBefore(card, first);
+    };
+    if (payments.length > 0) {
+        var list = createDiv('payments');
+        for (var i = 0; i < payments.length; i++) {
+            list.appendChild(createDiv('payment', payments[i].from + ' pays ' +
+                payments[i].to + ' ' + payments[i].amount));
+        };
+        container.insertBefore(list, first);
+    };
+}
+
 window.onload = function() {
     var plus = document.getElementById('plus');
     if (plus) {
@@ -83,14 +167,12 @@ window.onload = function() {
         });
     };
 
-    var addExpenses = (function() {
-        var container = document.getElementsByClassName('container')[0];
-        return function(data) {
-            for (var i = 0; i < data.expenses.length; i++) {
-                addExpense(data.expenses[i], container);
-            };
+    var container = document.getElementsByClassName('container')[0];
+    function addExpenses(data) {
+        for (var i = 0; i < data.expenses.length; i++) {
+            addExpense(data.expenses[i], container);
         };
-    })();
+    };
 
     addExpenses(data);
 
@@ -138,4 +220,27 @@ window.onload = function() {
 
     window.addEventListener('scroll', onScroll);
     onScroll();
+
+    if (window.EventSource) {
+        // Show what everyone else adds, without reloading the page
+        var source = new EventSource(feed);
+        source.onmessage = function(e) {
+            var d = JSON.parse(e.data);
+            if (d.reload) {
+                source.close();
+                window.location.reload();
+                return;
+            };
+            // Oldest first, so the newest ends up on top
+            for (var i = d.expenses.length - 1; i >= 0; i--) {
+                if (!prependExpense(d.expenses[i], container)) {
+                    // Backdated below the page, so start it again
+                    source.close();
+                    window.location.reload();
+                    return;
+                };
+            };
+            updateBalances(d.balances, d.payments, container);
+        };
+    };
 };
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""Caching compiled templates across workers and restarts.
+
+Jinja compiles each template to Python source and then to bytecode the
+first time a process uses it. A bytecode cache keeps the result, on disk
+or in redis, so new workers skip straight to loading it. Templates can
+also be compiled up front, before the first request needs them.
+"""
+
+from jinja2 import BytecodeCache, FileSystemBytecodeCache
+from redis import RedisError
+
+
+class RedisBytecodeCache(BytecodeCache):
+
+    """Share compiled templates between workers through redis.
+
+    Entries are keyed by template name and checked against the source,
+    so an edited template is recompiled. Redis errors just mean compiling
+    the template again.
+    """
+
+    prefix = 'jinja:bytecode:'
+
+    def __init__(self, app, timeout=None):
+        self.app = app
+        self.timeout = timeout
+
+    def load_bytecode(self, bucket):
+        try:
+            code = self.app.redis.get(self.prefix + bucket.key)
+        except RedisError:
+            return
+        if code is not None:
+            bucket.bytecode_from_string(code)
+
+    def dump_bytecode(self, bucket):
+        try:
+            self.app.redis.set(self.prefix + bucket.key,
+                               bucket.bytecode_to_string(), ex=self.timeout)
+        except RedisError:
+            pass
+
+
+def bytecode_cache(app):
+    """Return the bytecode cache set up by TEMPLATE_CACHE, or None."""
+    kind = app.config['TEMPLATE_CACHE']
+    if kind == 'filesystem':
+        return FileSystemBytecodeCache(app.config['TEMPLATE_CACHE_DIR'])
+    elif kind == 'redis':
+        return RedisBytecodeCache(app, app.config['TEMPLATE_CACHE_TTL'])
+    elif kind:
+        raise ValueError('Unknown TEMPLATE_CACHE: {0}'.format(kind))
+    return None
+
+
+def precompile_templates(app):
+    """Load every template, filling the bytecode cache, and count them."""
+    names = app.jinja_env.list_templates(extensions=['html'])
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""Maintained per-user purchase totals.
+
+Each user has a running total of what they paid, and of what they owe
+for purchases split with explicit shares. Purchases without shares are
+split equally between everyone, so the pool of those is simply what
+was paid in all, less what's owed through shares.
+"""
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import func, select
+from .model import db, User, Purchase, PurchaseShare, UserTotal
+
+
+def serializes_writes():
+    """Return whether the database lets one transaction write at a time.
+
+    SQLite does, and pysqlite on Python 2 commits around savepoints, so
+    they can't be used there anyway.
+    """
+    return db.session.get_bind().dialect.name == 'sqlite'
+
+
+def insert_or_update(table, values, update):
+    """Insert a row that update found missing, as part of the transaction.
+
+    If another transaction inserts the row first, the insert is rolled
+    back to a savepoint, and update called again to add to that row.
+    """
+    if serializes_writes():
+        db.session.execute(table.insert(), values)
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.execute(table.insert(), values)
+    except IntegrityError:
+        update()
+
+
+def add_to_total(user_id, amount=0, owed=0):
+    """Add to a user's totals, as part of the current transaction."""
+    def update():
+        return (db.session.query(UserTotal).filter_by(user_id=user_id)
+                .update({UserTotal.total: UserTotal.total + amount,
+                         UserTotal.owed: UserTotal.owed + owed},
+                        synchronize_session=False))
+
+    if not update():
+        insert_or_update(UserTotal.__table__, {
+            'user_id': user_id, 'total': amount, 'owed': owed}, update)
+
+
+def computed_paid(bind=None):
+    """Return a dict of user id to amount paid, from the purchases."""
+    query = (select([User.id, func.sum(Purchase.cost)])
+             .select_from(User.__table__.outerjoin(Purchase.__table__))
+             .group_by(User.id))
+    rows = (bind or db.session).execute(query)
+    return dict((user_id, int(total or 0)) for user_id, total in rows)
+
+
+def computed_owed(bind=None):
+    """Return a dict of user id to amount owed, from the shares."""
+    query = (select([PurchaseShare.user_id, func.sum(PurchaseShare.amount)])
+             .group_by(PurchaseShare.user_id))
+    rows = (bind or db.session).execute(query)
+    return dict((user_id, int(owed)) for user_id, owed in rows)
+
+
+def computed_totals(bind=None):
+    """Return a dict of user id to (paid, owed), from the purchases."""
+    owed = computed_owed(bind)
+    return dict((user_id, (paid, owed.get(user_id, 0)))
+                for user_id, paid in computed_paid(bind).items())
+
+
+def totals_drift():
+    """Return a dict of user id to (stored, actual) for wrong totals."""
+    stored = dict((user_id, (total, owed)) for user_id, total, owed in
+                  db.session.query(UserTotal.user_id, UserTotal.total,
+                                   UserTotal.owed))
+    drift = {}
+    for user_id, totals in computed_totals().items():
+        if stored.get(user_id, (0, 0)) != totals:
+            drift[user_id] = (stored.get(user_id), totals)
+    return drift
+
+
+def rebuild_totals():
+    """Recompute every total from scratch, and return the drift fixed."""
+    drift = totals_drift()
+    db.session.query(UserTotal).delete()
+    db.session.add_all(UserTotal(user_id=user_id, total=paid, owed=owed)
+                       for user_id, (paid, owed)
+                       in computed_totals().items())
+    db.session.commit()
+    return drift
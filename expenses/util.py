@@ -1,12 +1,22 @@
 # -*- coding: utf-8 -*-
 """Utility functions."""
 
-from base64 import urlsafe_b64encode
-from datetime import date
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import date, datetime
 from flask import request, session, abort, redirect, url_for
 from functools import wraps
 import operator
 import os
+import sys
+
+
+PY2 = sys.version_info[0] == 2
+
+# Far more than any real expense, and small enough that totals of a great
+# many of them still fit in a 64-bit INTEGER column
+MAX_COST = 10 ** 12
+MAX_ID = 2 ** 63 - 1
+MAX_WEIGHT = 10 ** 6
 
 
 class LazyObject(object):
@@ -58,7 +68,8 @@ class LazyObject(object):
 def check_csrf(fn):
     @wraps(fn)
     def inner(*a, **kw):
-        token = request.form.get('token') or request.args.get('token')
+        token = request.form.get('token') or request.args.get('token') or \
+            request.headers.get('X-CSRF-Token')
         if not token or token != session['csrf']:
             abort(403)
         return fn(*a, **kw)
@@ -103,6 +114,68 @@ def date_format(d, today=None):
         return '{0:%B %Y}'.format(d)
 
 
+def parse_expense(name, price, p_date):
+    """Validate the fields of a new expense.
+
+    Return a dict of purchase columns, and a list of error messages. The
+    dict is only complete if there are no errors.
+    """
+    values = {}
+    errors = []
+    if not name:
+        errors.append('A name is required')
+    elif not isinstance(name, (type(u''), type(''))):
+        # Parsed JSON can hold anything
+        errors.append('Expected a valid name')
+    else:
+        values['name'] = name
+    try:
+        if isinstance(price, bool):
+            raise TypeError(price)
+        values['cost'] = int(float(price) * 100)
+        if values['cost'] <= 0:
+            errors.append('The price must be greater than $0.00')
+        elif values['cost'] > MAX_COST:
+            errors.append('The price must be at most {0}'
+                          .format(price_filter(MAX_COST)))
+    except (TypeError, ValueError, OverflowError):
+        errors.append('Expected a valid price')
+    try:
+        values['date'] = datetime.strptime(p_date, '%m/%d/%Y').date()
+    except (TypeError, ValueError):
+        errors.append('Expected a valid date')
+    return values, errors
+
+
+def parse_shares(participants, weights=None):
+    """Validate who a purchase is split between.
+
+    participants is a list of user ids, ignoring blanks, and weights an
+    optional dict of user id to weight; anyone not in it weighs 1. Return
+    a list of (user id, weight) pairs, and a list of error messages.
+    """
+    if weights is None:
+        weights = {}
+    shares = []
+    seen = set()
+    try:
+        for user_id in participants:
+            if user_id in ('', None) or user_id in seen:
+                continue
+            seen.add(user_id)
+            weight = int(weights.get(user_id) or 1)
+            if not 0 < weight <= MAX_WEIGHT:
+                raise ValueError(weight)
+            if not 0 < int(user_id) <= MAX_ID:
+                raise ValueError(user_id)
+            shares.append((int(user_id), weight))
+    except (TypeError, ValueError, OverflowError):
+        return [], ['Expected valid participants']
+    if not shares:
+        return [], ['At least one participant is required']
+    return shares, []
+
+
 def price_filter(amount):
     return u'${0:,.2f}'.format(amount / 100.0)
 
@@ -115,3 +188,42 @@ def random_string(size):
         raise ValueError('The length must be a multiple of 4')
     n_bytes = size * 3 // 4
     return urlsafe_b64encode(os.urandom(n_bytes)).decode()
+
+
+def encode_cursor(d, purchase_id):
+    """Return an opaque pagination cursor for a (date, id) position."""
+    raw = '{0}:{1}'.format(d.toordinal(), purchase_id)
+    return urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return the (date, id) position encoded in a pagination cursor."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        raw = urlsafe_b64decode(padded.encode()).decode()
+        ordinal, purchase_id = raw.split(':')
+        if not 0 <= int(purchase_id) <= MAX_ID:
+            raise ValueError(purchase_id)
+        return date.fromordinal(int(ordinal)), int(purchase_id)
+    except (ValueError, OverflowError):
+        raise ValueError('Invalid cursor')
+
+
+def encode_csv_row(row):
+    """Return a row for a csv.writer, which writes bytes on Python 2."""
+    if PY2:
+        return [cell.encode('utf-8') if isinstance(cell, type(u'')) else cell
+                for cell in row]
+    return row
+
+
+def decode_csv_cell(cell):
+    """Return a cell from a csv.reader as text, as on Python 3.
+
+    A DictReader's missing cells are None, and its extra ones a list.
+    """
+    if isinstance(cell, bytes):
+        return cell.decode('utf-8')
+    elif isinstance(cell, list):
+        return [decode_csv_cell(c) for c in cell]
+    return cell
@@ -1,101 +1,713 @@
 # -*- coding: utf-8 -*-
 """Main HTML views."""
 
-from bcrypt import gensalt, hashpw
-from datetime import datetime, date
+from collections import OrderedDict
+from datetime import date, datetime
 from flask import Blueprint, request, session, flash, url_for, redirect, \
-                  jsonify, render_template
+                  jsonify, render_template, make_response, current_app, \
+                  Response, stream_with_context
+from functools import wraps
+from hashlib import sha1
+from json import dumps
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.sql import func
-from werkzeug.security import safe_str_cmp
-from .model import db, User, Purchase
-from .util import check_csrf, require_auth, require_noauth, date_format, \
-                  price_filter
+from werkzeug.exceptions import ServiceUnavailable
+from . import importer
+from .cache import purchase_count, response_cache
+from .error import html_handler
+from .feed import log_position, logged_since, queue_read_log
+from .hashing import HasherBusy
+from .importer import MalformedFile, formats, guess_format
+from .ledger import add_keyed_purchases, add_purchases, purchases_committed
+from .model import db, Household, User, Purchase, UserTotal
+from .query import purchase_rows, after_position, filter_purchases, \
+                   iter_batches
+from .rollups import LAST_REPORT_DATE, PERIODS, spend_report
+from .search import search_purchases, search_terms
+from .settlement import net_balances, settle
+from .util import MAX_ID, PY2, check_csrf, require_auth, require_noauth, \
+                  date_format, price_filter, encode_cursor, decode_cursor, \
+                  encode_csv_row, parse_expense, parse_shares, random_string
+import csv
+import io
+import time
 
 
 views = Blueprint('views', __name__, template_folder='templates')
 
 PER_PAGE = 50
+# Keys are looked up with IN (...), within SQLite's 999 parameters
+MAX_BATCH = 500
+MAX_KEY = 64
+# Milliseconds for a browser to wait before reopening a closed feed stream
+FEED_RETRY = 3000
 
 
-def purchases_obj(page):
-    total_purchases = db.session.query(Purchase).count()
-    purchases = (db.session.query(Purchase)
-                 .order_by(Purchase.date.desc(), Purchase.id.desc())
-                 .slice(page * PER_PAGE, (page + 1) * PER_PAGE))
-    data = {
-        'expenses': [{
-            'user': p.user.name,
-            'name': p.name,
-            'price': price_filter(p.cost),
-            'date': date_format(p.date),
-        } for p in purchases],
-        'links': {},
-    }
-    if total_purchases > (page + 1) * PER_PAGE:
-        data['links']['next'] = url_for('.get_expenses', page=page + 1,
+def current_household():
+    """Return the id of the household the request is scoped to.
+
+    That's the signed in user's household, or the DEFAULT_HOUSEHOLD for
+    anyone else, which may be None. It's kept in the session so looking
+    it up doesn't touch the database.
+    """
+    if not session.authed:
+        return current_app.config['DEFAULT_HOUSEHOLD']
+    if 'household' not in session:
+        # Signed in before there were households
+        session['household'] = db.session.query(User.household_id) \
+            .filter_by(id=session['user']).scalar()
+    return session['household']
+
+
+def require_household(fn):
+    @wraps(fn)
+    def inner(*a, **kw):
+        household = current_household()
+        if household is None:
+            return redirect(url_for('.login_page'), code=303)
+        return fn(household, *a, **kw)
+    return inner
+
+
+def expense_objs(purchases):
+    return [{
+        'id': p.id,
+        'user': p.user,
+        'name': p.name,
+        'price': price_filter(p.cost),
+        'date': date_format(p.date),
+        # The date is a label, like Today; this one orders the listing
+        'iso_date': p.date.isoformat(),
+    } for p in purchases]
+
+
+def page_query(household, page=0, cursor=None):
+    """Return a query for one page of a household's purchases.
+
+    Pages are addressed either by number, or by a cursor holding the
+    (date, id) of the last purchase already seen. The cursor form seeks
+    directly to the next row instead of skipping over every earlier one.
+    """
+    query = purchase_rows(household)
+    if cursor is not None:
+        return query.filter(after_position(*cursor)).limit(PER_PAGE + 1)
+    return query.slice(page * PER_PAGE, (page + 1) * PER_PAGE + 1)
+
+
+def purchases_obj(household, page=0, cursor=None):
+    """Return one page of a household's purchases, newest first."""
+    return page_obj(page_query(household, page, cursor).all())
+
+
+def page_obj(purchases):
+    """Return the listing of the rows of a page_query."""
+    # The extra row only tells us whether there's a next page
+    has_next = len(purchases) > PER_PAGE
+    purchases = purchases[:PER_PAGE]
+    data = {'expenses': expense_objs(purchases), 'links': {}}
+    if has_next:
+        last = purchases[-1]
+        data['links']['next'] = url_for('.get_expenses',
+                                        cursor=encode_cursor(last.date,
+                                                             last.id),
                                         _external=True)
     return data
 
 
-@views.route('/')
-def home():
-    query = db.session.query(User.name, func.sum(Purchase.cost).label('tot')) \
-        .outerjoin(Purchase).group_by(User).order_by(User.name)
-    users = [(r.name, int(r.tot or 0)) for r in query]
-    if users:
-        avg = float(sum(user[1] for user in users)) / len(users)
+def feed_url(position):
+    """Return the link to the feed from a log_position."""
+    return url_for('.expense_stream', since=position, _external=True)
+
+
+def purchases_cache_name(host_url, page=0, cursor=None):
+    if cursor is not None:
+        position = 'cursor:{0}:{1}'.format(cursor[0].toordinal(), cursor[1])
     else:
-        avg = 0
-    purchases = purchases_obj(0)
-    return render_template('views/home.html', users=users, avg=avg,
-                           purchases=purchases, today=date.today())
+        position = 'page:{0}'.format(page)
+    # Dates are shown relative to today, and links include the host
+    return 'expenses:{0}:{1}:{2}'.format(date.today().toordinal(), host_url,
+                                         position)
 
 
-@views.route('/expenses', methods=['GET'])
-def get_expenses():
+def cached_purchases_obj(household, page=0, cursor=None):
+    """Return purchases_obj, by way of the response cache."""
+    return response_cache.get_or_set(
+        household, purchases_cache_name(request.host_url, page, cursor),
+        lambda: purchases_obj(household, page, cursor))
+
+
+def user_totals_query(household):
+    return db.session.query(User.id, User.name, UserTotal.total,
+                            UserTotal.owed) \
+        .outerjoin(UserTotal).filter(User.household_id == household) \
+        .order_by(User.name)
+
+
+def user_totals(household, rows=None):
+    if rows is None:
+        rows = user_totals_query(household)
+    return [(r.id, r.name, r.total or 0, r.owed or 0) for r in rows]
+
+
+def cached_user_totals(household):
+    return response_cache.get_or_set(household, 'user-totals',
+                                     lambda: user_totals(household))
+
+
+def household_query(household):
+    return db.session.query(Household.name, Household.invite_code) \
+        .filter(Household.id == household)
+
+
+def household_obj(household, row=None):
+    if row is None:
+        row = household_query(household).one()
+    return {'name': row.name, 'invite_code': row.invite_code}
+
+
+def user_balances(users):
+    return net_balances([(name, paid, owed)
+                         for _, name, paid, owed in users])
+
+
+def balances_obj(balances):
+    return [{
+        'name': name,
+        'balance': price_filter(balance),
+        'positive': balance >= 0,
+    } for name, balance in balances]
+
+
+def payments_obj(balances):
+    return [{
+        'from': payer,
+        'to': payee,
+        'amount': price_filter(amount),
+    } for payer, payee, amount in settle(balances)]
+
+
+@views.route('/')
+@require_household
+def home(household):
+    position = log_position(household)
+    users = cached_user_totals(household)
+    purchases = cached_purchases_obj(household, 0)
+    invite_code = None
+    if session.authed:
+        invite_code = response_cache.get_or_set(
+            household, 'household',
+            lambda: household_obj(household))['invite_code']
+    return render_home(users, purchases, invite_code, position)
+
+
+def render_home(users, purchases, invite_code, position):
+    balances = user_balances(users)
+    return render_template('views/home.html', users=users,
+                           balances=balances, payments=settle(balances),
+                           purchases=purchases, invite_code=invite_code,
+                           feed=feed_url(position), today=date.today())
+
+
+@views.route('/settlement')
+@require_household
+def settlement(household):
+    users = cached_user_totals(household)
+    return jsonify({'payments': payments_obj(user_balances(users))})
+
+
+def expenses_etag(household, generation):
+    """Return a validator for the current /expenses response.
+
+    The household's response cache generation changes with every write
+    that could change a page, whatever order it commits in. The date is
+    included because dates are shown relative to today, and the path
+    carries the page or cursor.
+    """
+    raw = '{0}:{1}:{2}:{3}'.format(household, generation,
+                                   date.today().toordinal(),
+                                   request.full_path)
+    return sha1(raw.encode()).hexdigest()
+
+
+def invalid_position(cursor):
+    return 'Invalid cursor.' if cursor is not None else 'Invalid page number.'
+
+
+def listing_position():
+    """Return the (page, cursor) an /expenses request asks for.
+
+    Either may be used, and the cursor is None unless it's given. Raise
+    ValueError, with the message to respond with, for a bad one.
+    """
+    cursor = request.args.get('cursor')
+    if cursor is not None:
+        try:
+            return 0, decode_cursor(cursor)
+        except ValueError:
+            raise ValueError(invalid_position(cursor))
     try:
         page = int(request.args.get('page', '0'))
     except ValueError:
-        return jsonify({'msg': 'Invalid page number.'}), 404
-    if page < 0:
-        return jsonify({'msg': 'Invalid page number.'}), 404
-    data = purchases_obj(page)
+        page = -1
+    if not 0 <= page <= MAX_ID // PER_PAGE:
+        raise ValueError(invalid_position(None))
+    return page, None
+
+
+@views.route('/expenses', methods=['GET'])
+@require_household
+def get_expenses(household):
+    etag = expenses_etag(household, response_cache.generation(household))
+    if etag in request.if_none_match:
+        response = make_response('', 304)
+        response.set_etag(etag)
+        return response
+    try:
+        page, cursor = listing_position()
+    except ValueError as e:
+        return jsonify({'msg': str(e)}), 404
+    first = page == 0 and cursor is None
+    if first:
+        position = log_position(household)
+    data = cached_purchases_obj(household, page, cursor)
     if not data['expenses']:
-        return jsonify({'msg': 'Invalid page number.'}), 404
+        return jsonify({'msg': invalid_position(cursor)}), 404
+    if first:
+        # For anything added since, or that shows up with a lower id
+        data['links']['feed'] = feed_url(position)
+    if request.args.get('total'):
+        data['total'] = purchase_count(household)
+    response = jsonify(data)
+    response.set_etag(etag)
+    return response
+
+
+def new_purchases_query(household, ids):
+    """Return a query for the household's purchases with any of the ids."""
+    return purchase_rows(household).filter(Purchase.id.in_(ids))
+
+
+def sse_message(data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append('id: {0}'.format(event_id))
+    lines.append('data: ' + dumps(data, separators=(',', ':')))
+    return '\n'.join(lines) + '\n\n'
+
+
+# Tells the browser to reload the page, for news a feed can't send
+FEED_RELOAD = sse_message({'reload': True})
+
+
+def feed_reloads(position, ids):
+    """Return whether a feed has the browser reload, from logged_since.
+
+    That's when the log doesn't go back far enough, or there are too many
+    new purchases to add one by one.
+    """
+    return position is None or len(ids) > PER_PAGE
+
+
+def feed_message(purchases, users, position):
+    """Return a feed message with new purchases, and the balances after.
+
+    purchases are the rows of a new_purchases_query, users the
+    household's current user_totals, and position the feed's, for the
+    browser to resume from.
+    """
+    balances = user_balances(users)
+    return sse_message({
+        'expenses': expense_objs(purchases),
+        'balances': balances_obj(balances),
+        'payments': payments_obj(balances),
+    }, position)
+
+
+def feed_position():
+    """Return the feed position a stream has seen up to.
+
+    A browser sends the last one it got back in Last-Event-ID when it
+    reconnects, or the first time there's the since argument the home
+    page links to. Raise ValueError, with the message to respond with, for
+    a bad one.
+    """
+    try:
+        since = int(request.headers.get('Last-Event-ID') or
+                    request.args.get('since', ''))
+    except ValueError:
+        since = -1
+    if not 0 <= since <= MAX_ID:
+        raise ValueError('Expected the position of the feed seen.')
+    return since
+
+
+def feed_response(body):
+    return Response(body, mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # Stop proxies like nginx from holding messages back
+        'X-Accel-Buffering': 'no',
+    })
+
+
+@views.route('/expenses/stream')
+@require_household
+def expense_stream(household):
+    """Stream a household's new purchases and balances as server-sent events.
+
+    Every open stream holds one of the WSGI server's threads, so this is
+    a long poll: it ends with the first message, or after
+    FEED_POLL_TIMEOUT seconds without one, and browsers then open
+    another one. The asyncio server holds streams open for FEED_TIMEOUT.
+    """
+    try:
+        since = feed_position()
+    except ValueError as e:
+        return jsonify({'msg': str(e)}), 400
+    config = current_app.config
+    feed = current_app.feed
+
+    def stream(since):
+        # Subscribe before catching up, so nothing's missed in between
+        event = feed.subscribe(current_app.redis, household)
+        try:
+            yield 'retry: {0}\n\n'.format(FEED_RETRY)
+            deadline = time.time() + config['FEED_POLL_TIMEOUT']
+            woken = True
+            while True:
+                if woken:
+                    event.clear()
+                    pipe = current_app.redis.pipeline()
+                    queue_read_log(pipe, household, since)
+                    position, ids = logged_since(pipe.execute(), since)
+                    message = None
+                    if feed_reloads(position, ids):
+                        message = FEED_RELOAD
+                    else:
+                        purchases = ids and \
+                            new_purchases_query(household, ids).all()
+                        if purchases:
+                            message = feed_message(
+                                purchases, cached_user_totals(household),
+                                position)
+                        since = position
+                    # Don't hold on to a connection while waiting
+                    db.session.close()
+                    if message is not None:
+                        yield message
+                        return
+                else:
+                    yield ': keepalive\n\n'
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                woken = event.wait(min(config['FEED_KEEPALIVE'], remaining))
+        finally:
+            feed.unsubscribe(household, event)
+
+    return feed_response(stream_with_context(stream(since)))
+
+
+def parse_iso_date(value):
+    """Return the date in a YYYY-MM-DD argument, or None if it's unset."""
+    if not value:
+        return None
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def export_csv(batches):
+    # Python 2's csv module writes bytes
+    buf = io.BytesIO() if PY2 else io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(['id', 'user', 'name', 'price', 'date'])
+    for rows in batches:
+        for p in rows:
+            writer.writerow(encode_csv_row([
+                p.id, p.user, p.name, '{0:.2f}'.format(p.cost / 100.0),
+                '{0:%m/%d/%Y}'.format(p.date)]))
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def export_ndjson(batches):
+    for rows in batches:
+        yield ''.join(dumps({
+            'id': p.id,
+            'user': p.user,
+            'name': p.name,
+            'price': '{0:.2f}'.format(p.cost / 100.0),
+            'date': '{0:%m/%d/%Y}'.format(p.date),
+        }, separators=(',', ':')) + '\n' for p in rows)
+
+
+exporters = {
+    'csv': (export_csv, 'text/csv'),
+    'ndjson': (export_ndjson, 'application/x-ndjson'),
+}
+
+
+def purchase_filters():
+    """Return the buyer and dates an export or search is narrowed to.
+
+    Raise ValueError, with the message to respond with, for a bad one.
+    """
+    try:
+        start = parse_iso_date(request.args.get('start'))
+        end = parse_iso_date(request.args.get('end'))
+    except ValueError:
+        raise ValueError('Expected YYYY-MM-DD dates.')
+    user_id = request.args.get('user', type=int)
+    # Out of range for the database, which would only fail mid-export
+    if request.args.get('user') and user_id is None or \
+            user_id is not None and not 0 < user_id <= MAX_ID:
+        raise ValueError('Invalid user.')
+    return user_id, start, end
+
+
+@views.route('/expenses/export')
+@require_household
+def export_expenses(household):
+    fmt = request.args.get('format', 'csv')
+    if fmt not in exporters:
+        return jsonify({'msg': 'Expected a format of csv or ndjson.'}), 400
+    try:
+        user_id, start, end = purchase_filters()
+    except ValueError as e:
+        return jsonify({'msg': str(e)}), 400
+
+    query = filter_purchases(purchase_rows(household), user_id, start, end)
+    exporter, mimetype = exporters[fmt]
+    response = Response(stream_with_context(exporter(iter_batches(query))),
+                        mimetype=mimetype)
+    response.headers['Content-Disposition'] = \
+        'attachment; filename=expenses.{0}'.format(fmt)
+    return response
+
+
+@views.route('/search')
+@require_household
+def search_expenses(household):
+    text = request.args.get('q', '')
+    if not search_terms(text):
+        return jsonify({'msg': 'Expected words of at least two letters '
+                               'to search for.'}), 400
+    try:
+        user_id, start, end = purchase_filters()
+    except ValueError as e:
+        return jsonify({'msg': str(e)}), 400
+    try:
+        page = int(request.args.get('page', '0'))
+    except ValueError:
+        return jsonify({'msg': 'Invalid page number.'}), 400
+    # Past which the offset would overflow the database's integers
+    if not 0 <= page <= MAX_ID // PER_PAGE:
+        return jsonify({'msg': 'Invalid page number.'}), 400
+
+    # The extra row only tells us whether there's a next page
+    purchases = search_purchases(household, text, user_id, start, end,
+                                 page * PER_PAGE, PER_PAGE + 1)
+    data = {'expenses': expense_objs(purchases[:PER_PAGE]), 'links': {}}
+    if len(purchases) > PER_PAGE:
+        args = request.args.to_dict()
+        args['page'] = page + 1
+        data['links']['next'] = url_for('.search_expenses', _external=True,
+                                        **args)
     return jsonify(data)
 
 
+def analytics_obj(household, period, start, end):
+    names = dict(db.session.query(User.id, User.name)
+                 .filter(User.household_id == household))
+    return {
+        'period': period,
+        'start': start and start.isoformat(),
+        'end': end and end.isoformat(),
+        'spend': [{
+            'start': p_start.isoformat(),
+            'user': names.get(user_id),
+            'amount': price_filter(total),
+            'count': count,
+        } for p_start, user_id, total, count
+            in spend_report(household, period, start, end)],
+    }
+
+
+@views.route('/analytics')
+@require_household
+def analytics(household):
+    period = request.args.get('period', 'month')
+    if period not in PERIODS:
+        return jsonify({'msg': 'Expected a period of month or week.'}), 400
+    try:
+        start = parse_iso_date(request.args.get('start'))
+        end = parse_iso_date(request.args.get('end'))
+    except ValueError:
+        return jsonify({'msg': 'Expected YYYY-MM-DD dates.'}), 400
+    if start is not None and end is not None and start > end:
+        return jsonify({'msg': 'The start must be before the end.'}), 400
+    if any(d is not None and d > LAST_REPORT_DATE for d in (start, end)):
+        return jsonify({'msg': 'Expected dates up to {0}.'.format(
+            LAST_REPORT_DATE.isoformat())}), 400
+    name = 'analytics:{0}:{1}:{2}'.format(period, start, end)
+    return jsonify(response_cache.get_or_set(
+        household, name,
+        lambda: analytics_obj(household, period, start, end)))
+
+
+def household_members(household, user_ids):
+    """Return the set of the user ids that are in the household."""
+    if not user_ids:
+        return set()
+    return set(user_id for user_id, in db.session.query(User.id).filter(
+        User.id.in_(user_ids), User.household_id == household))
+
+
 @views.route('/expenses', methods=['POST'])
 @require_auth
 @check_csrf
 def add_expense():
-    valid = True
-    name = request.form.get('name')
-    if not name:
-        flash('A name is required', 'error')
-        valid = False
-    try:
-        price = int(float(request.form.get('price')) * 100)
-        if price <= 0:
-            flash('The price must be greater than $0.00', 'error')
-            valid = False
-    except (TypeError, ValueError):
-        flash('Expected a valid price', 'error')
-        valid = False
-    try:
-        p_date = datetime.strptime(request.form.get('date'), '%m/%d/%Y').date()
-    except (TypeError, ValueError):
-        flash('Expected a valid date', 'error')
-        valid = False
-    if valid:
-        purchase = Purchase(name=name, cost=price, date=p_date,
-                            user_id=session['user'])
-        db.session.add(purchase)
+    household = current_household()
+    values, errors = parse_expense(request.form.get('name'),
+                                   request.form.get('price'),
+                                   request.form.get('date'))
+    if 'participants' in request.form:
+        participants = request.form.getlist('participants')
+        weights = dict((p, request.form.get('weight-' + p))
+                       for p in participants)
+        values['shares'], share_errors = parse_shares(participants, weights)
+        user_ids = [user_id for user_id, _ in values['shares']]
+        if (not share_errors and
+                len(household_members(household, user_ids)) !=
+                len(user_ids)):
+            share_errors = ['Expected valid participants']
+        errors.extend(share_errors)
+    for error in errors:
+        flash(error, 'error')
+    if not errors:
+        values['user_id'] = session['user']
+        values['household_id'] = household
+        ids = add_purchases([values])
         db.session.commit()
-        return redirect(url_for('.home'), code=303)
-    else:
-        return redirect(url_for('.home'), code=303)
+        purchases_committed(household, 1, ids)
+    return redirect(url_for('.home'), code=303)
+
+
+def parse_batch_expense(item):
+    """Validate one expense of a batch.
+
+    Return its key, a dict of purchase columns, and a list of error
+    messages. Expenses have the same fields as the form, along with the
+    key, and optionally a list of participants and a dict of their
+    weights to split the expense between just them.
+    """
+    if not isinstance(item, dict):
+        return None, {}, ['Expected an object']
+    key = item.get('key')
+    values, errors = parse_expense(item.get('name'), item.get('price'),
+                                   item.get('date'))
+    if not isinstance(key, type(u'')) or not 0 < len(key) <= MAX_KEY:
+        key = None
+        errors.append('Expected a key of at most {0} characters'
+                      .format(MAX_KEY))
+    if 'participants' in item:
+        participants = item['participants']
+        weights = item.get('weights') or {}
+        if not isinstance(participants, list) or \
+                not isinstance(weights, dict):
+            errors.append('Expected valid participants')
+        else:
+            values['shares'], share_errors = parse_shares(
+                [type(u'')(p) for p in participants], weights)
+            errors.extend(share_errors)
+    return key, values, errors
+
+
+@views.route('/expenses/batch', methods=['POST'])
+@require_auth
+@check_csrf
+def add_expenses():
+    """Add a JSON array of expenses, all in one transaction.
+
+    Each expense has a key the client made up for it. One with a key the
+    user already added an expense under is reported as a duplicate
+    rather than added again, so a client can resend a batch it never got
+    an answer for. Valid expenses are added even if others aren't, and
+    the results are in the same order as the expenses.
+    """
+    items = request.get_json(silent=True)
+    if not isinstance(items, list) or not items:
+        return jsonify({'msg': 'Expected an array of expenses.'}), 400
+    if len(items) > MAX_BATCH:
+        return jsonify({'msg': 'Expected at most {0} expenses.'
+                               .format(MAX_BATCH)}), 400
+    household = current_household()
+    parsed = [parse_batch_expense(item) for item in items]
+    members = household_members(household, set(
+        user_id for _, values, _ in parsed
+        for user_id, _ in values.get('shares', ())))
+
+    rows = OrderedDict()
+    results = []
+    for key, values, errors in parsed:
+        if not errors and any(user_id not in members
+                              for user_id, _ in values.get('shares', ())):
+            errors = ['Expected valid participants']
+        if errors:
+            results.append({'key': key, 'status': 'invalid',
+                            'errors': errors})
+            continue
+        if key not in rows:
+            values['client_key'] = key
+            values['user_id'] = session['user']
+            values['household_id'] = household
+            rows[key] = values
+        results.append({'key': key})
+
+    retried = False
+    while True:
+        try:
+            new, ids = add_keyed_purchases(session['user'],
+                                           list(rows.values()))
+            db.session.commit()
+            break
+        except IntegrityError:
+            # Some of the keys were added by a request running at once,
+            # which the next try finds
+            db.session.rollback()
+            if retried:
+                raise
+            retried = True
+    purchases_committed(household, len(new),
+                        [ids[row['client_key']] for row in new])
+
+    created = set(row['client_key'] for row in new)
+    for result in results:
+        if 'status' not in result:
+            result['id'] = ids[result['key']]
+            # A key sent twice in the batch is only added the first time
+            result['status'] = 'created' if result['key'] in created \
+                else 'duplicate'
+            created.discard(result['key'])
+    return jsonify({'results': results})
+
+
+@views.route('/expenses/import', methods=['POST'])
+@require_auth
+@check_csrf
+def import_expenses():
+    upload = request.files.get('file')
+    if not upload:
+        return jsonify({'msg': 'A file is required.'}), 400
+    fmt = request.form.get('format') or guess_format(upload.filename)
+    if fmt not in formats:
+        return jsonify({'msg': 'Expected a CSV or JSON file.'}), 400
+    try:
+        summary = importer.import_expenses(upload.stream, fmt,
+                                           session['user'])
+    except MalformedFile as e:
+        return jsonify({'msg': 'Could not read the file: {0}'.format(e)}), 400
+    return jsonify(summary)
 
 
 @views.route('/login/')
@@ -118,10 +730,14 @@ def auth():
     password = request.form.get('password')
     user = User.query.filter_by(username=username).first()
     if user:
-        pw_hash = hashpw(password.encode(), user.password.encode()).decode()
-        if safe_str_cmp(pw_hash, user.password):
+        hasher = current_app.hasher
+        if hasher.check(password, user.password):
+            if hasher.needs_rehash(user.password):
+                user.password = hasher.hash(password)
+                db.session.commit()
             session.rotate()
             session['user'] = user.id
+            session['household'] = user.household_id
             return redirect(url_for('.home'), code=303)
         else:
             flash('Incorrect password', 'error')
@@ -132,6 +748,27 @@ def auth():
         return redirect(url_for('.login_page'), code=303)
 
 
+def signup_household(name, invite_code):
+    """Return the household a new user joins, or None for a bad invite.
+
+    An invite code joins an existing household. Without one, users join
+    the DEFAULT_HOUSEHOLD, if there is one, or else start their own.
+    """
+    if invite_code:
+        return Household.query.filter_by(invite_code=invite_code).first()
+    default = current_app.config['DEFAULT_HOUSEHOLD']
+    if default is None:
+        household = Household(name=u'{0}\'s household'.format(name))
+    else:
+        household = Household.query.get(default)
+        if household is not None:
+            return household
+        household = Household(id=default, name='Home')
+    household.invite_code = random_string(12)
+    db.session.add(household)
+    return household
+
+
 @views.route('/users', methods=['POST'])
 @require_noauth
 @check_csrf
@@ -145,12 +782,19 @@ def signup():
         name = request.form.get('name')
         username = request.form.get('username')
         password = request.form.get('password')
-        pw_hash = hashpw(password.encode(), gensalt()).decode()
-        user = User(name=name, username=username, password=pw_hash)
+        household = signup_household(name, request.form.get('invite'))
+        if household is None:
+            flash('No household has that invite code', 'error')
+            return redirect(url_for('.signup_page'), code=303)
+        pw_hash = current_app.hasher.hash(password)
+        user = User(name=name, username=username, password=pw_hash,
+                    household=household)
         db.session.add(user)
         try:
             db.session.commit()
+            response_cache.invalidate(household.id)
             session['user'] = user.id
+            session['household'] = household.id
             return redirect(url_for('.home'), code=303)
         except IntegrityError:
             flash('That username already exists', 'error')
@@ -163,3 +807,8 @@ def signup():
 def logout():
     session.clear()
     return redirect(url_for('.home'))
+
+
+@views.errorhandler(HasherBusy)
+def hasher_busy(e):
+    return html_handler(ServiceUnavailable())
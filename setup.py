@@ -32,9 +32,20 @@ setup(
         'Flask',
         'Flask-SQLAlchemy',
         'bcrypt',
+        'futures; python_version < "3"',
         'redis',
     ],
     extras_require={
+        # The asyncio server for the read endpoints, and a database driver
+        # that databases supports, like aiosqlite or asyncpg
+        'asgi': [
+            'databases; python_version >= "3.6"',
+            'redis>=4.2; python_version >= "3.6"',
+        ],
+        # Template render times are measured with Flask's signals
+        'metrics': [
+            'blinker',
+        ],
         'testing': [
             'blinker',
             'fakeredis',
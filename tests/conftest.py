@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""Shared fixtures and helpers."""
+
+from expenses.app import create_app
+from expenses.model import db, Household, User
+import fakeredis
+import pytest
+
+
+@pytest.fixture
+def config():
+    """Settings for the app, over the defaults; override to change."""
+    return {}
+
+
+@pytest.fixture
+def app(config):
+    settings = {
+        'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'BCRYPT_ROUNDS': 4,
+        'REDIS_WARM_CONNECTIONS': 0,
+    }
+    settings.update(config)
+    app = create_app(settings)
+    app.redis = fakeredis.FakeStrictRedis()
+    with app.app_context():
+        db.create_all()
+        db.session.add(Household(id=1, name='Home', invite_code='home'))
+        db.session.commit()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def loop():
+    # Only on Python 3
+    import asyncio
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def add_user(name, household_id=1):
+    user = User(name=name, username=name.lower(), password='',
+                household_id=household_id)
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def http_scope(path, query='', method='GET', headers=()):
+    return {
+        'type': 'http',
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'server': ('localhost', 80),
+        'client': ('127.0.0.1', 1234),
+        'root_path': '',
+        'path': path,
+        'query_string': query.encode(),
+        'headers': [(b'host', b'localhost')] + [
+            (k.encode(), v.encode()) for k, v in headers],
+    }
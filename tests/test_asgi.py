@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""Test the asyncio server for the read endpoints."""
+
+from conftest import http_scope
+from datetime import date, timedelta
+from expenses.feed import log_position
+from expenses.ledger import add_purchases, purchases_committed
+from expenses.model import db, Household, User, Purchase
+from expenses.views import PER_PAGE
+import fakeredis
+import json
+import pytest
+
+# Only on Python 3, with the asgi extra installed
+pytest.importorskip('redis.asyncio')
+asgi = pytest.importorskip('expenses.asgi')
+aioredis = pytest.importorskip('fakeredis.aioredis')
+asyncio = pytest.importorskip('asyncio')
+
+
+@pytest.fixture
+def asgi_app(tmpdir, loop):
+    path = str(tmpdir.join('expenses.sqlite'))
+    asgi_app = asgi.create_asgi_app({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path,
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'BCRYPT_ROUNDS': 4,
+        'REDIS_WARM_CONNECTIONS': 0,
+        'FEED_TIMEOUT': 0,
+        'FEED_POLL_TIMEOUT': 0,
+    })
+    # Both clients see the same fake server
+    server = fakeredis.FakeServer()
+    asgi_app.app.redis = fakeredis.FakeStrictRedis(server=server)
+    asgi_app.redis = aioredis.FakeRedis(server=server)
+    with asgi_app.app.app_context():
+        db.create_all()
+        db.session.add(Household(id=1, name='Home', invite_code='home'))
+        alice = User(name='Alice', username='alice', password='',
+                     household_id=1)
+        db.session.add(alice)
+        db.session.commit()
+        for i in range(PER_PAGE + 10):
+            db.session.add(Purchase(name='Purchase {0}'.format(i),
+                                    cost=100 + i, user_id=alice.id,
+                                    date=date(2015, 1, 1) +
+                                    timedelta(days=i // 3),
+                                    household_id=1))
+        db.session.commit()
+    loop.run_until_complete(asgi_app.startup())
+    yield asgi_app
+    loop.run_until_complete(asgi_app.shutdown())
+
+
+def channel(loop, body=b''):
+    """Return receive and send callables, and the sent messages.
+
+    After the request, receive waits until the disconnect future is set.
+    """
+    messages = []
+    disconnect = loop.create_future()
+    received = []
+
+    def resolved(value):
+        future = loop.create_future()
+        future.set_result(value)
+        return future
+
+    def receive():
+        if received:
+            return disconnect
+        received.append(True)
+        return resolved({'type': 'http.request', 'body': body,
+                         'more_body': False})
+
+    def send(message):
+        messages.append(message)
+        return resolved(None)
+
+    return receive, send, messages, disconnect
+
+
+def call(loop, asgi_app, path, query='', method='GET', body=b'',
+         headers=()):
+    """Return the status, headers and body of an ASGI response."""
+    receive, send, messages, _ = channel(loop, body)
+    loop.run_until_complete(asgi_app(http_scope(path, query, method, headers),
+                                     receive, send))
+    start = messages[0]
+    headers = [(k.decode(), v.decode()) for k, v in start['headers']]
+    return (start['status'], headers,
+            b''.join(m.get('body', b'') for m in messages[1:]))
+
+
+def header(headers, name):
+    values = [v for k, v in headers if k == name]
+    return values[0] if values else None
+
+
+def sign_in(asgi_app):
+    data = {'csrf': 'token', 'user': 1, 'household': 1}
+    asgi_app.app.redis.set('session:abcd', json.dumps(data))
+    return [('cookie', 'session=abcd')]
+
+
+def test_matches_flask(loop, asgi_app):
+    client = asgi_app.app.test_client()
+    headers = sign_in(asgi_app)
+    client.set_cookie('localhost', 'session', 'abcd')
+    for path, query in [('/', ''), ('/expenses', ''),
+                        ('/expenses', 'page=1&total=1'),
+                        ('/expenses', 'page=5'), ('/expenses', 'page=x'),
+                        ('/expenses', 'cursor=bad'),
+                        ('/expenses/stream', 'since=0'),
+                        ('/expenses/stream', 'since=55'),
+                        ('/expenses/stream', 'since=x')]:
+        # Once filling the cache, and once from it
+        for _ in range(2):
+            status, _, body = call(loop, asgi_app, path, query,
+                                   headers=headers)
+            rv = client.get(path + '?' + query)
+            assert status == rv.status_code
+            assert body == rv.data
+
+
+def test_expenses(loop, asgi_app):
+    headers = sign_in(asgi_app)
+    status, response_headers, body = call(loop, asgi_app, '/expenses',
+                                          headers=headers)
+    assert status == 200
+    data = json.loads(body.decode())
+    assert len(data['expenses']) == PER_PAGE
+    path, _, query = data['links']['next'].partition('?')
+    assert path == 'http://localhost/expenses'
+    status, _, body = call(loop, asgi_app, '/expenses', query,
+                           headers=headers)
+    assert len(json.loads(body.decode())['expenses']) == 10
+
+    etag = header(response_headers, 'etag')
+    status, _, body = call(loop, asgi_app, '/expenses',
+                           headers=headers + [('if-none-match', etag)])
+    assert status == 304
+    assert body == b''
+
+
+def test_session(loop, asgi_app):
+    status, headers, body = call(loop, asgi_app, '/')
+    assert status == 200
+    cookie = header(headers, 'set-cookie')
+    sid = cookie.split(';')[0].split('=', 1)[1]
+    stored = json.loads(asgi_app.app.redis.get('session:' + sid).decode())
+    assert 'value="{0}"'.format(stored['csrf']) in body.decode()
+
+    # Signed in sessions are refreshed
+    headers = sign_in(asgi_app)
+    asgi_app.app.redis.expire('session:abcd', 10)
+    call(loop, asgi_app, '/', headers=headers)
+    assert asgi_app.app.redis.ttl('session:abcd') > 10
+    assert 'invite' not in call(loop, asgi_app, '/')[2].decode()
+    assert 'home' in call(loop, asgi_app, '/', headers=headers)[2].decode()
+
+
+def test_falls_back_to_flask(loop, asgi_app):
+    headers = sign_in(asgi_app)
+    _, _, body = call(loop, asgi_app, '/expenses', headers=headers)
+    assert json.loads(body.decode())['expenses'][0]['name'] == 'Purchase 59'
+
+    form = 'token=token&name=Newest&price=1.00&date=01/01/2030'
+    status, _, _ = call(
+        loop, asgi_app, '/expenses', method='POST', body=form.encode(),
+        headers=headers + [
+            ('content-type', 'application/x-www-form-urlencoded'),
+            ('content-length', str(len(form)))])
+    assert status == 303
+    # Through the cache, which the write invalidated
+    _, _, body = call(loop, asgi_app, '/expenses', headers=headers)
+    assert json.loads(body.decode())['expenses'][0]['name'] == 'Newest'
+
+
+def test_no_household(loop, asgi_app):
+    asgi_app.app.config['DEFAULT_HOUSEHOLD'] = None
+    status, headers, _ = call(loop, asgi_app, '/expenses')
+    assert status == 303
+    assert header(headers, 'location') == 'http://localhost/login/'
+
+
+def test_stream(loop, asgi_app):
+    app = asgi_app.app
+    app.config['FEED_TIMEOUT'] = 10
+    app.config['FEED_KEEPALIVE'] = 0.01
+    receive, send, messages, disconnect = channel(loop)
+    task = loop.create_task(asgi_app(
+        http_scope('/expenses/stream', 'since=0', headers=sign_in(asgi_app)),
+        receive, send))
+
+    def body():
+        return b''.join(m.get('body', b'') for m in messages[1:]).decode()
+
+    def wait_for(text):
+        for _ in range(100):
+            if text in body():
+                return
+            loop.run_until_complete(asyncio.sleep(0.01))
+        raise AssertionError('Timed out waiting for ' + text)
+
+    wait_for(': keepalive')
+    assert messages[0]['status'] == 200
+    assert (b'content-type', b'text/event-stream; charset=utf-8') in \
+        messages[0]['headers']
+    with app.app_context():
+        ids = add_purchases([{'name': 'Live', 'cost': 100, 'user_id': 1,
+                              'date': date(2015, 1, 1),
+                              'household_id': 1}])
+        db.session.commit()
+        purchases_committed(1, 1, ids)
+        position = log_position(1)
+    wait_for('id: {0}'.format(position))
+    assert '"name":"Live"' in body()
+
+    disconnect.set_result({'type': 'http.disconnect'})
+    loop.run_until_complete(task)
+    assert not asgi_app.feed.waiters
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""Test serving the Flask app over ASGI from threads."""
+
+from conftest import http_scope
+from expenses.model import db, User
+import json
+import pytest
+import sys
+
+# Only on Python 3.6 or later, where the module parses, but without the
+# asgi extra
+if sys.version_info >= (3, 6):
+    from expenses import bridge
+else:
+    pytest.skip('expenses.bridge needs Python 3.6', allow_module_level=True)
+
+
+def resolved(loop, value):
+    future = loop.create_future()
+    future.set_result(value)
+    return future
+
+
+def call(loop, wsgi, scope, chunks):
+    """Send a request body in chunks, and return the response.
+
+    Also return how many chunks had been received when the response
+    started.
+    """
+    messages = []
+    received = []
+
+    def receive():
+        if len(received) == len(chunks):
+            # Never resolved, as there's nothing more until a disconnect
+            return loop.create_future()
+        received.append(True)
+        return resolved(loop, {'type': 'http.request',
+                               'body': chunks[len(received) - 1],
+                               'more_body': len(received) < len(chunks)})
+
+    def send(message):
+        if message['type'] == 'http.response.start':
+            message['received'] = len(received)
+        messages.append(message)
+        return resolved(loop, None)
+
+    loop.run_until_complete(wsgi(scope, receive, send))
+    start = messages[0]
+    return (start['status'], dict((k.decode(), v.decode())
+                                  for k, v in start['headers']),
+            b''.join(m.get('body', b'') for m in messages[1:]),
+            start['received'])
+
+
+def test_threaded_wsgi(app, loop):
+    app.redis.set('session:abcd', json.dumps({'csrf': 'token', 'user': 1,
+                                              'household': 1}))
+    alice = User(name='Alice', username='alice', password='',
+                 household_id=1)
+    db.session.add(alice)
+    db.session.commit()
+    wsgi = bridge.ThreadedWSGI(app, 2)
+
+    form = b'token=token&name=Soap&price=2.50&date=01/02/2015'
+    chunks = [form[:10], form[10:20], form[20:]]
+    headers = [('cookie', 'session=abcd'),
+               ('content-type', 'application/x-www-form-urlencoded'),
+               ('content-length', str(len(form)))]
+    scope = http_scope('/expenses', method='POST', headers=headers)
+    status, _, _, received = call(loop, wsgi, scope, chunks)
+    assert status == 303
+    assert received == 3
+
+    # The body's only received as the app reads it
+    scope = http_scope('/nowhere', method='POST', headers=headers)
+    status, _, _, received = call(loop, wsgi, scope, chunks)
+    assert status == 404
+    assert received == 0
+
+    status, _, body, _ = call(
+        loop, wsgi, http_scope('/expenses', headers=headers[:1]), [b''])
+    assert status == 200
+    assert json.loads(body.decode())['expenses'][0]['name'] == 'Soap'
+
+
+def test_request_body(loop):
+    chunks = [b'first\nsec', b'ond\n', b'', b'third']
+    messages = iter([{'type': 'http.request', 'body': chunk,
+                      'more_body': i < len(chunks) - 1}
+                     for i, chunk in enumerate(chunks)])
+    pulled = []
+
+    def receive():
+        pulled.append(True)
+        return resolved(loop, next(messages))
+
+    body = bridge.RequestBody(receive, loop)
+
+    def read():
+        # From another thread, as the app would
+        return [body.readline(), body.read(3), body.readline(),
+                body.read(), body.read()]
+
+    lines = loop.run_until_complete(loop.run_in_executor(None, read))
+    assert lines == [b'first\n', b'sec', b'ond\n', b'third', b'']
+    assert len(pulled) == 4
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""Test the feed of new purchases."""
+
+from datetime import date
+from expenses import feed as feed_module
+from expenses.feed import log_position
+from expenses.ledger import add_purchases, purchases_committed
+from expenses.model import db, Household, User, Purchase
+from expenses.views import PER_PAGE
+import json
+import pytest
+
+
+@pytest.fixture
+def alice(app):
+    alice = User(name='Alice', username='alice', password='', household_id=1)
+    db.session.add(alice)
+    db.session.commit()
+    return alice
+
+
+@pytest.fixture
+def feed(app):
+    yield app.feed
+    if app.feed.listener is not None:
+        app.feed.listener.stop()
+
+
+def buy(user_id, *names):
+    ids = add_purchases([{'name': name, 'cost': 100,
+                          'date': date(2015, 1, 1), 'user_id': user_id,
+                          'household_id': 1} for name in names])
+    db.session.commit()
+    purchases_committed(1, len(names), ids)
+
+
+def messages(body):
+    """Return the fields of each server-sent event in a stream."""
+    events = []
+    for block in body.split('\n\n'):
+        fields = {}
+        for line in block.splitlines():
+            name, _, value = line.partition(': ')
+            fields[name] = value
+        if 'data' in fields:
+            fields['data'] = json.loads(fields['data'])
+            events.append(fields)
+    return events
+
+
+def test_feed_link(client, alice):
+    buy(alice.id, 'Old', 'Older')
+    # Added last, but listed after the first page
+    db.session.add_all([Purchase(name='Purchase', cost=1, user_id=alice.id,
+                                 date=date(2016, 1, 1), household_id=1)
+                        for _ in range(PER_PAGE)])
+    db.session.commit()
+    db.session.add(Purchase(name='Backdated', cost=1, user_id=alice.id,
+                            date=date(2014, 1, 1), household_id=1))
+    db.session.commit()
+
+    data = json.loads(client.get('/expenses').data.decode())
+    feed = 'http://localhost/expenses/stream?since={0}'.format(
+        log_position(1))
+    assert data['links']['feed'] == feed
+    assert 'feed' not in json.loads(client.get(
+        data['links']['next']).data.decode())['links']
+    assert feed in client.get('/').data.decode()
+
+
+def test_feed_link_empty(client):
+    assert '/expenses/stream?since=0' in client.get('/').data.decode()
+
+
+def test_stream(app, client, alice):
+    # Ends with the first message, rather than waiting out the timeout
+    app.config['FEED_POLL_TIMEOUT'] = 60
+    buy(alice.id, 'First')
+    first = log_position(1)
+    db.session.add(User(name='Bob', username='bob', password='',
+                        household_id=1))
+    db.session.commit()
+    buy(alice.id, 'Second', 'Third')
+
+    rv = client.get('/expenses/stream?since={0}'.format(first))
+    assert rv.status_code == 200
+    assert rv.mimetype == 'text/event-stream'
+    assert rv.headers['Cache-Control'] == 'no-cache'
+    body = rv.data.decode()
+    assert body.startswith('retry: ')
+    event, = messages(body)
+    assert event['id'] == str(first + 1)
+    assert [e['name'] for e in event['data']['expenses']] == \
+        ['Third', 'Second']
+    assert event['data']['balances'] == [
+        {'name': 'Alice', 'balance': '$1.50', 'positive': True},
+        {'name': 'Bob', 'balance': '$-1.50', 'positive': False},
+    ]
+    assert event['data']['payments'] == [
+        {'from': 'Bob', 'to': 'Alice', 'amount': '$1.50'}]
+
+    # Browsers reconnect from the last id they got
+    app.config['FEED_POLL_TIMEOUT'] = 0
+    rv = client.get('/expenses/stream?since=0',
+                    headers={'Last-Event-ID': str(first + 1)})
+    assert messages(rv.data.decode()) == []
+
+
+def test_stream_out_of_order(app, client, alice):
+    app.config['FEED_POLL_TIMEOUT'] = 60
+
+    def commit(p_id, name):
+        db.session.add(Purchase(id=p_id, name=name, cost=100,
+                                user_id=alice.id, date=date(2015, 1, 1),
+                                household_id=1))
+        db.session.commit()
+        purchases_committed(1, 1, [p_id])
+
+    # Given id 10 first, but committed after 11 was streamed
+    commit(11, 'Later')
+    seen = log_position(1)
+    commit(10, 'Earlier')
+    event, = messages(client.get(
+        '/expenses/stream?since={0}'.format(seen)).data.decode())
+    assert [e['id'] for e in event['data']['expenses']] == [10]
+    assert event['id'] == str(seen + 1)
+
+
+def test_stream_reload(app, client, alice):
+    app.config['FEED_POLL_TIMEOUT'] = 60
+    buy(alice.id, *['Purchase {0}'.format(i) for i in range(PER_PAGE + 1)])
+    event, = messages(client.get('/expenses/stream?since=0').data.decode())
+    assert event['data'] == {'reload': True}
+    assert 'id' not in event
+
+
+def test_stream_log_lost(app, client, alice, monkeypatch):
+    app.config['FEED_POLL_TIMEOUT'] = 0
+    monkeypatch.setattr(feed_module, 'LOG_COMMITS', 2)
+    alice_id = alice.id
+
+    def stream(since):
+        return messages(client.get(
+            '/expenses/stream?since={0}'.format(since)).data.decode())
+
+    assert stream(0) == []
+    buy(alice_id, 'First')
+    first = log_position(1)
+    buy(alice_id, 'Second', 'Third')
+    buy(alice_id, 'Fourth')
+    event, = stream(first)
+    assert len(event['data']['expenses']) == 3
+    # Past the end of the log, or from before it kept track
+    buy(alice_id, 'Fifth')
+    assert stream(first) == [{'data': {'reload': True}}]
+    assert stream(0) == [{'data': {'reload': True}}]
+    assert stream(log_position(1) + 1) == [{'data': {'reload': True}}]
+    app.redis.flushall()
+    assert stream(first + 2) == [{'data': {'reload': True}}]
+
+
+def test_stream_position(client):
+    for query in ('', '?since=', '?since=x', '?since=-1',
+                  '?since={0}'.format(10 ** 30)):
+        rv = client.get('/expenses/stream' + query)
+        assert rv.status_code == 400
+        data = json.loads(rv.data.decode())
+        assert data['msg'] == 'Expected the position of the feed seen.'
+
+
+def test_stream_live(app, client, alice, feed):
+    app.config['FEED_POLL_TIMEOUT'] = 10
+    app.config['FEED_KEEPALIVE'] = 0.01
+    alice_id = alice.id
+    rv = client.get('/expenses/stream?since=0', buffered=False)
+    stream = iter(rv.response)
+    try:
+        assert next(stream).startswith(b'retry: ')
+        assert next(stream) == b': keepalive\n\n'
+        buy(alice_id, 'Live')
+        chunk = next(stream)
+        while chunk == b': keepalive\n\n':
+            chunk = next(stream)
+        event, = messages(chunk.decode())
+        assert event['data']['expenses'][0]['name'] == 'Live'
+        # A long poll, that frees its thread once there's news
+        assert next(stream, None) is None
+    finally:
+        rv.close()
+    assert not feed.waiters
+
+
+def test_feed(app, alice, feed):
+    db.session.add(Household(id=2, name='Other', invite_code='other'))
+    db.session.commit()
+    home = feed.subscribe(app.redis, 1)
+    other = feed.subscribe(app.redis, 2)
+    buy(alice.id, 'Purchase')
+    assert home.wait(5)
+    assert not other.is_set()
+
+    feed.unsubscribe(1, home)
+    feed.unsubscribe(2, other)
+    assert not feed.waiters
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""Test password hashing."""
+
+from expenses.hashing import Hasher, HasherBusy, hash_rounds
+import pytest
+import threading
+
+
+def test_hash():
+    hasher = Hasher(rounds=4)
+    pw_hash = hasher.hash('hunter2')
+    assert pw_hash.startswith('$2b$04$')
+    assert hash_rounds(pw_hash) == 4
+    assert hasher.check('hunter2', pw_hash)
+    assert not hasher.check('hunter3', pw_hash)
+
+    assert not hasher.needs_rehash(pw_hash)
+    assert Hasher(rounds=5).needs_rehash(pw_hash)
+
+
+def test_busy():
+    hasher = Hasher(rounds=4, workers=1, max_pending=2)
+    started = threading.Semaphore(0)
+    release = threading.Event()
+
+    def block():
+        started.release()
+        release.wait()
+        return 'done'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        hasher.run(block))) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    # One is running, and the other is queued behind it
+    started.acquire()
+
+    with pytest.raises(HasherBusy):
+        hasher.hash('hunter2')
+
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert results == ['done', 'done']
+    assert hasher.check('hunter2', hasher.hash('hunter2'))
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""Test bulk imports."""
+
+from datetime import date
+from expenses.importer import MalformedFile, guess_format, import_expenses, \
+    iter_json
+from expenses.model import db, User, Purchase, UserTotal
+import io
+import pytest
+
+
+@pytest.fixture
+def user(app):
+    user = User(name='Alice', username='alice', password='', household_id=1)
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def test_guess_format():
+    assert guess_format('export.CSV') == 'csv'
+    assert guess_format('export.json') == 'json'
+    assert guess_format('export.ndjson') == 'json'
+    assert guess_format('export.xls') is None
+    assert guess_format(None) is None
+
+
+@pytest.mark.parametrize('text', [
+    u'[{"a": 1}, {"a": 2.5}, [3], 4]',
+    u'  [ {"a": 1} ,{"a": 2.5},[3],\n4 ]  ',
+    u'{"a": 1}\n{"a": 2.5}\n[3]\n4\n',
+    u'{"a": 1} {"a": 2.5} [3] 4',
+])
+def test_iter_json(text):
+    for chunk_size in (1, 2, 3, 1024):
+        values = list(iter_json(io.StringIO(text), chunk_size))
+        assert values == [{'a': 1}, {'a': 2.5}, [3], 4]
+
+
+@pytest.mark.parametrize('text', [u'[{"a": 1}', u'{"a": 1}\n{"a"', u'[1, }'])
+def test_iter_json_malformed(text):
+    with pytest.raises(MalformedFile):
+        list(iter_json(io.StringIO(text), 2))
+
+
+def test_import_csv(user):
+    data = (u'﻿name,price,date\n'
+            u'Trader Joe\'s,34.17,01/02/2015\n'
+            u'"Rent, January",1200,01/01/2015\n'
+            u',5,01/01/2015\n'
+            u'Soap,free,2015-01-01\n'
+            u'Café,3.50,01/03/2015\n').encode('utf-8')
+    summary = import_expenses(io.BytesIO(data), 'csv', user.id, batch_size=2)
+    assert summary == {
+        'imported': 3,
+        'failed': 2,
+        'errors': [
+            {'row': 3, 'errors': ['A name is required']},
+            {'row': 4, 'errors': ['Expected a valid price',
+                                  'Expected a valid date']},
+        ],
+    }
+    purchases = Purchase.query.order_by(Purchase.date).all()
+    assert [(p.name, p.cost, p.date) for p in purchases] == [
+        (u'Rent, January', 120000, date(2015, 1, 1)),
+        (u'Trader Joe\'s', 3417, date(2015, 1, 2)),
+        (u'Café', 350, date(2015, 1, 3)),
+    ]
+    assert db.session.query(UserTotal.total).scalar() == 123767
+
+
+def test_import_json(user):
+    data = (b'[{"name": "Soap", "price": 2.5, "date": "01/02/2015"},'
+            b' "oops", {"name": "Tea", "price": "0", "date": "01/02/2015"}]')
+    summary = import_expenses(io.BytesIO(data), 'json', user.id,
+                              max_errors=1)
+    assert summary == {
+        'imported': 1,
+        'failed': 2,
+        'errors': [{'row': 2, 'errors': ['Expected an object']}],
+    }
+    assert Purchase.query.one().cost == 250
+
+
+def test_import_malformed(user):
+    data = b'{"name": "Soap", "price": 2.5, "date": "01/02/2015"}\n{"nam'
+    with pytest.raises(MalformedFile):
+        import_expenses(io.BytesIO(data), 'json', user.id, batch_size=1)
+    assert Purchase.query.count() == 0
+    assert UserTotal.query.count() == 0
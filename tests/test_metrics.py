@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Test request instrumentation."""
+
+from expenses.metrics import Histogram, server_timing
+from expenses.model import db, User
+from expenses.pool import RedisPool
+import fakeredis
+import json
+import pytest
+import re
+
+
+@pytest.fixture
+def config():
+    return {'METRICS': True}
+
+
+@pytest.fixture
+def metrics_client(app, client):
+    db.session.add(User(name='Alice', username='alice', household_id=1,
+                        password=app.hasher.hash('hunter2')))
+    db.session.commit()
+    return client
+
+
+def sample(text, name, **labels):
+    label_text = ','.join('{0}="{1}"'.format(k, v)
+                          for k, v in sorted(labels.items()))
+    match = re.search(r'^{0}\{{{1}\}} (\S+)$'.format(
+        re.escape(name), re.escape(label_text)), text, re.M)
+    return float(match.group(1)) if match else None
+
+
+def test_histogram():
+    histogram = Histogram((0.1, 1))
+    for value in (0.05, 0.1, 0.5, 2):
+        histogram.observe(value)
+    assert list(histogram.cumulative()) == [(0.1, 2), (1, 3), ('+Inf', 4)]
+    assert histogram.sum == 2.65
+
+
+def test_server_timing():
+    assert server_timing({'sql': [0.0012, 3]}, 0.005) == \
+        'sql;dur=1.20;desc="3 statements", total;dur=5.00'
+
+
+def test_request_metrics(metrics_client):
+    client = metrics_client
+    client.application.redis.set('session:abcd', json.dumps({
+        'csrf': 'token',
+    }))
+    client.set_cookie('localhost', 'session', 'abcd')
+    rv = client.get('/')
+    timing = rv.headers['Server-Timing']
+    assert re.search(r'sql;dur=[\d.]+;desc="\d+ statements"', timing)
+    assert 'redis;dur=' in timing and 'desc="2 commands"' in timing
+    assert 'render;dur=' in timing and 'desc="1 templates"' in timing
+    assert timing.split(', ')[-1].startswith('total;dur=')
+
+    rv = client.post('/auth', data={
+        'token': 'token',
+        'username': 'alice',
+        'password': 'hunter2',
+    })
+    assert 'bcrypt;dur=' in rv.headers['Server-Timing']
+
+    rv = client.get('/metrics')
+    assert rv.mimetype == 'text/plain'
+    text = rv.data.decode()
+    latency = 'expenses_request_duration_seconds'
+    assert sample(text, latency + '_count', endpoint='views.home') == 1
+    assert sample(text, latency + '_bucket', endpoint='views.home',
+                  le='+Inf') == 1
+    assert sample(text, 'expenses_sql_statements_total',
+                  endpoint='views.home') >= 2
+    # Loading the session, then saving it
+    assert sample(text, 'expenses_redis_commands_total',
+                  endpoint='views.home') == 3
+    assert sample(text, 'expenses_bcrypt_hashes_total',
+                  endpoint='views.auth') == 1
+    assert sample(text, 'expenses_render_templates_total',
+                  endpoint='views.home') == 1
+    assert sample(text, 'expenses_response_cache_total',
+                  result='miss') == 2
+    assert sample(text, 'expenses_redis_pool_connections',
+                  state='max') == 50
+    assert '# TYPE {0} histogram'.format(latency) in text
+
+
+def test_redis_stats(metrics_client):
+    app = metrics_client.application
+    app.redis_pool = RedisPool('redis://localhost',
+                               connection_class=fakeredis.FakeConnection,
+                               server=fakeredis.FakeServer(), warm=1)
+    app.redis_pool.warm()
+    rv = metrics_client.get('/stats/redis')
+    assert json.loads(rv.data.decode()) == {
+        'max': 50,
+        'created': 1,
+        'idle': 1,
+        'in_use': 0,
+    }
+
+
+@pytest.mark.parametrize('config', [{}])  # Without METRICS
+def test_disabled(app, client):
+    rv = client.get('/')
+    assert 'Server-Timing' not in rv.headers
+    assert client.get('/metrics').status_code == 404
+    assert client.get('/stats/redis').status_code == 404
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""Test schema migrations."""
+
+from expenses.migrations import upgrade, schema_version, migrations
+from expenses.model import db
+import sqlalchemy
+
+
+def index_names(engine, table):
+    indexes = sqlalchemy.inspect(engine).get_indexes(table)
+    return set(index['name'] for index in indexes)
+
+
+def test_fresh_database():
+    engine = sqlalchemy.create_engine('sqlite://')
+    assert schema_version(engine) is None
+    assert upgrade(engine) == []
+    assert schema_version(engine) == len(migrations)
+    tables = set(sqlalchemy.inspect(engine).get_table_names())
+    # Along with the search index, and its shadow tables
+    assert 'purchase_fts' in tables
+    assert set(t for t in tables if not t.startswith('purchase_fts')) == \
+        set(db.metadata.tables) | set(['schema_version'])
+
+
+def test_existing_database():
+    engine = sqlalchemy.create_engine('sqlite://')
+    # The schema as it was before migrations
+    engine.execute('CREATE TABLE user (id INTEGER PRIMARY KEY, '
+                   'name VARCHAR(254), username VARCHAR(254) UNIQUE, '
+                   'password VARCHAR(60))')
+    engine.execute('CREATE TABLE purchase (id INTEGER PRIMARY KEY, '
+                   'name VARCHAR(254), user_id INTEGER REFERENCES user(id), '
+                   'cost INTEGER, date DATE)')
+    engine.execute("INSERT INTO user VALUES (1, 'Alice', 'alice', ''), "
+                   "(2, 'Bob', 'bob', '')")
+    engine.execute("INSERT INTO purchase VALUES (1, 'A', 1, 100, "
+                   "'2015-01-01'), (2, 'B', 1, 250, '2015-01-02')")
+    assert schema_version(engine) == 0
+
+    assert upgrade(engine) == ['add_user_totals', 'add_purchase_indexes',
+                               'add_purchase_shares', 'add_households',
+                               'add_spend_rollups', 'add_purchase_search',
+                               'add_purchase_client_keys',
+                               'add_household_search']
+    assert schema_version(engine) == len(migrations)
+    assert index_names(engine, 'purchase') == set([
+        'ix_purchase_household_date_id',
+        'ix_purchase_household_id',
+        'ix_purchase_user_id',
+        'ix_purchase_user_id_client_key',
+    ])
+    # Everyone starts out in the same household
+    households = engine.execute('SELECT id, name FROM household')
+    assert [tuple(row) for row in households] == [(1, 'Home')]
+    users = engine.execute('SELECT household_id FROM user')
+    assert [row[0] for row in users] == [1, 1]
+    purchases = engine.execute('SELECT household_id FROM purchase')
+    assert [row[0] for row in purchases] == [1, 1]
+    rollups = engine.execute('SELECT period, start, total, count '
+                             'FROM spend_rollup ORDER BY period')
+    assert [tuple(row) for row in rollups] == [
+        ('month', '2015-01-01', 350, 2),
+        ('week', '2014-12-29', 350, 2),
+    ]
+    totals = engine.execute('SELECT user_id, total, owed FROM user_total')
+    assert [tuple(row) for row in totals] == [(1, 350, 0), (2, 0, 0)]
+    found = engine.execute("SELECT rowid FROM purchase_fts "
+                           "WHERE purchase_fts MATCH 'b'")
+    assert [row[0] for row in found] == [2]
+
+    assert upgrade(engine) == []
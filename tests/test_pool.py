@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""Test the redis connection pool."""
+
+from expenses.app import create_app
+from expenses.pool import RedisPool
+from redis import ConnectionError
+import fakeredis
+import json
+import os
+import pytest
+
+
+def fake_pool(**kwargs):
+    return RedisPool('redis://localhost',
+                     connection_class=fakeredis.FakeConnection,
+                     server=fakeredis.FakeServer(), **kwargs)
+
+
+def test_warm():
+    pool = fake_pool(max_connections=3, warm=2)
+    assert pool.stats() == {'max': 3, 'created': 0, 'idle': 0, 'in_use': 0}
+    assert pool.warm() == 2
+    assert pool.stats() == {'max': 3, 'created': 2, 'idle': 2, 'in_use': 0}
+
+    # Warm connections are used before any new ones are opened
+    pool.client.set('a', 1)
+    connection = pool.pool.get_connection('GET')
+    assert pool.stats() == {'max': 3, 'created': 2, 'idle': 1, 'in_use': 1}
+    pool.pool.release(connection)
+
+    pool.after_fork()
+    assert pool.stats() == {'max': 3, 'created': 2, 'idle': 2, 'in_use': 0}
+    assert pool.client.get('a') == b'1'
+
+
+def test_unreachable():
+    pool = RedisPool('redis://localhost:1', warm=2,
+                     socket_connect_timeout=0.1)
+    assert pool.warm() == 0
+    assert pool.stats()['in_use'] == 0
+
+
+def test_exhausted():
+    pool = fake_pool(max_connections=2, timeout=0.01)
+    held = [pool.pool.get_connection('GET') for _ in range(2)]
+    assert pool.stats()['in_use'] == 2
+    with pytest.raises(ConnectionError):
+        pool.client.get('a')
+    for connection in held:
+        pool.pool.release(connection)
+    assert pool.client.get('a') is None
+
+
+@pytest.mark.skipif(not hasattr(os, 'register_at_fork'),
+                    reason='needs os.register_at_fork')
+def test_fork():
+    pool = fake_pool(warm=1)
+    pool.client.ping()
+    parent = pool.pool._connections[0]
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            stats = pool.stats()
+            stats['shared'] = parent in pool.pool._connections
+            os.write(write, json.dumps(stats).encode())
+        finally:
+            os._exit(0)
+    os.close(write)
+    os.waitpid(pid, 0)
+    child = json.loads(os.read(read, 1024).decode())
+    os.close(read)
+    assert child == {'max': 50, 'created': 1, 'idle': 1, 'in_use': 0,
+                     'shared': False}
+    assert pool.pool._connections == [parent]
+
+
+def test_warm_on_first_request(app, client):
+    app.redis_pool = fake_pool(warm=2)
+    assert app.redis_pool.stats()['created'] == 0
+    client.get('/')
+    assert app.redis_pool.stats()['created'] == 2
+
+
+def test_create_app_does_not_connect():
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'REDIS_URL': 'redis://localhost:1',
+        'REDIS_WARM_CONNECTIONS': 2,
+    })
+    assert app.redis_pool.stats()['created'] == 0
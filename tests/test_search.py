@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""Test searching purchases by name."""
+
+from conftest import add_user
+from datetime import date, timedelta
+from expenses.ledger import add_purchases, purchases_committed
+from expenses.model import db, Household, Purchase
+from expenses.search import search_terms, search_purchases, rebuild_index
+from expenses.views import PER_PAGE
+import json
+import pytest
+
+
+@pytest.fixture(params=['sqlite', 'redis'])
+def backend(app, request):
+    app.config['SEARCH_BACKEND'] = request.param
+    app.extensions.pop('search_backend', None)
+    return request.param
+
+
+def buy(user, *names, **kw):
+    p_date = kw.get('p_date', date(2015, 1, 1))
+    ids = add_purchases([{
+        'name': name,
+        'cost': 100,
+        'date': p_date + timedelta(days=i),
+        'user_id': user.id,
+        'household_id': user.household_id,
+    } for i, name in enumerate(names)])
+    db.session.commit()
+    purchases_committed(user.household_id, len(names), ids)
+
+
+def found(household, text, **kw):
+    return [p.name for p in search_purchases(household, text, **kw)]
+
+
+def search(client, query):
+    rv = client.get('/search?' + query)
+    return rv.status_code, json.loads(rv.data.decode())
+
+
+def test_search_terms():
+    assert search_terms(u"Trader Joe's Caf\xe9") == \
+        ['trader', 'joe', 'cafe']
+    assert search_terms(u'a b_c') == []
+    assert search_terms(u'x' * 30) == ['x' * 20]
+
+
+def test_search(app, backend):
+    db.session.add(Household(id=2, name='Other'))
+    alice = add_user('Alice')
+    bob = add_user('Bob')
+    carol = add_user('Carol', household_id=2)
+    buy(alice, u"Trader Joe's", u'Groceries', u'Caf\xe9 Noir')
+    buy(bob, u"Trader Joe's wine", u'Trader Vic', p_date=date(2015, 2, 1))
+    buy(carol, u"Trader Joe's")
+
+    assert sorted(found(1, u'trader joe')) == \
+        [u"Trader Joe's", u"Trader Joe's wine"]
+    assert sorted(found(1, u'TRA')) == \
+        [u"Trader Joe's", u"Trader Joe's wine", u'Trader Vic']
+    assert found(1, u'cafe') == [u'Caf\xe9 Noir']
+    assert found(1, u'trader groceries') == []
+    assert found(1, u'a') == []
+    assert found(2, u'trader') == [u"Trader Joe's"]
+
+    assert sorted(found(1, u'trader', user_id=bob.id)) == \
+        [u"Trader Joe's wine", u'Trader Vic']
+    assert found(1, u'trader', start=date(2015, 2, 2)) == [u'Trader Vic']
+    assert found(1, u'trader', end=date(2015, 1, 1)) == [u"Trader Joe's"]
+    assert found(1, u'trader', user_id=alice.id,
+                 start=date(2015, 2, 1)) == []
+
+
+def test_search_ranking(app):
+    alice = add_user('Alice')
+    buy(alice, u'Joe', u'Joe and friends, at the old place downtown', u'Joe')
+    names = found(1, u'joe')
+    assert names[:2] == [u'Joe', u'Joe']
+    # Equally good matches come newest first
+    rows = search_purchases(1, u'joe')
+    assert rows[0].date > rows[1].date
+
+
+def test_redis_catches_up(app):
+    app.config['SEARCH_BACKEND'] = 'redis'
+    alice = add_user('Alice')
+    buy(alice, u'Trader Joe')
+    # Added without going through the ledger
+    db.session.add(Purchase(name=u'Trader Vic', cost=100, user_id=alice.id,
+                            date=date(2015, 3, 1), household_id=1))
+    db.session.commit()
+    assert found(1, u'trader') == [u'Trader Vic', u'Trader Joe']
+
+    app.redis.flushall()
+    assert rebuild_index() == 2
+    assert app.redis.get('search:1:indexed') == b'2'
+    assert found(1, u'vic') == [u'Trader Vic']
+
+
+def test_redis_out_of_order(app):
+    app.config['SEARCH_BACKEND'] = 'redis'
+    alice = add_user('Alice')
+
+    def commit(p_id, name):
+        db.session.add(Purchase(id=p_id, name=name, cost=100,
+                                user_id=alice.id, date=date(2015, 1, 1),
+                                household_id=1))
+        db.session.commit()
+        purchases_committed(1, 1, [p_id])
+
+    # Given id 10 first, but committed after 11, and a search in between
+    commit(11, u'Trader Vic')
+    assert found(1, u'trader') == [u'Trader Vic']
+    commit(10, u'Trader Joe')
+    assert found(1, u'trader') == [u'Trader Vic', u'Trader Joe']
+
+
+def test_add_purchases_ids(app):
+    alice = add_user('Alice')
+    ids = add_purchases([{
+        'name': name, 'cost': 100, 'date': date(2015, 1, 1),
+        'user_id': alice.id, 'household_id': 1,
+        'shares': [(alice.id, 1)] if name == 'Shared' else None,
+    } for name in ('Plain', 'Shared', 'Other')])
+    db.session.commit()
+    assert sorted(ids) == [p.id for p in Purchase.query.order_by('id')]
+
+
+def test_fts_query_plan(app):
+    sql = ("EXPLAIN QUERY PLAN SELECT purchase.id FROM purchase "
+           "JOIN purchase_fts ON purchase_fts.rowid = purchase.id "
+           "WHERE purchase_fts MATCH 'tra*' AND purchase.household_id = 1")
+    details = ' '.join(row[-1] for row in db.session.execute(sql))
+    assert 'VIRTUAL TABLE INDEX' in details
+    assert 'SCAN purchase ' not in details + ' '
+
+
+def test_fts_households(app):
+    db.session.add(Household(id=12, name='Other'))
+    alice = add_user('Alice')
+    carol = add_user('Carol', household_id=12)
+    buy(alice, u'Trader Joe', u'Flat 12')
+    buy(carol, u'Trader Joe')
+    # Only household 12's purchases match, and not for their names
+    rows = db.session.execute("SELECT rowid FROM purchase_fts "
+                              "WHERE purchase_fts MATCH "
+                              "'household_id : \"12\"'")
+    assert [row[0] for row in rows] == [3]
+    assert found(12, u'12') == []
+    assert found(1, u'12') == [u'Flat 12']
+
+
+def test_search_view(client, backend):
+    alice = add_user('Alice')
+    buy(alice, *[u'Coffee {0}'.format(i) for i in range(PER_PAGE + 5)])
+    buy(alice, u'Tea')
+
+    status, data = search(client, 'q=tea')
+    assert status == 200
+    assert data['expenses'] == [{
+        'id': PER_PAGE + 6,
+        'user': 'Alice',
+        'name': 'Tea',
+        'price': '$1.00',
+        'date': 'January 2015',
+        'iso_date': '2015-01-01',
+    }]
+    assert data['links'] == {}
+
+    status, data = search(client, 'q=coffee&user={0}'.format(alice.id))
+    assert len(data['expenses']) == PER_PAGE
+    next_url = data['links']['next']
+    assert 'page=1' in next_url and 'q=coffee' in next_url
+    rv = client.get(next_url)
+    assert rv.status_code == 200
+    data = json.loads(rv.data.decode())
+    assert len(data['expenses']) == 5
+    assert data['links'] == {}
+
+    for query in ('', 'q=a', 'q=tea&start=yesterday', 'q=tea&user=alice',
+                  'q=tea&user=0', 'q=tea&user={0}'.format(10 ** 30),
+                  'q=tea&page=-1', 'q=tea&page=x',
+                  'q=tea&page={0}'.format(10 ** 30)):
+        status, data = search(client, query)
+        assert status == 400
@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
 """Test session."""
 
-from expenses.session import LazyRedisSessionInterface
+from expenses.session import LazyRedisSessionInterface, JSONSerializer, \
+    BinarySerializer, SessionCache
+from expenses.util import random_string
 import fakeredis
 import flask
 import json
 import pytest
+import redis
+import time
 
 
 @pytest.fixture
@@ -178,3 +182,172 @@ def test_rotate_new_session(client):
     db_d = json.loads(session_data.decode())
     assert len(db_d['csrf']) == 64
     assert db_d['a'] == 'b'
+
+
+def count_round_trips(client, monkeypatch):
+    calls = []
+    db = client.application.redis
+    execute_command = db.execute_command
+    pipeline_execute = redis.client.Pipeline.execute
+
+    def counted_command(*args, **kwargs):
+        calls.append(args[0])
+        return execute_command(*args, **kwargs)
+
+    def counted_pipeline(self, *args, **kwargs):
+        calls.append(tuple(c[0][0] for c in self.command_stack))
+        return pipeline_execute(self, *args, **kwargs)
+
+    monkeypatch.setattr(db, 'execute_command', counted_command)
+    monkeypatch.setattr(redis.client.Pipeline, 'execute', counted_pipeline)
+    return calls
+
+
+def test_save_pipelined(client, monkeypatch):
+    client.set_cookie('localhost', 'session', 'abcd')
+    calls = count_round_trips(client, monkeypatch)
+    rv = client.post('/rotate')
+    assert rv.status_code == 200
+    assert calls == [('GET', 'TTL'), ('DEL', 'SETEX')]
+
+
+def test_refresh_throttle(client, monkeypatch):
+    db = client.application.redis
+    client.application.config['SESSION_REFRESH_THROTTLE'] = 60 * 60
+    client.set_cookie('localhost', 'session', 'abcd')
+
+    # Refreshed 30 minutes ago, so the expiry is left alone
+    db.expire('session:abcd', 24 * 60 * 60 - 30 * 60)
+    calls = count_round_trips(client, monkeypatch)
+    rv = client.get('/')
+    assert rv.status_code == 200
+    assert calls == [('GET', 'TTL')]
+    assert db.ttl('session:abcd') <= 24 * 60 * 60 - 30 * 60
+    assert 'session=abcd' in rv.headers['Set-Cookie']
+
+    # Refreshed 2 hours ago
+    db.expire('session:abcd', 22 * 60 * 60)
+    rv = client.get('/')
+    assert db.ttl('session:abcd') > 23 * 60 * 60
+
+    # Modified sessions are always written
+    db.expire('session:abcd', 24 * 60 * 60 - 30 * 60)
+    rv = client.put('/update', headers={'Content-Type': 'application/json'},
+                    data='{"a":"c"}')
+    assert json.loads(db.get('session:abcd').decode())['a'] == 'c'
+    assert db.ttl('session:abcd') > 23 * 60 * 60
+
+
+@pytest.mark.parametrize('data', [
+    {},
+    {'csrf': random_string(64)},
+    {'csrf': random_string(64), 'user': 12, '_permanent': True},
+    {'csrf': 'not a token', 'a': [1, 'b']},
+    {'csrf': 'somecsrf', 'a': 'b'},
+])
+def test_binary_serializer(data):
+    serializer = BinarySerializer()
+    encoded = serializer.dumps(data)
+    assert serializer.loads(encoded) == data
+    # Sessions written as JSON still decode
+    assert serializer.loads(JSONSerializer().dumps(data)) == data
+
+
+def test_binary_serializer_size():
+    data = {'csrf': random_string(64), 'user': 12}
+    binary = BinarySerializer().dumps(data)
+    assert len(binary) == 2 + 48 + len(b'{"user":12}')
+    assert len(binary) < len(JSONSerializer().dumps(data))
+
+
+def test_binary_session(client):
+    client.application.session_interface = LazyRedisSessionInterface(
+        BinarySerializer())
+    client.set_cookie('localhost', 'session', 'abcd')
+    rv = client.put('/update', headers={'Content-Type': 'application/json'},
+                    data='{"a":"c"}')
+    data = json.loads(rv.data.decode())
+    assert data['data'] == {'csrf': 'somecsrf', 'a': 'c'}
+
+    csrf = random_string(64)
+    rv = client.put('/update', headers={'Content-Type': 'application/json'},
+                    data=json.dumps({'csrf': csrf}))
+    stored = client.application.redis.get('session:abcd')
+    assert stored.startswith(b'\x01\x30')
+    rv = client.get('/')
+    data = json.loads(rv.data.decode())
+    assert data['data'] == {'csrf': csrf, 'a': 'c'}
+
+
+def test_session_cache(client, monkeypatch):
+    cache = SessionCache(maxsize=2, ttl=5)
+    client.application.session_interface = LazyRedisSessionInterface(
+        cache=cache)
+    db = client.application.redis
+    client.set_cookie('localhost', 'session', 'abcd')
+
+    rv = client.get('/')
+    calls = count_round_trips(client, monkeypatch)
+    rv = client.get('/')
+    assert json.loads(rv.data.decode())['data']['a'] == 'b'
+    assert calls == [('EXPIRE',)]
+
+    # Writes go through to the cache, and are announced
+    del calls[:]
+    rv = client.put('/update', headers={'Content-Type': 'application/json'},
+                    data='{"a":"c"}')
+    assert calls == [('SETEX', 'PUBLISH')]
+    db.set('session:abcd', '{"csrf": "somecsrf", "a": "d"}')
+    rv = client.get('/')
+    assert json.loads(rv.data.decode())['data']['a'] == 'c'
+
+    # Another process changed it
+    cache.on_message({'data': b'other:abcd'})
+    rv = client.get('/')
+    assert json.loads(rv.data.decode())['data']['a'] == 'd'
+
+    # Our own announcements are ignored
+    cache.on_message({'data': cache.token.encode() + b':abcd'})
+    assert cache.get('abcd') is not None
+
+    rv = client.post('/logout')
+    assert cache.get('abcd') is None
+
+
+def test_session_cache_expiry(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('time.time', lambda: now[0])
+    cache = SessionCache(maxsize=2, ttl=5)
+
+    cache.set('a', {'x': [1]}, 100)
+    cache.set('b', {}, -1)
+    data, ttl = cache.get('a')
+    data['x'].append(2)
+    now[0] += 3
+    assert cache.get('a') == ({'x': [1]}, 97)
+    assert cache.get('b') == ({}, -1)
+
+    # 'a' was used least recently
+    cache.set('c', {}, 100)
+    assert cache.get('a') is None
+    assert cache.get('b') is not None
+
+    now[0] += 3
+    assert cache.get('b') is None
+    assert cache.get('c') is not None
+
+
+def test_session_cache_listen():
+    db = fakeredis.FakeStrictRedis()
+    cache = SessionCache()
+    cache.listen(db)
+    try:
+        cache.set('abcd', {}, 100)
+        db.publish(SessionCache.channel, 'other:abcd')
+        for _ in range(50):
+            if cache.get('abcd') is None:
+                break
+            time.sleep(0.01)
+        assert cache.get('abcd') is None
+    finally:
+        cache.listener.stop()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""Test settling up."""
+
+from collections import defaultdict
+from expenses.ledger import split_cost
+from expenses.settlement import equal_shares, net_balances, settle
+import random
+
+
+def apply_payments(balances, payments):
+    result = defaultdict(int, balances)
+    for payer, payee, amount in payments:
+        assert amount > 0
+        result[payer] += amount
+        result[payee] -= amount
+    return result
+
+
+def test_equal_shares():
+    assert equal_shares([]) == []
+    assert equal_shares([('a', 900), ('b', 0), ('c', 300)]) == \
+        [('a', 500), ('b', -400), ('c', -100)]
+    # 1000 cents don't split evenly three ways
+    assert equal_shares([('a', 1000), ('b', 0), ('c', 0)]) == \
+        [('a', 666), ('b', -333), ('c', -333)]
+
+
+def test_net_balances():
+    assert net_balances([]) == []
+    # Alice's 900 was split between Bob and Carol; Carol's 300 by everyone
+    assert net_balances([('a', 900, 0), ('b', 0, 450), ('c', 300, 450)]) == \
+        [('a', 800), ('b', -550), ('c', -250)]
+
+
+def test_split_cost():
+    assert split_cost(900, [(1, 1), (2, 2)]) == [(1, 300), (2, 600)]
+    assert split_cost(1000, [(1, 1), (2, 1), (3, 1)]) == \
+        [(1, 334), (2, 333), (3, 333)]
+    # 3 * 100 / 7 = 42.86 and 4 * 100 / 7 = 57.14
+    assert split_cost(100, [(1, 3), (2, 4)]) == [(1, 43), (2, 57)]
+    assert split_cost(0, [(1, 1), (2, 1)]) == [(1, 0), (2, 0)]
+
+
+def test_settle():
+    assert settle([]) == []
+    assert settle([('a', 0), ('b', 0)]) == []
+    assert settle([('a', 500), ('b', -400), ('c', -100)]) == \
+        [('b', 'a', 400), ('c', 'a', 100)]
+    # Exact matches are paired off first
+    assert sorted(settle([('a', 7), ('b', 3), ('c', -3), ('d', -7)])) == \
+        [('c', 'b', 3), ('d', 'a', 7)]
+
+
+def test_settle_random():
+    rng = random.Random(0)
+    for n in (2, 3, 10, 100):
+        for _ in range(20):
+            balances = equal_shares([(i, rng.randint(0, 10000))
+                                     for i in range(n)])
+            payments = settle(balances)
+            assert len(payments) <= n - 1
+            assert set(apply_payments(dict(balances), payments).values()) \
+                <= set([0])
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""Test compiled template caching."""
+
+from expenses.app import create_app
+from expenses.model import db, Household
+from expenses.templating import RedisBytecodeCache, precompile_templates
+import fakeredis
+import jinja2
+import pytest
+
+
+TEMPLATES = 6
+
+
+def make_app(redis, **config):
+    config.update({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'REDIS_WARM_CONNECTIONS': 0,
+    })
+    app = create_app(config)
+    app.redis = redis
+    return app
+
+
+def render_home(app):
+    with app.app_context():
+        db.create_all()
+        db.session.add(Household(id=1, name='Home', invite_code='home'))
+        db.session.commit()
+        rv = app.test_client().get('/')
+        db.drop_all()
+    return rv
+
+
+@pytest.fixture
+def no_compile(monkeypatch):
+    def compile(*args, **kwargs):
+        raise AssertionError('Template was compiled')
+    return lambda: monkeypatch.setattr(jinja2.Environment, 'compile',
+                                       compile)
+
+
+def test_filesystem(tmpdir, no_compile):
+    redis = fakeredis.FakeStrictRedis()
+    app = make_app(redis, TEMPLATE_CACHE='filesystem',
+                   TEMPLATE_CACHE_DIR=str(tmpdir))
+    assert precompile_templates(app) == TEMPLATES
+    assert len(tmpdir.listdir()) == TEMPLATES
+
+    # A new worker loads them without compiling
+    no_compile()
+    app = make_app(redis, TEMPLATE_CACHE='filesystem',
+                   TEMPLATE_CACHE_DIR=str(tmpdir))
+    assert render_home(app).status_code == 200
+
+
+def test_redis(no_compile):
+    redis = fakeredis.FakeStrictRedis()
+    app = make_app(redis, TEMPLATE_CACHE='redis')
+    assert isinstance(app.jinja_env.bytecode_cache, RedisBytecodeCache)
+    precompile_templates(app)
+    assert len(redis.keys('jinja:bytecode:*')) == TEMPLATES
+
+    no_compile()
+    app = make_app(redis, TEMPLATE_CACHE='redis')
+    assert render_home(app).status_code == 200
+
+
+def test_redis_down():
+    app = make_app(None, TEMPLATE_CACHE='redis')
+    app.redis = fakeredis.FakeStrictRedis(connected=False)
+    assert precompile_templates(app) == TEMPLATES
+
+
+def test_unknown_cache():
+    with pytest.raises(ValueError):
+        make_app(None, TEMPLATE_CACHE='memcached')
+
+
+def test_compile_command(tmpdir):
+    app = make_app(None, TEMPLATE_CACHE='filesystem',
+                   TEMPLATE_CACHE_DIR=str(tmpdir))
+    rv = app.test_cli_runner().invoke(args=['templates', 'compile'])
+    assert rv.exit_code == 0
+    assert 'Compiled {0} templates'.format(TEMPLATES) in rv.output
+    assert len(tmpdir.listdir()) == TEMPLATES
+
+    app = make_app(None)
+    rv = app.test_cli_runner().invoke(args=['templates', 'compile'])
+    assert rv.exit_code == 1
@@ -2,7 +2,8 @@
 """Test utility functions."""
 
 from datetime import date
-from expenses.util import LazyObject, check_csrf, date_format, random_string
+from expenses.util import LazyObject, check_csrf, date_format, \
+                          parse_expense, random_string
 import flask
 import pytest
 
@@ -117,6 +118,26 @@ def test_date_format():
     assert date_format(date(2015, 1, 31), date(2014, 1, 1)) == 'January 2015'
 
 
+def test_parse_expense():
+    values, errors = parse_expense('Tea', '2.50', '01/02/2015')
+    assert values == {'name': 'Tea', 'cost': 250, 'date': date(2015, 1, 2)}
+    assert errors == []
+    assert parse_expense('Tea', 10 ** 10, '01/02/2015')[1] == []
+
+    for name in (['Tea'], {'name': 'Tea'}, 5):
+        assert parse_expense(name, 1, '01/02/2015')[1] == \
+            ['Expected a valid name']
+    for price in ('x', None, [1], True, 1e308, '1e308', 'inf', 'nan'):
+        assert parse_expense('Tea', price, '01/02/2015')[1] == \
+            ['Expected a valid price']
+    assert parse_expense('Tea', 10 ** 10 + 1, '01/02/2015')[1] == \
+        ['The price must be at most $10,000,000,000.00']
+    assert parse_expense('Tea', 0, '01/02/2015')[1] == \
+        ['The price must be greater than $0.00']
+    for p_date in (None, 5, ['01/02/2015'], '2015-01-02'):
+        assert parse_expense('Tea', 1, p_date)[1] == ['Expected a valid date']
+
+
 def test_random_string():
     for n in (-2, -1):
         with pytest.raises(ValueError) as exc:
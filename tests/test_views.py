@@ -0,0 +1,716 @@
+# -*- coding: utf-8 -*-
+"""Test views."""
+
+from conftest import add_user
+from contextlib import contextmanager
+from datetime import date, timedelta
+from expenses import ledger
+from expenses.cache import count_key, incr_purchase_count, response_cache
+from expenses.hashing import hash_rounds
+from expenses.model import db, Household, User, Purchase, PurchaseShare, \
+                           UserTotal
+from expenses.query import purchase_rows, after_position, iter_batches
+from expenses.totals import totals_drift
+from expenses.util import encode_cursor
+from expenses.views import PER_PAGE
+import io
+import json
+import pytest
+import sqlalchemy
+import threading
+
+
+def add_purchases(user, n, start=date(2015, 1, 1)):
+    # Several purchases share each date, to exercise the id tie-breaker
+    for i in range(n):
+        db.session.add(Purchase(name='Purchase {0}'.format(i), cost=100 + i,
+                                date=start + timedelta(days=i // 3),
+                                user_id=user.id,
+                                household_id=user.household_id))
+    db.session.commit()
+
+
+def set_session(client, **data):
+    data['csrf'] = 'token'
+    client.application.redis.set('session:abcd', json.dumps(data))
+    client.set_cookie('localhost', 'session', 'abcd')
+
+
+def login(client, user):
+    set_session(client, user=user.id, household=user.household_id)
+
+
+@contextmanager
+def count_queries():
+    statements = []
+
+    def before_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+    sqlalchemy.event.listen(db.engine, 'before_cursor_execute',
+                            before_execute)
+    try:
+        yield statements
+    finally:
+        sqlalchemy.event.remove(db.engine, 'before_cursor_execute',
+                                before_execute)
+
+
+def get_json(client, url):
+    rv = client.get(url)
+    return rv.status_code, json.loads(rv.data.decode())
+
+
+def test_expenses_pages(client):
+    add_purchases(add_user('Alice'), PER_PAGE + 10)
+
+    status, data = get_json(client, '/expenses?page=0')
+    assert status == 200
+    assert len(data['expenses']) == PER_PAGE
+    assert data['expenses'][0]['name'] == 'Purchase {0}'.format(PER_PAGE + 9)
+    assert data['expenses'][0]['user'] == 'Alice'
+    assert 'cursor=' in data['links']['next']
+
+    status, data = get_json(client, '/expenses?page=1')
+    assert status == 200
+    assert len(data['expenses']) == 10
+    assert data['links'] == {}
+
+    for page in ('2', '-1', 'abc'):
+        status, data = get_json(client, '/expenses?page=' + page)
+        assert status == 404
+        assert data['msg'] == 'Invalid page number.'
+
+
+def test_expenses_cursor(client):
+    add_purchases(add_user('Alice'), 3 * PER_PAGE + 7)
+    _, first = get_json(client, '/expenses')
+
+    names = [e['name'] for e in first['expenses']]
+    url = first['links']['next']
+    pages = 1
+    while url:
+        status, data = get_json(client, url)
+        assert status == 200
+        names.extend(e['name'] for e in data['expenses'])
+        url = data['links'].get('next')
+        pages += 1
+
+    assert pages == 4
+    expected = ['Purchase {0}'.format(i) for i in range(3 * PER_PAGE + 7)]
+    assert names == expected[::-1]
+
+    # Cursor pages line up with the numbered pages
+    _, by_cursor = get_json(client, first['links']['next'])
+    _, by_page = get_json(client, '/expenses?page=1')
+    assert by_cursor['expenses'] == by_page['expenses']
+
+
+def test_expenses_exact_page(client):
+    add_purchases(add_user('Alice'), 2 * PER_PAGE)
+    _, data = get_json(client, '/expenses')
+    _, data = get_json(client, data['links']['next'])
+    assert len(data['expenses']) == PER_PAGE
+    assert data['links'] == {}
+
+
+def test_expenses_invalid_cursor(client):
+    add_purchases(add_user('Alice'), 5)
+    for cursor in ('', 'abc', '!!!!', encode_cursor(date(1, 1, 1), 1),
+                   encode_cursor(date(2015, 1, 1), 2 ** 63),
+                   encode_cursor(date(2015, 1, 1), -1)):
+        status, data = get_json(client, '/expenses?cursor=' + cursor)
+        assert status == 404
+        assert data['msg'] == 'Invalid cursor.'
+    for page in ('-1', 'x', str(10 ** 30)):
+        status, data = get_json(client, '/expenses?page=' + page)
+        assert status == 404
+        assert data['msg'] == 'Invalid page number.'
+
+
+def test_expenses_query_count(app, client):
+    app.config['CACHE_TTL'] = 0
+    for i in range(PER_PAGE):
+        add_purchases(add_user('User {0}'.format(i)), 2)
+
+    with count_queries() as statements:
+        _, data = get_json(client, '/expenses')
+    assert len(data['expenses']) == PER_PAGE
+    assert len(statements) == 1
+
+    with count_queries() as statements:
+        _, data = get_json(client, data['links']['next'])
+    assert len(data['expenses']) == PER_PAGE
+    assert len(statements) == 1
+
+    with count_queries() as statements:
+        rv = client.get('/')
+    assert rv.status_code == 200
+    assert len(statements) == 2
+
+
+def test_expenses_total(app, client):
+    app.config['CACHE_TTL'] = 0
+    alice = add_user('Alice')
+    add_purchases(alice, 3)
+
+    _, data = get_json(client, '/expenses')
+    assert 'total' not in data
+
+    with count_queries() as statements:
+        _, data = get_json(client, '/expenses?total=1')
+    assert data['total'] == 3
+    assert len(statements) == 2
+
+    login(client, alice)
+    rv = client.post('/expenses', data={
+        'token': 'token',
+        'name': 'Groceries',
+        'price': '12.50',
+        'date': '01/05/2015',
+    })
+    assert rv.status_code == 303
+
+    with count_queries() as statements:
+        _, data = get_json(client, '/expenses?total=1')
+    assert data['total'] == 4
+    assert len(statements) == 1
+
+
+def test_incr_purchase_count(app):
+    key = count_key(1)
+    incr_purchase_count(1, 2)
+    assert app.redis.get(key) is None
+
+    app.redis.set(key, 5, ex=60)
+    incr_purchase_count(1, 2)
+    assert app.redis.get(key) == b'7'
+    assert app.redis.ttl(key) > 0
+
+
+def post_expense(client, price, name='Groceries', p_date='01/05/2015',
+                 **extra):
+    data = {
+        'token': 'token',
+        'name': name,
+        'price': price,
+        'date': p_date,
+    }
+    data.update(extra)
+    return client.post('/expenses', data=data)
+
+
+def test_home_balances(client):
+    alice = add_user('Alice')
+    add_user('Bob')
+
+    login(client, alice)
+    assert post_expense(client, '30.00').status_code == 303
+    assert post_expense(client, '12.50').status_code == 303
+    assert db.session.query(UserTotal.total).scalar() == 4250
+
+    with count_queries() as statements:
+        rv = client.get('/')
+    assert b'$21.25' in rv.data
+    assert b'$-21.25' in rv.data
+    assert not any('sum(' in s.lower() for s in statements)
+
+
+def test_split_expense(client):
+    alice = add_user('Alice')
+    bob = add_user('Bob').id
+    carol = add_user('Carol').id
+
+    login(client, alice)
+    alice = alice.id
+    # Alice pays for something only she and Bob share, Bob twice over
+    rv = post_expense(client, '30.00', participants=[alice, bob],
+                      **{'weight-{0}'.format(bob): '2'})
+    assert rv.status_code == 303
+    shares = db.session.query(PurchaseShare.user_id, PurchaseShare.amount)
+    assert dict(shares) == {alice: 1000, bob: 2000}
+    # and something for everyone
+    assert post_expense(client, '9.00').status_code == 303
+    assert totals_drift() == {}
+
+    status, data = get_json(client, '/settlement')
+    assert data == {'payments': [
+        {'from': 'Bob', 'to': 'Alice', 'amount': '$23.00'},
+        {'from': 'Carol', 'to': 'Alice', 'amount': '$3.00'},
+    ]}
+
+    for participants in ([''], [alice, 'x'], [alice, carol + 1]):
+        rv = post_expense(client, '1.00', participants=participants)
+        assert rv.status_code == 303
+    rv = post_expense(client, '1.00', participants=[alice],
+                      **{'weight-{0}'.format(alice): '0'})
+    assert db.session.query(Purchase).count() == 2
+
+
+def test_response_cache(client):
+    alice = add_user('Alice')
+    add_purchases(alice, 3)
+    response_cache.hits = response_cache.misses = 0
+
+    with count_queries() as statements:
+        rv = client.get('/')
+        _, data = get_json(client, '/expenses')
+    assert len(statements) == 2
+    assert len(data['expenses']) == 3
+
+    with count_queries() as statements:
+        rv = client.get('/')
+        _, data = get_json(client, '/expenses')
+    assert statements == []
+    assert len(data['expenses']) == 3
+
+    login(client, alice)
+    assert post_expense(client, '1.00').status_code == 303
+
+    with count_queries() as statements:
+        rv = client.get('/')
+        _, data = get_json(client, '/expenses')
+    # Signed in, the home page also shows the household's invite code
+    assert len(statements) == 3
+    assert len(data['expenses']) == 4
+    assert b'home' in rv.data
+
+    # The last hit is only flushed to redis with the next miss
+    assert response_cache.stats() == {'hits': 4, 'misses': 5}
+
+
+def test_expenses_etag(client):
+    alice = add_user('Alice')
+    add_purchases(alice, PER_PAGE + 1)
+
+    rv = client.get('/expenses')
+    etag = rv.headers['ETag']
+    assert rv.status_code == 200
+
+    with count_queries() as statements:
+        rv = client.get('/expenses', headers={'If-None-Match': etag})
+    assert rv.status_code == 304
+    assert rv.headers['ETag'] == etag
+    assert rv.data == b''
+    assert statements == []
+
+    # Each page has its own validator
+    links = json.loads(client.get('/expenses').data.decode())['links']
+    rv = client.get(links['next'], headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+    assert rv.headers['ETag'] != etag
+
+    login(client, alice)
+    assert post_expense(client, '1.00').status_code == 303
+    rv = client.get('/expenses', headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+    assert rv.headers['ETag'] != etag
+
+
+def test_signup_and_login(app, client):
+    set_session(client)
+    rv = client.post('/users', data={
+        'token': 'token',
+        'name': 'Alice',
+        'username': 'alice',
+        'password': 'hunter2',
+    })
+    assert rv.status_code == 303
+    user = User.query.filter_by(username='alice').one()
+    assert hash_rounds(user.password) == 4
+
+    # Logging in upgrades the hash to the new cost
+    app.hasher.rounds = 5
+    set_session(client)
+    rv = client.post('/auth', data={
+        'token': 'token',
+        'username': 'alice',
+        'password': 'hunter2',
+    })
+    assert rv.status_code == 303
+    assert rv.headers['Location'] == 'http://localhost/'
+    db.session.refresh(user)
+    assert hash_rounds(user.password) == 5
+    assert app.hasher.check('hunter2', user.password)
+
+    set_session(client)
+    rv = client.post('/auth', data={
+        'token': 'token',
+        'username': 'alice',
+        'password': 'wrong',
+    })
+    assert rv.headers['Location'].startswith('http://localhost/login/')
+
+
+def test_hasher_busy(app, client, monkeypatch):
+    add_user('Alice')
+    monkeypatch.setattr(app.hasher, 'slots', threading.Semaphore(0))
+    set_session(client)
+    rv = client.post('/auth', data={
+        'token': 'token',
+        'username': 'alice',
+        'password': 'hunter2',
+    })
+    assert rv.status_code == 503
+    assert b'>Error 503</h1>' in rv.data
+
+
+def test_listing_uses_index(app):
+    queries = [
+        (purchase_rows(1).limit(PER_PAGE + 1), '(household_id=?)'),
+        (purchase_rows(1).filter(after_position(date(2015, 1, 1), 10))
+         .limit(PER_PAGE + 1), '(household_id=? AND date<?)'),
+    ]
+    for query, search in queries:
+        sql = str(query.statement.compile(
+            db.engine, compile_kwargs={'literal_binds': True}))
+        plan = db.session.execute('EXPLAIN QUERY PLAN ' + sql).fetchall()
+        details = ' '.join(row[-1] for row in plan)
+        # SQLite only lists the constraints when it searches the index
+        assert 'USING INDEX ix_purchase_household_date_id ' + search \
+            in details
+        assert 'TEMP B-TREE' not in details
+
+
+def test_import_expenses(client):
+    alice = add_user('Alice')
+    login(client, alice)
+    _, data = get_json(client, '/expenses?total=1')
+
+    csv = b'name,price,date\nSoap,2.50,01/02/2015\nTea,x,01/02/2015\n'
+    rv = client.post('/expenses/import', data={
+        'token': 'token',
+        'file': (io.BytesIO(csv), 'history.csv'),
+    })
+    assert rv.status_code == 200
+    assert json.loads(rv.data.decode()) == {
+        'imported': 1,
+        'failed': 1,
+        'errors': [{'row': 2, 'errors': ['Expected a valid price']}],
+    }
+    _, data = get_json(client, '/expenses?total=1')
+    assert data['total'] == 1
+    assert data['expenses'][0]['name'] == 'Soap'
+
+    rv = client.post('/expenses/import', data={
+        'token': 'token',
+        'file': (io.BytesIO(b'[{"name": '), 'history.json'),
+    })
+    assert rv.status_code == 400
+    assert 'Could not read the file' in json.loads(rv.data.decode())['msg']
+
+    rv = client.post('/expenses/import', data={
+        'token': 'token',
+        'file': (io.BytesIO(csv), 'history.xls'),
+    })
+    assert rv.status_code == 400
+
+
+def post_batch(client, expenses):
+    rv = client.post('/expenses/batch', data=json.dumps(expenses),
+                     content_type='application/json',
+                     headers={'X-CSRF-Token': 'token'})
+    return rv.status_code, json.loads(rv.data.decode())
+
+
+def test_add_expenses(client):
+    alice = add_user('Alice')
+    bob = add_user('Bob')
+    other = Household(id=2, name='Other', invite_code='other')
+    db.session.add(other)
+    db.session.commit()
+    carol = add_user('Carol', household_id=2)
+    login(client, alice)
+
+    batch = [
+        {'key': 'a', 'name': 'Soap', 'price': '2.50', 'date': '01/02/2015'},
+        {'key': 'b', 'name': 'Tea', 'price': 4, 'date': '01/03/2015',
+         'participants': [alice.id, bob.id],
+         'weights': {str(bob.id): 3}},
+        {'key': 'c', 'name': 'Tea', 'price': 'x', 'date': '01/03/2015'},
+        {'key': 'd', 'name': 'Gift', 'price': 1, 'date': '01/03/2015',
+         'participants': [carol.id]},
+        {'name': 'Keyless', 'price': 1, 'date': '01/03/2015'},
+        {'key': 'a', 'name': 'Soap', 'price': '2.50', 'date': '01/02/2015'},
+        'Soap',
+    ]
+    with count_queries() as statements:
+        status, data = post_batch(client, batch)
+    assert status == 200
+    assert [(r['key'], r['status']) for r in data['results']] == [
+        ('a', 'created'), ('b', 'created'), ('c', 'invalid'),
+        ('d', 'invalid'), (None, 'invalid'), ('a', 'duplicate'),
+        (None, 'invalid'),
+    ]
+    results = data['results']
+    assert results[0]['id'] == results[5]['id']
+    assert results[2]['errors'] == ['Expected a valid price']
+    assert results[3]['errors'] == ['Expected valid participants']
+    assert results[4]['errors'] == ['Expected a key of at most 64 characters']
+    assert results[6]['errors'] == ['Expected an object']
+    # No more statements for more expenses
+    inserts = [s for s in statements if s.startswith('INSERT INTO purchase ')]
+    assert len(inserts) == 2
+
+    tea = Purchase.query.get(results[1]['id'])
+    assert tea.client_key == 'b'
+    shares = dict((s.user_id, s.amount) for s in
+                  PurchaseShare.query.filter_by(purchase_id=tea.id))
+    assert shares == {alice.id: 100, bob.id: 300}
+    _, data = get_json(client, '/expenses?total=1')
+    assert data['total'] == 2
+
+    # Sending it again after a lost response doesn't add anything
+    status, data = post_batch(client, batch)
+    assert [r['status'] for r in data['results']] == [
+        'duplicate', 'duplicate', 'invalid', 'invalid', 'invalid',
+        'duplicate', 'invalid']
+    assert [r.get('id') for r in data['results']] == \
+        [r.get('id') for r in results]
+    assert db.session.query(Purchase).count() == 2
+    _, data = get_json(client, '/expenses?total=1')
+    assert data['total'] == 2
+
+    # Keys are per user
+    login(client, bob)
+    status, data = post_batch(client, batch[:1])
+    assert data['results'][0]['status'] == 'created'
+
+
+def test_add_expenses_at_once(client, monkeypatch):
+    alice = add_user('Alice')
+    login(client, alice)
+    expense = {'key': 'a', 'name': 'Soap', 'price': 1, 'date': '01/02/2015'}
+    assert post_batch(client, [expense])[1]['results'][0]['status'] == \
+        'created'
+
+    # As if another request added it after this one looked
+    lookup = ledger.keyed_purchase_ids
+    stale = [True]
+
+    def keyed_purchase_ids(user_id, keys):
+        if stale:
+            return {}
+        return lookup(user_id, keys)
+    monkeypatch.setattr(ledger, 'keyed_purchase_ids', keyed_purchase_ids)
+    real_add = ledger.add_purchases
+
+    def add_purchases(rows):
+        del stale[:]
+        real_add(rows)
+    monkeypatch.setattr(ledger, 'add_purchases', add_purchases)
+
+    status, data = post_batch(client, [expense])
+    assert status == 200
+    assert data['results'][0]['status'] == 'duplicate'
+    assert db.session.query(Purchase).count() == 1
+
+
+def test_add_expenses_invalid(client):
+    alice = add_user('Alice')
+    login(client, alice)
+    expense = {'key': 'a', 'name': 'Soap', 'price': 1, 'date': '01/02/2015'}
+    for body in ({}, [], 'Soap', [expense] * 501):
+        status, data = post_batch(client, body)
+        assert status == 400
+    for headers in ({'X-CSRF-Token': 'wrong'}, {}):
+        rv = client.post('/expenses/batch', data=json.dumps([expense]),
+                         content_type='application/json', headers=headers)
+        assert rv.status_code == 403
+
+    # Anything JSON can hold is reported, rather than failing the batch
+    bad = [
+        {'name': ['Soap']}, {'name': {'a': 1}}, {'name': 5},
+        {'price': 1e308}, {'price': '1e308'}, {'price': 1e20},
+        {'price': True}, {'price': [1]}, {'date': 5}, {'date': ['x']},
+        {'participants': [1e308]}, {'participants': ['1' * 30]},
+        {'participants': [alice.id], 'weights': {str(alice.id): 1e308}},
+        {'participants': 'x'}, {'participants': [alice.id], 'weights': 'x'},
+    ]
+    batch = [dict(expense, key=str(i), **fields)
+             for i, fields in enumerate(bad)]
+    status, data = post_batch(client, batch + [dict(expense, key='ok')])
+    assert status == 200
+    statuses = [r['status'] for r in data['results']]
+    assert statuses == ['invalid'] * len(bad) + ['created']
+    assert data['results'][5]['errors'] == \
+        ['The price must be at most $10,000,000,000.00']
+    assert db.session.query(Purchase).count() == 1
+
+
+def test_export_seeks(client):
+    alice = add_user('Alice')
+    db.session.execute(Purchase.__table__.insert(), [{
+        'name': 'Purchase {0}'.format(i), 'cost': 100, 'user_id': alice.id,
+        'household_id': 1, 'date': date(2015, 1, 1) + timedelta(days=i // 3),
+    } for i in range(2500)])
+    db.session.commit()
+
+    statements = []
+
+    def before_execute(conn, cursor, statement, parameters, *args):
+        if statement.startswith('SELECT purchase.id'):
+            statements.append((statement, parameters))
+    sqlalchemy.event.listen(db.engine, 'before_cursor_execute',
+                            before_execute)
+    try:
+        rv = client.get('/expenses/export')
+        assert len(rv.data.decode().splitlines()) == 2501
+    finally:
+        sqlalchemy.event.remove(db.engine, 'before_cursor_execute',
+                                before_execute)
+
+    # Every batch after the first seeks to where the last one ended,
+    # rather than filtering its way down from the newest purchase
+    assert len(statements) == 3
+    for statement, parameters in statements[1:]:
+        plan = db.session.connection().connection.execute(
+            'EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+        details = ' '.join(row[-1] for row in plan)
+        assert 'USING INDEX ix_purchase_household_date_id ' \
+            '(household_id=? AND date<?)' in details
+
+
+def test_iter_batches(app):
+    add_purchases(add_user('Alice'), 20)
+    batches = list(iter_batches(purchase_rows(1), batch_size=7))
+    assert [len(rows) for rows in batches] == [7, 7, 6]
+    names = [p.name for rows in batches for p in rows]
+    assert names == ['Purchase {0}'.format(i) for i in range(19, -1, -1)]
+
+
+def test_export_unicode(client):
+    alice = add_user(u'Zoë')
+    db.session.add(Purchase(name=u'Café, crème', cost=350, user_id=alice.id,
+                            household_id=1, date=date(2015, 1, 3)))
+    db.session.commit()
+    rv = client.get('/expenses/export')
+    assert rv.data.decode('utf-8').splitlines()[1] == \
+        u'1,Zoë,"Café, crème",3.50,01/03/2015'
+
+
+def test_export(client):
+    alice = add_user('Alice')
+    bob = add_user('Bob')
+    add_purchases(alice, 3)
+    add_purchases(bob, 4, start=date(2015, 2, 1))
+
+    rv = client.get('/expenses/export')
+    assert rv.status_code == 200
+    assert rv.mimetype == 'text/csv'
+    assert rv.headers['Content-Disposition'] == \
+        'attachment; filename=expenses.csv'
+    lines = rv.data.decode().splitlines()
+    assert lines[0] == 'id,user,name,price,date'
+    assert lines[1] == '7,Bob,Purchase 3,1.03,02/02/2015'
+    assert len(lines) == 8
+
+    rv = client.get('/expenses/export?format=ndjson&user={0}'
+                    '&start=2015-02-02&end=2015-02-28'.format(bob.id))
+    assert rv.mimetype == 'application/x-ndjson'
+    rows = [json.loads(line) for line in rv.data.decode().splitlines()]
+    assert rows == [{
+        'id': 7,
+        'user': 'Bob',
+        'name': 'Purchase 3',
+        'price': '1.03',
+        'date': '02/02/2015',
+    }]
+
+    for query in ('format=xml', 'start=yesterday', 'user=bob', 'user=0',
+                  'user={0}'.format(10 ** 30)):
+        rv = client.get('/expenses/export?' + query)
+        assert rv.status_code == 400
+
+
+def test_settlement(client):
+    alice = add_user('Alice')
+    add_user('Bob')
+    add_user('Carol')
+
+    login(client, alice)
+    assert post_expense(client, '30.00').status_code == 303
+
+    status, data = get_json(client, '/settlement')
+    assert status == 200
+    assert data == {'payments': [
+        {'from': 'Bob', 'to': 'Alice', 'amount': '$10.00'},
+        {'from': 'Carol', 'to': 'Alice', 'amount': '$10.00'},
+    ]}
+    rv = client.get('/')
+    assert b'Bob pays Alice $10.00' in rv.data
+
+
+def test_households(app, client):
+    db.session.add(Household(id=2, name='Flat', invite_code='flat'))
+    alice = add_user('Alice')
+    add_user('Bob')
+    carol = add_user('Carol', household_id=2)
+    dave = add_user('Dave', household_id=2)
+    add_purchases(alice, 5)
+
+    login(client, carol)
+    assert post_expense(client, '10.00').status_code == 303
+    # Only people in the same household can share a purchase
+    rv = post_expense(client, '10.00', participants=[carol.id, alice.id])
+    assert rv.status_code == 303
+
+    status, data = get_json(client, '/expenses?total=1')
+    assert [e['user'] for e in data['expenses']] == ['Carol']
+    assert data['total'] == 1
+    _, data = get_json(client, '/settlement')
+    assert data == {'payments': [
+        {'from': 'Dave', 'to': 'Carol', 'amount': '$5.00'},
+    ]}
+    rv = client.get('/expenses/export?format=ndjson')
+    assert len(rv.data.splitlines()) == 1
+    rv = client.get('/')
+    assert b'Alice' not in rv.data
+    assert b'flat' in rv.data
+
+    # Signed out, the default household is shown
+    set_session(client)
+    _, data = get_json(client, '/expenses?total=1')
+    assert data['total'] == 5
+    _, data = get_json(client, '/settlement')
+    assert data == {'payments': []}
+
+    # Sessions from before households look it up once
+    set_session(client, user=dave.id)
+    _, data = get_json(client, '/expenses')
+    assert [e['user'] for e in data['expenses']] == ['Carol']
+    session = json.loads(app.redis.get('session:abcd').decode())
+    assert session['household'] == 2
+
+
+def test_signup_households(app, client):
+    db.session.add(Household(id=2, name='Flat', invite_code='flat'))
+    db.session.commit()
+
+    def signup(username, invite=''):
+        set_session(client)
+        return client.post('/users', data={
+            'token': 'token',
+            'name': username.capitalize(),
+            'username': username,
+            'password': 'hunter2',
+            'invite': invite,
+        })
+
+    assert signup('alice').status_code == 303
+    assert signup('carol', 'flat').status_code == 303
+    rv = signup('eve', 'nope')
+    assert rv.headers['Location'] == 'http://localhost/signup/'
+    assert dict(db.session.query(User.username, User.household_id)) == {
+        'alice': 1,
+        'carol': 2,
+    }
+
+    # Without a default, signing up makes a new household
+    app.config['DEFAULT_HOUSEHOLD'] = None
+    set_session(client)
+    rv = client.get('/')
+    assert rv.status_code == 303
+    assert signup('bob').status_code == 303
+    bob = User.query.filter_by(username='bob').one()
+    assert bob.household.name == "Bob's household"
+    assert bob.household_id not in (1, 2)